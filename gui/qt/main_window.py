@@ -277,6 +277,8 @@ class ElectrumWindow(QMainWindow):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
+                # fold the journal into the wallet file before copying it
+                self.wallet.storage.write()
                 shutil.copy2(path, new_path)
                 QMessageBox.information(None,"Wallet backup created", _("A copy of your wallet file was created in")+" '%s'" % str(new_path))
             except (IOError, os.error), reason:
@@ -522,6 +524,7 @@ class ElectrumWindow(QMainWindow):
     def create_history_tab(self):
         self.history_list = l = MyTreeWidget(self)
         self.history_list.setObjectName('history_list')
+        self.history_rows = []
         l.setColumnCount(5)
         for i,width in enumerate(self.column_widths['history']):
             l.setColumnWidth(i, width)
@@ -634,55 +637,71 @@ class ElectrumWindow(QMainWindow):
 
 
     def update_history_tab(self):
-
-        self.history_list.clear()
-        for item in self.wallet.get_tx_history(self.current_account):
-            tx_hash, conf, is_mine, value, fee, balance, timestamp = item
-            time_str = _("unknown")
-            if conf > 0:
-                time_str = self.format_time(timestamp)
-            if conf == -1:
-                time_str = 'unverified'
-                icon = QIcon(":icons/unconfirmed.png")
-            elif conf == 0:
-                time_str = 'pending'
-                icon = QIcon(":icons/unconfirmed.png")
-            elif conf < 6:
-                icon = QIcon(":icons/clock%d.png"%conf)
-            else:
-                icon = QIcon(":icons/confirmed.png")
-
-            if value is not None:
-                v_str = self.format_amount(value, True, whitespaces=True)
-            else:
-                v_str = '--'
-
-            balance_str = self.format_amount(balance, whitespaces=True)
-
+        history = self.wallet.get_tx_history(self.current_account)
+        l = self.history_list
+        # rows are kept between updates, oldest at the bottom, and only
+        # the rows whose transaction changed are filled again
+        if len(self.history_rows) > len(history):
+            for i in range(len(self.history_rows) - len(history)):
+                l.takeTopLevelItem(0)
+            self.history_rows = self.history_rows[:len(history)]
+        for j, h_item in enumerate(history):
+            tx_hash = h_item[0]
             if tx_hash:
                 label, is_default_label = self.wallet.get_label(tx_hash)
             else:
                 label = _('Pruned transaction outputs')
                 is_default_label = False
+            row = (h_item, label, is_default_label)
+            if j < len(self.history_rows):
+                if self.history_rows[j] == row:
+                    continue
+                self.history_rows[j] = row
+                item = l.topLevelItem(l.topLevelItemCount() - 1 - j)
+            else:
+                self.history_rows.append(row)
+                item = QTreeWidgetItem()
+                item.setFont(2, QFont(MONOSPACE_FONT))
+                item.setFont(3, QFont(MONOSPACE_FONT))
+                item.setFont(4, QFont(MONOSPACE_FONT))
+                l.insertTopLevelItem(0, item)
+            self.fill_history_item(item, h_item, label, is_default_label)
 
-            item = QTreeWidgetItem( [ '', time_str, label, v_str, balance_str] )
-            item.setFont(2, QFont(MONOSPACE_FONT))
-            item.setFont(3, QFont(MONOSPACE_FONT))
-            item.setFont(4, QFont(MONOSPACE_FONT))
-            if value < 0:
-                item.setForeground(3, QBrush(QColor("#BC1E1E")))
-            if tx_hash:
-                item.setData(0, Qt.UserRole, tx_hash)
-                item.setToolTip(0, "%d %s\nTxId:%s" % (conf, _('Confirmations'), tx_hash) )
-            if is_default_label:
-                item.setForeground(2, QBrush(QColor('grey')))
+        self.history_list.setCurrentItem(self.history_list.topLevelItem(0))
+        run_hook('history_tab_update')
 
-            item.setIcon(0, icon)
-            self.history_list.insertTopLevelItem(0,item)
 
+    def fill_history_item(self, item, h_item, label, is_default_label):
+        tx_hash, conf, is_mine, value, fee, balance, timestamp = h_item
+        time_str = _("unknown")
+        if conf > 0:
+            time_str = self.format_time(timestamp)
+        if conf == -1:
+            time_str = 'unverified'
+            icon = QIcon(":icons/unconfirmed.png")
+        elif conf == 0:
+            time_str = 'pending'
+            icon = QIcon(":icons/unconfirmed.png")
+        elif conf < 6:
+            icon = QIcon(":icons/clock%d.png"%conf)
+        else:
+            icon = QIcon(":icons/confirmed.png")
 
-        self.history_list.setCurrentItem(self.history_list.topLevelItem(0))
-        run_hook('history_tab_update')
+        if value is not None:
+            v_str = self.format_amount(value, True, whitespaces=True)
+        else:
+            v_str = '--'
+
+        balance_str = self.format_amount(balance, whitespaces=True)
+
+        for i, text in enumerate([ '', time_str, label, v_str, balance_str]):
+            item.setText(i, text)
+        # rows are reused, so every field is set or reset
+        item.setData(3, Qt.ForegroundRole, QBrush(QColor("#BC1E1E")) if value < 0 else QVariant())
+        item.setData(0, Qt.UserRole, tx_hash if tx_hash else QVariant())
+        item.setToolTip(0, "%d %s\nTxId:%s" % (conf, _('Confirmations'), tx_hash) if tx_hash else '')
+        item.setData(2, Qt.ForegroundRole, QBrush(QColor('grey')) if is_default_label else QVariant())
+        item.setIcon(0, icon)
 
 
     def create_receive_tab(self):
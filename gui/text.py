@@ -107,7 +107,8 @@ class ElectrumGui:
         b = 0 
         self.history = []
 
-        for item in self.wallet.get_tx_history():
+        # only the most recent transactions fit on the screen
+        for item in self.wallet.get_tx_history(offset=-(self.maxy-4)):
             tx_hash, conf, is_mine, value, fee, balance, timestamp = item
             if conf:
                 try:
@@ -3,7 +3,7 @@ from util import format_satoshis, print_msg, print_json, print_error, set_verbos
 from wallet import WalletSynchronizer, WalletStorage
 from wallet import Wallet, Wallet_2of2, Wallet_2of3, Imported_Wallet
 from verifier import TxVerifier
-from network import Network, DEFAULT_SERVERS, DEFAULT_PORTS, pick_random_server
+from network import Network, LoopNetwork, new_network, DEFAULT_SERVERS, DEFAULT_PORTS, pick_random_server
 from interface import Interface
 from simple_config import SimpleConfig, get_config, set_config
 import pesetacoin
@@ -1,6 +1,9 @@
 # https://github.com/kR105/i0coin/compare/bitcoin:master...master#diff-d3b948fe89a5d012a7eaeea8f25d7c42R1
 import string
+import struct
 import btcutils
+from pesetacoin import Hash, hash_encode
+from transaction import BCDataStream
 
 BLOCK_VERSION_CHAIN_START = (1 << 16)
 
@@ -113,7 +116,7 @@ def verify(auxhash, chain_id, auxpow):
     pos = pos + len(root_hash)
     if (len(script) - pos < 8):
         print 'Aux POW missing chain merkle tree size and nonce in parent coinbase'
-        return false
+        return False
 
      #int nSize;
     #memcpy(&nSize, &pc[0], 4);
@@ -161,3 +164,114 @@ def verify(auxhash, chain_id, auxpow):
         return False
 
     return True
+
+
+class AuxPow(object):
+    """Auxpow data parsed from its serialized form.  Hashes are kept as
+    raw 32-byte strings, the coinbase script and the parent block header
+    as raw bytes."""
+
+    __slots__ = ('coinbase_txid', 'coinbase_script', 'coinbase_branch', 'coinbase_index',
+                 'chain_branch', 'chain_index', 'parent_block')
+
+    def __init__(self, s):
+        vds = BCDataStream()
+        vds.write(s)
+        # the coinbase is served without its outpoint, which must be
+        # inserted back to compute the txid
+        vds.read_int32()
+        for i in xrange(vds.read_compact_size()):
+            outpoint_pos = vds.read_cursor
+            self.coinbase_script = vds.read_string()
+            vds.read_uint32()
+        for i in xrange(vds.read_compact_size()):
+            vds.read_int64()
+            vds.read_string()
+        vds.read_uint32()
+        self.coinbase_txid = Hash(s[0:outpoint_pos] + '\0'*32 + '\xff'*4 + s[outpoint_pos:vds.read_cursor])
+        self.coinbase_branch, self.coinbase_index = self.read_merkle_branch(vds)
+        self.chain_branch, self.chain_index = self.read_merkle_branch(vds)
+        self.parent_block = s[vds.read_cursor:vds.read_cursor+80]
+
+    @staticmethod
+    def read_merkle_branch(vds):
+        hashes = [vds.read_bytes(32) for i in xrange(vds.read_compact_size())]
+        return hashes, vds.read_int32()
+
+    def __getstate__(self):
+        return [getattr(self, k) for k in self.__slots__]
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+    def as_dict(self):
+        return {
+            'coinbasetx': {'txid': hash_encode(self.coinbase_txid), 'coinbase': self.coinbase_script.encode('hex')},
+            'coinbaseMerkleBranch': map(hash_encode, self.coinbase_branch),
+            'coinbaseIndex': self.coinbase_index,
+            'chainMerkleBranch': map(hash_encode, self.chain_branch),
+            'chainIndex': self.chain_index,
+            'parent_block': self.parent_block.encode('hex'),
+        }
+
+
+def merkle_root(_hash, merkle_branch, index):
+    """Same as check_merkle_branch, on raw hashes."""
+    for h in merkle_branch:
+        if index & 1:
+            _hash = Hash(h + _hash)
+        else:
+            _hash = Hash(_hash + h)
+        index >>= 1
+    return _hash
+
+def check(auxhash, chain_id, aux):
+    """Check the auxpow of a block, given the raw hash of its header.
+    Returns None if it is valid, or the reason why it is not."""
+    parent_version, = struct.unpack('<I', aux.parent_block[0:4])
+    if parent_version / BLOCK_VERSION_CHAIN_START == chain_id:
+        return 'Aux POW parent has our chain ID'
+
+    if merkle_root(aux.coinbase_txid, aux.coinbase_branch, aux.coinbase_index) != aux.parent_block[36:68]:
+        return 'Aux POW merkle root incorrect'
+
+    # the chain merkle root appears in the coinbase in reversed byte order
+    root_hash = merkle_root(auxhash, aux.chain_branch, aux.chain_index)[::-1]
+    script = aux.coinbase_script
+    pos = script.find(root_hash)
+    if pos == -1:
+        return 'Aux POW missing chain merkle root in parent coinbase'
+
+    pos = pos + len(root_hash)
+    if len(script) - pos < 8:
+        return 'Aux POW missing chain merkle tree size and nonce in parent coinbase'
+
+    size, nonce = struct.unpack('<II', script[pos:pos+8])
+    if size != (1 << len(aux.chain_branch)):
+        return 'Aux POW merkle branch size does not match parent coinbase'
+
+    index = calc_merkle_index(chain_id, nonce, size)
+    if aux.chain_index != index:
+        return 'Aux POW wrong index : $chain_index=%d, $index=%d' % (aux.chain_index, index)
+
+def verify_many(items, chain_id=None):
+    """Check a batch of auxpows.  items is a list of (height, auxhash,
+    aux), where auxhash is the raw hash of the block header and aux is
+    either a serialized auxpow or an AuxPow.  Only plain strings and
+    ints are needed, so batches can be sent to worker processes.
+
+    Returns the list of failures, as (height, reason) tuples."""
+    if chain_id is None:
+        chain_id = get_our_chain_id()
+    failures = []
+    for height, auxhash, aux in items:
+        try:
+            if not isinstance(aux, AuxPow):
+                aux = AuxPow(aux)
+            error = check(auxhash, chain_id, aux)
+        except Exception as e:
+            error = 'Aux POW could not be parsed: %r' % e
+        if error:
+            failures.append((height, error))
+    return failures
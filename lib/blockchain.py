@@ -18,16 +18,21 @@
 
 import threading, time, Queue, os, sys, shutil, traceback, json, auxpow
 import zlib
+import array
+import mmap
+import struct
+from collections import OrderedDict
 from decimal import Decimal
 from util import user_dir, appdata_dir, print_error, cdiv, print_msg
 from pesetacoin import *
-from transaction import BCDataStream
 
 try:
     from ltc_scrypt import getPoWHash as PoWHash
+    PoWHashBatch = lambda headers: map(PoWHash, headers)
 except ImportError:
     print_msg("Warning: ltc_scrypt not available, using fallback")
     from scrypt import scrypt_1024_1_1_80 as PoWHash
+    from scrypt import scrypt_batch as PoWHashBatch
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
@@ -50,6 +55,24 @@ kgw_fix   = 127500
 # https://github.com/FundacionPesetacoin/Pesetacoin-0.9.1-Oficial/blob/master/src/main.cpp#L1495
 dgw_start = 582500
 
+# Trusted block hashes, height -> hash.  Headers up to the last checkpoint
+# are only checked for hash linkage and against these hashes; proof of work
+# and retargets are verified above it.
+# The table is generated by scripts/make_checkpoints from a fully verified
+# headers file, with a checkpoint at each era boundary above.  It is empty
+# until it is generated: checkpoints then come from the 'checkpoints'
+# config key only, and without it every header gets full verification.
+checkpoints = {
+}
+
+def get_checkpoints(config):
+    """Checkpoints of the table above, added to or overridden by the
+    'checkpoints' config key, e.g. {"2015": "<block hash>"}."""
+    res = dict(checkpoints)
+    for height, _hash in config.get('checkpoints', {}).items():
+        res[int(height)] = _hash
+    return res
+
 def bits_to_target(bits):
     """Convert a compact representation to a hex target."""
     MM = 256*256*256
@@ -76,6 +99,218 @@ def target_to_bits(target):
     new_bits = c + MM * i
     return new_bits
 
+class BlockHeader(object):
+    """A decoded block header.
+
+    Integer fields are kept as ints and hashes as raw 32-byte strings,
+    next to the serialized 80 bytes, so hashing and re-serializing a
+    header does not go through hex.  Item access mimics the dict used by
+    the server protocol: header['prev_block_hash'] is the hex hash."""
+
+    __slots__ = ('raw', 'version', 'prev_hash', 'merkle_hash', 'timestamp', 'bits', 'nonce',
+                 'block_height', 'auxpow', 'auxpow_offset', 'auxpow_length')
+
+    def __init__(self, s, block_height=None):
+        self.raw = s[0:80]
+        self.version, self.prev_hash, self.merkle_hash, self.timestamp, self.bits, self.nonce = struct.unpack('<I32s32sIII', self.raw)
+        self.block_height = block_height
+        self.auxpow = None
+        if len(s) >= 88:
+            self.auxpow_offset, self.auxpow_length = struct.unpack('<II', s[80:88])
+        else:
+            self.auxpow_offset = self.auxpow_length = None
+
+    def get(self, key, default=None):
+        if key == 'prev_block_hash':
+            return hash_encode(self.prev_hash)
+        elif key == 'merkle_root':
+            return hash_encode(self.merkle_hash)
+        elif key in self.__slots__:
+            value = getattr(self, key)
+            return default if value is None else value
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in ['block_height', 'auxpow']:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def as_dict(self):
+        """Return the header as a dict, for the JSON protocol boundary."""
+        d = {}
+        for key in ['version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce',
+                    'block_height', 'auxpow_offset', 'auxpow_length']:
+            if key in self:
+                d[key] = self.get(key)
+        if self.auxpow is not None:
+            d['auxpow'] = self.auxpow.as_dict()
+        return d
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class RetargetWindow(object):
+    """Ring buffer of the (height, bits, timestamp) of recent headers.
+
+    This is all the difficulty retargeting code needs to know about past
+    headers; the buffer is large enough for the 201 blocks looked at by
+    Kimoto Gravity Well."""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.heights = array.array('l', [-1] * size)
+        self.bits = array.array('I', [0] * size)
+        self.timestamps = array.array('I', [0] * size)
+
+    def push(self, header):
+        height = header.get('block_height')
+        i = height % self.size
+        self.heights[i] = height
+        self.bits[i] = header.get('bits')
+        self.timestamps[i] = header.get('timestamp')
+
+    def get(self, height):
+        if height < 0:
+            return None
+        i = height % self.size
+        if self.heights[i] != height:
+            return None
+        return {'block_height':height, 'bits':self.bits[i], 'timestamp':self.timestamps[i]}
+
+
+class HeaderStore(object):
+    """The blockchain_headers file, kept open and memory-mapped.
+
+    Headers are read as 80-byte slices of the mapping and written through
+    a single file handle.  The size of the file is tracked in memory, and
+    the mapping is only extended when a read goes past its end."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = None
+        self.mm = None
+        self.size = 0
+
+    def open(self):
+        """Open the file if it exists. Return True if it is open."""
+        with self.lock:
+            return self._open(False)
+
+    def _open(self, create):
+        if self.f is not None:
+            return True
+        if not os.path.exists(self.path):
+            if not create:
+                return False
+            open(self.path, 'wb').close()
+        self.f = open(self.path, 'rb+')
+        self.f.seek(0, os.SEEK_END)
+        self.size = self.f.tell()
+        return True
+
+    def _unmap(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def _map(self):
+        self._unmap()
+        if self.size > 0:
+            self.mm = mmap.mmap(self.f.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def close(self):
+        with self.lock:
+            self._unmap()
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+            self.size = 0
+
+    def height(self):
+        return self.size/80 - 1
+
+    def read(self, height, count=1):
+        """Return the raw data of count headers, starting at height."""
+        with self.lock:
+            if height < 0 or not self._open(False):
+                return None
+            start = height*80
+            end = min(start + count*80, self.size)
+            if end <= start:
+                return None
+            if self.mm is None or end > len(self.mm):
+                self.f.flush()
+                self._map()
+            return self.mm[start:end]
+
+    def write(self, height, data):
+        with self.lock:
+            self._open(True)
+            self.f.seek(height*80)
+            self.f.write(data)
+            self.f.flush()
+            self.size = max(self.size, height*80 + len(data))
+
+    def truncate(self, height):
+        with self.lock:
+            if not self._open(False):
+                return
+            # the mapping must not extend past the end of the file
+            self._unmap()
+            self.f.truncate(height*80)
+            self.size = min(self.size, height*80)
+
+
+class HeaderCache(object):
+    """Bounded LRU of decoded headers, keyed by height.
+    Cached headers are shared and must not be modified by callers."""
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.lock = threading.Lock()
+        self.headers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, height):
+        with self.lock:
+            header = self.headers.pop(height, None)
+            if header is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.headers[height] = header
+            return header
+
+    def put(self, height, header):
+        with self.lock:
+            self.headers.pop(height, None)
+            self.headers[height] = header
+            if len(self.headers) > self.size:
+                self.headers.popitem(last=False)
+
+    def invalidate(self, start, end=None):
+        """Forget the headers with start <= height < end (no upper bound if end is None)."""
+        with self.lock:
+            if end is not None and end - start <= len(self.headers):
+                heights = xrange(start, end)
+            else:
+                heights = [h for h in self.headers.keys() if h >= start and (end is None or h < end)]
+            for h in heights:
+                self.headers.pop(h, None)
+
+
 class Blockchain(threading.Thread):
 
     def __init__(self, config, network):
@@ -86,7 +321,11 @@ class Blockchain(threading.Thread):
         self.lock = threading.Lock()
         self.local_height = 0
         self.running = False
-        self.headers_url = 'http://electrum.pesetacoin.info/blockchain_headers'
+        self.headers_url = self.config.get('headers_url', 'http://electrum.pesetacoin.info/blockchain_headers')
+        self.store = HeaderStore(self.path())
+        self.header_cache = HeaderCache(self.config.get('header_cache_size', 4096))
+        self.checkpoints = get_checkpoints(self.config)
+        self.checkpoint_height = max(self.checkpoints) if self.checkpoints else -1
         self.set_local_height()
         self.queue = Queue.Queue()
 
@@ -160,21 +399,28 @@ class Blockchain(threading.Thread):
 
         first_header = chain[0]
         prev_header = self.read_header(first_header.get('block_height') - 1)
+        try:
+            pow_hashes = self.pow_hash_headers(chain)
+        except Exception:
+            print traceback.format_exc()
+            print 'error hashing chain at height ', first_header.get('block_height')
+            return False
+        window = self.get_retarget_window(first_header.get('block_height'))
 
-        for header in chain:
+        for header, pow_hash in zip(chain, pow_hashes):
 
             height = header.get('block_height')
 
             prev_hash = self.hash_header(prev_header)
-            bits, target = self.get_target(height, chain)
+            bits, target = self.get_target(height, chain, window)
+            window.push(header)
             _hash = self.hash_header(header)
-            pow_hash = self.pow_hash_header(header)
 
             try:
-                if height >= auxpow_start and header['version'] == 4653314:             #Pesetacoin blockchain
+                if self.is_auxpow_header(header):
                     assert auxpow.verify(_hash, auxpow.get_our_chain_id(), header['auxpow'])
-                    pow_hash = self.pow_hash_header(header['auxpow']['parent_block'])
                 assert prev_hash == header.get('prev_block_hash')
+                assert self.checkpoints.get(height, _hash) == _hash
                 assert bits == header.get('bits')
                 assert int('0x'+pow_hash,16) < target
             except Exception:
@@ -192,18 +438,21 @@ class Blockchain(threading.Thread):
 
 
 
-    def verify_chunk(self, index, hexdata):
+    def verify_chunk(self, index, hexdata, check_pow=True):
+        """Verify a chunk and save it."""
         print 'verify chunk'
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-
-        data = hexdata.decode('hex')
-        disk_data = ''
-        height = index * 2016
-        num = hex_to_int(data[0:4])
-        data = data[4:]
+        disk_data = self.check_chunk(index, hexdata, check_pow)
+        self.save_chunk(index, disk_data)
+        print_error("validated chunk %d"%index)
 
-        auxpowdata = data[num*88:]
-        auxpowbaseoffset = 0
+    def check_chunk(self, index, hexdata, check_pow=True):
+        """Verify a chunk against the headers before it, and return its
+        80-byte headers.  With check_pow=False only the prev-hash and bits
+        linkage is checked; the proof of work is then expected to have
+        been verified by check_chunk_pow.  Headers up to the last
+        checkpoint are only checked for linkage."""
+        headers, disk_data = deserialize_chunk(index, hexdata)
+        trusted = len([h for h in headers if h['block_height'] <= self.checkpoint_height])
 
         if index == 0:
             previous_hash = ("0"*64)
@@ -212,64 +461,62 @@ class Blockchain(threading.Thread):
             if prev_header is None: raise
             previous_hash = self.hash_header(prev_header)
 
-        bits, target = self.get_target(height)
+        height = index * 2016
+        window = self.get_retarget_window(height)
+        if trusted == 0:
+            bits, target = self.get_target(height, None, window)
+        else:
+            bits, target = None, None
+
+        # hash all headers at once, the fallback scrypt is much faster in batches
+        pow_hashes = [None] * trusted
+        if check_pow:
+            pow_hashes += self.pow_hash_headers(headers[trusted:])
+            failures = auxpow.verify_many(auxpow_items(headers[trusted:]))
+            if failures:
+                for height, error in failures:
+                    print_error('block %d: %s' % (height, error))
+                raise Exception('block %d: auxpow failed verification' % failures[0][0])
+        else:
+            pow_hashes += [None] * (len(headers) - trusted)
 
         chain = []
-        for i in range(num):
-            height = index * 2016 + i
-
-            raw_header = data[i*88:(i+1)*88]
-            disk_data += raw_header[0:80] # strip auxpow data
-
-            header = self.header_from_string(raw_header)
-            _hash = self.pow_hash_header(header)
+        for header, _hash in zip(headers, pow_hashes):
+            height = header['block_height']
             _prev_hash = self.hash_header(header)
-            header['block_height'] = height
-
-            if (i == 0):
-               auxpowbaseoffset = header['auxpow_offset']
 
-            start = header['auxpow_offset'] - auxpowbaseoffset
-            end = start + header['auxpow_length']
-
-            if (end > start):
-                header['auxpow'] = self.auxpow_from_string(auxpowdata[start:end].decode('hex'))
-                #print header['auxpow']
+            if height <= self.checkpoint_height:
+                try:
+                    assert previous_hash == header.get('prev_block_hash')
+                    assert self.checkpoints.get(height, _prev_hash) == _prev_hash
+                except Exception as e:
+                    print 'block ', height, ' failed validation'
+                    print previous_hash, '==', header.get('prev_block_hash')
+                    print 'checkpoint', self.checkpoints.get(height), '==', _prev_hash
+                    raise e
+                window.push(header)
+                previous_hash = _prev_hash
+                continue
 
             chain.append(header)
 
             # pesetacoin retargets: every 120 blocks
-            if (height % 120 == 0 or height >= kgw_start):
-                bits, target = self.get_target(height, chain)
-
-            #if height >= auxpow_start and header['version'] == 6422786: #TODO getAuxPowVersion()  #Dogecoin blockchain
-            if height >= auxpow_start and header['version'] == 4653314:                           #Pesetacoin blockchain
-                #todo: check that auxpow.get_chain_id(header) == auxpow.get_our_chain_id?
-                #print header['auxpow']
-                try:
-                    assert auxpow.verify(_prev_hash, auxpow.get_our_chain_id(), header['auxpow'])
-                except Exception as e:
-                    print traceback.format_exc()
-                    print 'block ', height, '(',_hash,') failed validation'
-                    print 'auxpow failed verification'
-                    pp.pprint(header['auxpow'])
-                    raise e
-                #pp.pprint(parent_header)
-                _hash = self.pow_hash_header(header['auxpow']['parent_block'])
-                #print _hash
-                # todo: verify auxpow data
-                #_hash = '' # auxpow.getHash()
+            if (height % 120 == 0 or height >= kgw_start or bits is None):
+                bits, target = self.get_target(height, chain, window)
+            window.push(header)
 
             try:
                 assert previous_hash == header.get('prev_block_hash')
                 if height >= 555000:
                     assert bits == header.get('bits')
-                    assert int('0x'+_hash,16) < target
+                    if check_pow:
+                        assert int('0x'+_hash,16) < target
             except Exception as e:
                 print 'block ', height, ' failed validation'
                 print previous_hash, '==', header.get('prev_block_hash')
                 print hex(bits), '==', hex(header.get('bits'))
-                print int('0x'+_hash,16), '<', target
+                if check_pow:
+                    print int('0x'+_hash,16), '<', target
                 raise e
 
             if height % 120 == 0:
@@ -278,8 +525,7 @@ class Blockchain(threading.Thread):
             previous_header = header
             previous_hash = _prev_hash
 
-        self.save_chunk(index, disk_data)
-        print_error("validated chunk %d"%(height / 2016))
+        return disk_data
 
     #def parent_block_to_header(self, parent_block):
         #h = {}
@@ -292,53 +538,25 @@ class Blockchain(threading.Thread):
         #return h
 
     def header_to_string(self, res):
-        #Dogecoin blockchain
-        s = int_to_hex(res.get('version'),4) \
-            + rev_hex(res.get('prev_block_hash')) \
-            + rev_hex(res.get('merkle_root')) \
-            + int_to_hex(int(res.get('timestamp')),4) \
-            + int_to_hex(int(res.get('bits')),4) \
-            + int_to_hex(int(res.get('nonce')),4)
-
-        #Pesetacoin blockchain
-        #s = int_to_hex(res.get('version'),4) \
-        #    + rev_hex(res.get('previousblockhash')) \
-        #    + rev_hex(res.get('merkleroot')) \
-        #    + int_to_hex(int(res.get('time')),4) \
-        #    + int_to_hex(int(res.get('bits')),4) \
-        #    + int_to_hex(int(res.get('nonce')),4)
-
-        return s
+        return header_to_string(res)
 
     def auxpow_from_string(self, s):
-        res = {}
-        res['coinbasetx'], s = tx_from_string(s)
-        res['coinbaseMerkleBranch'], res['coinbaseIndex'], s = merkle_branch_from_string(s)
-        res['chainMerkleBranch'], res['chainIndex'], s = merkle_branch_from_string(s)
-        res['parent_block'] = header_from_string(s)
-        return res
-
+        return auxpow_from_string(s)
 
     def header_from_string(self, s):
-        # hmmm why specify 0x at beginning if 16 is already specified??
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-        h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
-        if (len(s) > 80):
-            h['auxpow_offset'] = hex_to_int(s[80:84])
-            h['auxpow_length'] = hex_to_int(s[84:88])
-        return h
+        return header_from_string(s)
 
     def pow_hash_header(self, header):
-        return rev_hex(PoWHash(self.header_to_string(header).decode('hex')).encode('hex'))
+        return hash_encode(PoWHash(header_to_bytes(header)))
+
+    def is_auxpow_header(self, header):
+        return is_auxpow_header(header)
+
+    def pow_hash_headers(self, headers):
+        return pow_hash_headers(headers)
 
     def hash_header(self, header):
-        return rev_hex(Hash(self.header_to_string(header).decode('hex')).encode('hex'))
+        return hash_header(header)
 
     def path(self):
         return os.path.join( self.config.path, 'blockchain_headers')
@@ -365,32 +583,141 @@ class Blockchain(threading.Thread):
         os.remove(filename)
 
     def init_headers_file(self):
+        """Download the headers file if we do not have one yet.
+
+        Headers are fetched in ranges of one chunk, checked against the
+        checksum manifest published next to the file, and written to the
+        header store as they arrive, while a worker thread verifies the
+        chunks already written.  The .tmp file marks a partial download
+        and holds the number of bytes verified so far: a download that
+        was interrupted is resumed from there, and the headers after it
+        are downloaded again.  A download that fails keeps the verified
+        headers and empties the .tmp file; the next start resumes after
+        the headers then on disk, which are never overwritten."""
         filename = self.path()
-        if os.path.exists(filename):
+        offset_file = filename + '.tmp'
+        if os.path.exists(filename) and not os.path.exists(offset_file):
             return
 
+        verified = self.read_download_offset()
+        if verified is not None and self.synced_headers()*80 > verified:
+            self.truncate_headers(verified/80)
+        offset = self.synced_headers() / 2016 * 2016 * 80
+        self.write_download_offset(offset)
+        queue = Queue.Queue()
+        failed = threading.Event()
+        t = threading.Thread(target=self.verify_downloaded_chunks, args=(queue, failed))
+        t.daemon = True
+        t.start()
         try:
-            import urllib, socket
-            socket.setdefaulttimeout(30)
-            print_error('downloading ', self.headers_url )
-
-        ## Re-edition : by Alberto Hernandez - Pesetacoin Foundation 2017
-            # Original lines :
-            # urllib.urlretrieve(self.headers_url, filename + '_auxpow')
-            # self.remove_auxpow_indexes(filename + '_auxpow')
-
-            # New lines :
-            urllib.urlretrieve(self.headers_url, filename + '.tmp')
-            os.rename(filename + '.tmp', filename)
-        # End Re-edition />
-
+            print_error('downloading ', self.headers_url, 'from', offset)
+            manifest = self.get_headers_manifest()
+            self.download_headers(offset, manifest, queue, failed)
+        except Exception as e:
+            print_error('download failed:', e)
+            failed.set()
+        queue.put(None)
+        t.join()
+
+        # drop what was not verified
+        verified = self.read_download_offset()
+        if self.synced_headers()*80 > verified:
+            self.truncate_headers(verified/80)
+        if not failed.is_set():
+            os.remove(offset_file)
             print_error("done.")
-        except Exception:
-            print_error( 'download failed. creating file', filename  )
+        elif verified > offset:
+            self.write_download_offset(None)
+        else:
+            # only a download that got somewhere is resumed
+            os.remove(offset_file)
+        if not os.path.exists(filename):
             open(filename,'wb+').close()
         self.set_local_height()
         print_error("%d blocks" % self.local_height)
-        
+
+    def read_download_offset(self):
+        "Bytes of the headers file verified by an interrupted download, or None"
+        try:
+            with open(self.path() + '.tmp') as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def write_download_offset(self, offset):
+        with open(self.path() + '.tmp', 'w') as f:
+            f.write('' if offset is None else str(offset))
+
+    def verify_downloaded_chunks(self, queue, failed):
+        """Verify the chunks written by download_headers, whose indexes
+        come in order through queue, and record the verified offset.
+        The proof of work of merge-mined headers cannot be checked, the
+        headers file does not have their parent blocks."""
+        while True:
+            index = queue.get()
+            if index is None:
+                return
+            data = self.store.read(index*2016, 2016)
+            try:
+                hexdata = file_chunk(data)
+                error = check_chunk_pow(index, hexdata, self.checkpoint_height, with_auxpow=False)
+                if error:
+                    raise Exception(error)
+                self.check_chunk(index, hexdata, check_pow=False)
+            except Exception as e:
+                print_error('downloaded chunk %d failed verification:' % index, e)
+                failed.set()
+                return
+            self.write_download_offset(index*2016*80 + len(data))
+
+    def synced_headers(self):
+        "Number of headers in the header store."
+        return self.store.height() + 1 if self.store.open() else 0
+
+    def get_headers_manifest(self):
+        """Return the list of sha256 digests of the hosted headers file,
+        one per chunk, or None if the server does not publish it."""
+        import urllib2
+        try:
+            f = urllib2.urlopen(self.headers_url + '.manifest', timeout=self.config.get('headers_timeout', 30))
+            return json.loads(f.read())
+        except Exception as e:
+            print_error('no headers manifest:', e)
+            return None
+
+    def download_headers(self, offset, manifest, queue, failed):
+        """Write the headers file from offset to the header store, and
+        pass the index of each chunk written to the verifier through
+        queue.  Stops when failed is set."""
+        import urllib2, hashlib
+        chunk_size = 2016 * 80
+        req = urllib2.Request(self.headers_url)
+        if offset:
+            req.add_header('Range', 'bytes=%d-' % offset)
+        f = urllib2.urlopen(req, timeout=self.config.get('headers_timeout', 30))
+        if offset and f.getcode() != 206:
+            print_error('server does not support ranges, restarting download')
+            offset = 0
+
+        index = offset / chunk_size
+        while not failed.is_set():
+            data = f.read(chunk_size)
+            if not data:
+                break
+            if len(data) % 80:
+                raise Exception('truncated header in chunk %d' % index)
+            if manifest is not None and (index >= len(manifest) or hashlib.sha256(data).hexdigest() != manifest[index]):
+                raise Exception('checksum mismatch in chunk %d' % index)
+            # headers already synced are kept
+            skip = max(0, self.synced_headers() - index*2016)
+            if skip < len(data)/80:
+                self.store.write(index*2016 + skip, data[skip*80:])
+                self.header_cache.invalidate(index*2016 + skip, index*2016 + len(data)/80)
+                queue.put(index)
+            index += 1
+            if len(data) < chunk_size:
+                break
+
     def convbits(self, target):
         # convert it to bits
         MM = 256*256*256
@@ -408,59 +735,69 @@ class Blockchain(threading.Thread):
         return c + MM * i
 
     def save_chunk(self, index, chunk):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*2016*80)
-        h = f.write(chunk)
-        f.close()
+        self.store.write(index*2016, chunk)
+        self.header_cache.invalidate(index*2016, index*2016 + len(chunk)/80)
         self.set_local_height()
 
     def truncate_headers(self, height):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.truncate(height*80)
-        f.close()
+        self.store.truncate(height)
+        self.header_cache.invalidate(height)
         self.set_local_height()
 
     def erase_chunk(self, index):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.truncate(index*2016*80)
-        f.close()
+        self.store.truncate(index*2016)
+        self.header_cache.invalidate(index*2016)
         self.set_local_height()
 
     def save_header(self, header):
         data = self.header_to_string(header).decode('hex')
         assert len(data) == 80
         height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
+        self.store.write(height, data)
+        self.header_cache.invalidate(height, height + 1)
         self.set_local_height()
 
 
     def set_local_height(self):
-        name = self.path()
-        if os.path.exists(name):
-            h = os.path.getsize(name)/80 - 1
-            if self.local_height != h:
-                self.local_height = h
+        if self.store.open():
+            self.local_height = self.store.height()
 
 
     def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h
-
-    def get_target(self, height, chain=None):
+        h = self.header_cache.get(block_height)
+        if h is not None:
+            return h
+        h = self.store.read(block_height)
+        if h is not None and len(h) == 80:
+            h = self.header_from_string(h)
+            h['block_height'] = block_height
+            self.header_cache.put(block_height, h)
+            return h
+
+    def get_retarget_window(self, height):
+        """Return a RetargetWindow filled with the headers on disk below height."""
+        window = RetargetWindow()
+        start = max(0, height - window.size)
+        data = self.store.read(start, height - start) or ''
+        for i in range(len(data)/80):
+            header = self.header_from_string(data[i*80:(i+1)*80])
+            header['block_height'] = start + i
+            window.push(header)
+        return window
+
+    def get_retarget_header(self, height, chain, window):
+        if window is not None:
+            header = window.get(height)
+            if header is not None:
+                return header
+        header = self.read_header(height)
+        if header is None:
+            for h in chain:
+                if h.get('block_height') == height:
+                    header = h
+        return header
+
+    def get_target(self, height, chain=None, window=None):
         if chain is None:
             chain = []  # Do not use mutables as default values!
 
@@ -468,9 +805,9 @@ class Blockchain(threading.Thread):
         if height < 120:
             return 0x1e0ffff0, max_target
         elif height >= dgw_start:
-            return self.get_target_dgw(height, chain);
+            return self.get_target_dgw(height, chain, window);
         elif height >= kgw_start:
-            return self.KimotoGravityWell(height, chain, None); #
+            return self.KimotoGravityWell(height, chain, None, window); #
 
         # https://github.com/FundacionPesetacoin/Pesetacoin-0.9.1-Oficial/blob/9df921d230d3a45c0587e084568beea9f75033d2/src/main.cpp#L1285
         nTargetTimespan     = 2*60*60       #pesetacoin: every 4 hours
@@ -492,24 +829,14 @@ class Blockchain(threading.Thread):
         #print 'first height', first_height
         #print 'last height', last_height
 
-        first = self.read_header(first_height)
-        last  = self.read_header(last_height)
+        first = self.get_retarget_header(first_height, chain, window)
+        last  = self.get_retarget_header(last_height, chain, window)
 
         #print 'first'
         #print first
         #print 'last'
         #print last
 
-        if first is None:
-            for h in chain:
-                if h.get('block_height') == first_height:
-                    first = h
-
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == last_height:
-                    last = h
-
         nActualTimespan    = last.get('timestamp') - first.get('timestamp')
         nModulatedTimespan = nActualTimespan
 
@@ -575,6 +902,16 @@ class Blockchain(threading.Thread):
             result = r['result']
             return result
 
+    def retrieve_chunk(self, queue):
+        while True:
+            try:
+                ir = queue.get(timeout=300)
+            except Queue.Empty:
+                print_error('blockchain: request timeout')
+                continue
+            i, r = ir
+            return r['params'][0], r['result']
+
     def get_chain(self, interface, final_header):
 
         header = final_header
@@ -614,6 +951,10 @@ class Blockchain(threading.Thread):
 
     def get_and_verify_chunks(self, i, header, height):
 
+        workers = int(self.config.get('verify_workers', 0))
+        if workers > 0:
+            return self.get_and_verify_chunks_pipelined(i, height, workers)
+
         queue = Queue.Queue()
         min_index = (self.local_height + 1)/2016
         max_index = (height + 1)/2016
@@ -641,15 +982,60 @@ class Blockchain(threading.Thread):
                     return False
 
         return True
-    def get_target_dgw(self, block_height, chain=None):
+
+    def get_and_verify_chunks_pipelined(self, i, height, workers):
+        """Prefetch several chunks ahead and check their proof of work in a
+        pool of worker processes.  Chunks are then linked and saved in
+        order by verify_chunk(check_pow=False)."""
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        window = 2 * workers
+        min_index = (self.local_height + 1)/2016
+        max_index = (height + 1)/2016
+        n = min_index
+        try:
+            while n < max_index + 1:
+                # a fresh queue, so that answers to a discarded pipeline are ignored
+                queue = Queue.Queue()
+                pending = {}
+                requested = n
+                while n < max_index + 1:
+                    while requested < min(n + window, max_index + 1):
+                        print_error( "Requesting chunk:", requested )
+                        i.send_request({'method':'blockchain.block.get_chunk', 'params':[requested]}, queue)
+                        requested += 1
+
+                    while n not in pending or not queue.empty():
+                        index, r = self.retrieve_chunk(queue)
+                        hexdata = zlib.decompress(r.decode('hex'))
+                        pending[index] = hexdata, pool.apply_async(check_chunk_pow, (index, hexdata, self.checkpoint_height))
+
+                    hexdata, result = pending.pop(n)
+                    try:
+                        error = result.get()
+                        if error:
+                            raise Exception(error)
+                        self.verify_chunk(n, hexdata, check_pow=False)
+                    except Exception as e:
+                        print_error(str(e))
+                        print_error('Verify chunk failed!')
+                        self.erase_chunk(n)
+                        n = n - 1
+                        if n < 0:
+                            return False
+                        break
+                    n = n + 1
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return True
+
+    def get_target_dgw(self, block_height, chain=None, window=None):
         if chain is None:
             chain = []
 
-        last = self.read_header(block_height-1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == block_height-1:
-                    last = h
+        last = self.get_retarget_header(block_height-1, chain, window)
         # params
         BlockLastSolved = last
         BlockReading = last
@@ -681,11 +1067,7 @@ class Blockchain(threading.Thread):
                 nActualTimespan += Diff
             LastBlockTime = BlockReading.get('timestamp')
 
-            BlockReading = self.read_header((block_height-1) - CountBlocks)
-            if BlockReading is None:
-                for br in chain:
-                    if br.get('block_height') == (block_height-1) - CountBlocks:
-                        BlockReading = br
+            BlockReading = self.get_retarget_header((block_height-1) - CountBlocks, chain, window)
 
         bnNew = PastDifficultyAverage
         nTargetTimespan = CountBlocks * target_spacing
@@ -702,7 +1084,7 @@ class Blockchain(threading.Thread):
         new_bits = target_to_bits(bnNew)
         return new_bits, bnNew
         
-    def KimotoGravityWell(self, height, chain=[],data=None):    
+    def KimotoGravityWell(self, height, chain=[],data=None, window=None):
         #print_msg ("height=",height,"chain=", chain, "data=", data)
         BlocksTargetSpacing         = 1 * 60; # 1 minute
         TimeDaySeconds              = 60 * 60 * 24;
@@ -718,11 +1100,7 @@ class Blockchain(threading.Thread):
         bnProofOfWorkLimit          = 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
         LatestBlockTime             = 0
 
-        last = self.read_header(BlockLastSolvedIndex)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == BlockLastSolvedIndex:
-                    last = h
+        last = self.get_retarget_header(BlockLastSolvedIndex, chain, window)
 
         if (BlockLastSolvedIndex <= 0 or BlockLastSolvedIndex < PastBlocksMin or last is None):
             new_target = bnProofOfWorkLimit
@@ -736,11 +1114,7 @@ class Blockchain(threading.Thread):
                 break
             PastBlocksMass = PastBlocksMass + 1
 
-            reading = self.read_header(BlockReadingIndex)
-            if reading is None:
-                for h in chain:
-                    if h.get('block_height') == BlockReadingIndex:
-                        reading = h
+            reading = self.get_retarget_header(BlockReadingIndex, chain, window)
 
             if (i == 1):
                 PastDifficultyAverage=self.convbignum(reading.get('bits'))
@@ -796,69 +1170,138 @@ class Blockchain(threading.Thread):
 
 # START electrum-peseta-server
 # the following code was copied from the server's utils.py file
-def tx_from_string(s):
-    vds = BCDataStream()
-    vds.write(s)
-    #vds.write(raw.decode('hex'))
-    d = {}
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    d['vin'] = []
-    for i in xrange(n_vin):
-        txin = {}
-        # dirty hack: add outpoint structure to get correct txid later
-        outpoint_pos = vds.read_cursor
-        txin['coinbase'] = vds.read_bytes(vds.read_compact_size()).encode('hex')
-        txin['sequence'] = vds.read_uint32()
-        d['vin'].append(txin)
-    n_vout = vds.read_compact_size()
-    d['vout'] = []
-    for i in xrange(n_vout):
-        txout = {}
-        txout['value'] = vds.read_int64()
-        txout['scriptPubKey'] = vds.read_bytes(vds.read_compact_size()).encode('hex')
-        d['vout'].append(txout)
-    d['lockTime'] = vds.read_uint32()
-
-    # compute txid
-    # dirty hack to insert coinbase outpoint structure before hashing
-    raw = s[0:outpoint_pos]
-    COINBASE_OP = '0' * 64 + 'F' * 8
-    raw += (COINBASE_OP).decode('hex')
-    raw += s[outpoint_pos:vds.read_cursor]
-
-    d['txid'] = Hash(raw)[::-1].encode('hex')
-
-    return d, s[vds.read_cursor:] # +1?
-
-def merkle_branch_from_string(s):
-    vds = BCDataStream()
-    vds.write(s)
-    #vds.write(raw.decode('hex'))
-    hashes = []
-    n_hashes = vds.read_compact_size()
-    for i in xrange(n_hashes):
-        _hash = vds.read_bytes(32)
-        hashes.append(hash_encode(_hash))
-    index = vds.read_int32()
-    return hashes, index, s[vds.read_cursor:]
-
 def hex_to_int(s):
     return int('0x' + s[::-1].encode('hex'), 16)
 
 
 def header_from_string(s):
-    res = {
-        'version': hex_to_int(s[0:4]),
-        'prev_block_hash': hash_encode(s[4:36]),
-        'merkle_root': hash_encode(s[36:68]),
-        'timestamp': hex_to_int(s[68:72]),
-        'bits': hex_to_int(s[72:76]),
-        'nonce': hex_to_int(s[76:80]),
-    }
-
-    if (len(s) > 80):
-        res['auxpow_offset'] = hex_to_int(s[80:84])
-        res['auxpow_length'] = hex_to_int(s[84:88])
-
-    return res
+    return BlockHeader(s)
+
+
+def header_to_string(res):
+    if isinstance(res, BlockHeader):
+        return res.raw.encode('hex')
+
+    #Dogecoin blockchain
+    s = int_to_hex(res.get('version'),4) \
+        + rev_hex(res.get('prev_block_hash')) \
+        + rev_hex(res.get('merkle_root')) \
+        + int_to_hex(int(res.get('timestamp')),4) \
+        + int_to_hex(int(res.get('bits')),4) \
+        + int_to_hex(int(res.get('nonce')),4)
+
+    #Pesetacoin blockchain
+    #s = int_to_hex(res.get('version'),4) \
+    #    + rev_hex(res.get('previousblockhash')) \
+    #    + rev_hex(res.get('merkleroot')) \
+    #    + int_to_hex(int(res.get('time')),4) \
+    #    + int_to_hex(int(res.get('bits')),4) \
+    #    + int_to_hex(int(res.get('nonce')),4)
+
+    return s
+
+def auxpow_from_string(s):
+    return auxpow.AuxPow(s)
+
+def header_to_bytes(header):
+    if isinstance(header, BlockHeader):
+        return header.raw
+    return header_to_string(header).decode('hex')
+
+def hash_header(header):
+    return hash_encode(Hash(header_to_bytes(header)))
+
+def is_auxpow_header(header):
+    #if height >= auxpow_start and header['version'] == 6422786: #TODO getAuxPowVersion()  #Dogecoin blockchain
+    return header.get('block_height') >= auxpow_start and header['version'] == 4653314   #Pesetacoin blockchain
+
+def pow_hash_headers(headers):
+    """Return the proof-of-work hashes of a list of headers.
+    For merge-mined headers this is the hash of the auxpow parent block."""
+    data = []
+    for header in headers:
+        if is_auxpow_header(header) and header.get('auxpow'):
+            data.append(auxpow_parent_block(header['auxpow']))
+        else:
+            data.append(header_to_bytes(header))
+    return [hash_encode(h) for h in PoWHashBatch(data)]
+
+def auxpow_parent_block(aux):
+    """Return the 80-byte parent block header of an auxpow, either an
+    AuxPow or the dict sent by the server, whose parent_block is a
+    header dict."""
+    if isinstance(aux, auxpow.AuxPow):
+        return aux.parent_block
+    parent_block = aux['parent_block']
+    if isinstance(parent_block, dict):
+        return header_to_bytes(parent_block)
+    return parent_block.decode('hex')
+
+def auxpow_items(headers):
+    """Return the arguments of auxpow.verify_many for the merge-mined
+    headers of a list."""
+    return [(header['block_height'], Hash(header_to_bytes(header)), header.get('auxpow'))
+            for header in headers if is_auxpow_header(header)]
+
+def deserialize_chunk(index, hexdata):
+    """Parse a chunk as served by blockchain.block.get_chunk.
+    Returns the list of headers, with their auxpow, and the 80-byte
+    headers to be written to disk."""
+    data = hexdata.decode('hex')
+    num = hex_to_int(data[0:4])
+    data = data[4:]
+
+    auxpowdata = data[num*88:]
+    auxpowbaseoffset = 0
+
+    headers = []
+    disk_data = []
+    for i in range(num):
+        raw_header = data[i*88:(i+1)*88]
+        disk_data.append(raw_header[0:80]) # strip auxpow data
+
+        header = header_from_string(raw_header)
+        header['block_height'] = index * 2016 + i
+
+        if (i == 0):
+           auxpowbaseoffset = header['auxpow_offset']
+
+        start = header['auxpow_offset'] - auxpowbaseoffset
+        end = start + header['auxpow_length']
+
+        if (end > start):
+            header['auxpow'] = auxpow_from_string(auxpowdata[start:end].decode('hex'))
+
+        headers.append(header)
+
+    return headers, ''.join(disk_data)
+
+def file_chunk(data):
+    """Turn 80-byte headers, as in the headers file, into a chunk as
+    served by blockchain.block.get_chunk, without auxpow data."""
+    num = len(data)/80
+    records = [data[i*80:(i+1)*80] + struct.pack('<II', 0, 0) for i in range(num)]
+    return (struct.pack('<I', num) + ''.join(records)).encode('hex')
+
+def check_chunk_pow(index, hexdata, checkpoint_height=-1, with_auxpow=True):
+    """Check auxpow and proof of work of every header in a chunk against
+    the bits found in the header itself.  Bits linkage is left to
+    Blockchain.verify_chunk, and headers up to checkpoint_height are
+    skipped, as are merge-mined headers if the chunk comes without their
+    auxpow.  This runs in a worker process: it returns None on success,
+    or an error message."""
+    try:
+        headers, _ = deserialize_chunk(index, hexdata)
+        headers = [h for h in headers if h['block_height'] > checkpoint_height]
+        if not with_auxpow:
+            headers = [h for h in headers if not is_auxpow_header(h)]
+        failures = auxpow.verify_many(auxpow_items(headers))
+        if failures:
+            return 'block %d: %s' % failures[0]
+        pow_hashes = pow_hash_headers(headers)
+        for header, _hash in zip(headers, pow_hashes):
+            height = header['block_height']
+            if height >= 555000 and int('0x'+_hash,16) >= bits_to_target(header['bits']):
+                return 'block %d: insufficient proof of work' % height
+    except Exception:
+        return traceback.format_exc()
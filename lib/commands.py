@@ -52,6 +52,7 @@ def register_command(*args):
 payto_options = ' --fee, -f: set transaction fee\n --fromaddr, -F: send from address -\n --changeaddr, -c: send change to address'
 listaddr_options = " -a: show all addresses, including change addresses\n -l: include labels in results"
 restore_options = " accepts a seed or master public key."
+history_syntax = 'history [offset] [limit] [since_height]\nA negative offset counts from the most recent transaction.'
 mksendmany_syntax = 'mksendmanytx <recipient> <amount> [<recipient> <amount> ...]'
 payto_syntax = "payto <recipient> <amount> [label]\n<recipient> can be a pesetacoin address or a label"
 paytomany_syntax = "paytomany <recipient> <amount> [<recipient> <amount> ...]\n<recipient> can be a pesetaion address or a label"
@@ -82,7 +83,7 @@ register_command('getrawtransaction',    1, 1, True,  False, False, 'Retrieve a
 register_command('getseed',              0, 0, False, True,  True,  'Print the generation seed of your wallet.')
 register_command('getmpk',               0, 0, False, True,  False, 'Return your wallet\'s master public key', 'getmpk')
 register_command('help',                 0, 1, False, False, False, 'Prints this help')
-register_command('history',              0, 0, True,  True,  False, 'Returns the transaction history of your wallet')
+register_command('history',              0, 3, True,  True,  False, 'Returns the transaction history of your wallet', history_syntax)
 register_command('importprivkey',        1, 1, False, True,  True,  'Import a private key', 'importprivkey <privatekey>')
 register_command('listaddresses',        2, 2, False, True,  False, 'Returns your list of addresses.', '', listaddr_options)
 register_command('listunspent',          0, 0, True,  True,  False, 'Returns the list of unspent inputs in your wallet.')
@@ -326,10 +327,9 @@ class Commands:
         r, h = self.wallet.sendtx( tx )
         return h
 
-    def history(self):
-        balance = 0
+    def history(self, offset=0, limit=None, since_height=None):
         out = []
-        for item in self.wallet.get_tx_history():
+        for item in self.wallet.get_tx_history(None, offset, limit, since_height):
             tx_hash, conf, is_mine, value, fee, balance, timestamp = item
             try:
                 time_str = datetime.datetime.fromtimestamp( timestamp).isoformat(' ')[:-3]
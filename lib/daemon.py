@@ -26,7 +26,8 @@ import json
 import Queue
 
 import util
-from network import Network
+from network import new_network
+from event_loop import LoopQueue
 from util import print_error, print_stderr, parse_json
 from simple_config import SimpleConfig
 
@@ -68,6 +69,7 @@ class ClientThread(threading.Thread):
         self.server = server
         self.daemon = True
         self.client_pipe = util.SocketPipe(s)
+        self.client_pipe.set_timeout(None)
         self.response_queue = Queue.Queue()
         self.server.add_client(self)
 
@@ -84,19 +86,25 @@ class ClientThread(threading.Thread):
                 self.server.stop()
                 continue
             self.server.send_request(self, request)
+        # wake up the writing thread
+        self.response_queue.put(None)
 
     def run(self):
         self.running = True
         threading.Thread(target=self.reading_thread).start()
         while self.running:
-            try:
-                response = self.response_queue.get(timeout=0.1)
-            except Queue.Empty:
-                continue
+            response = self.response_queue.get()
+            if response is None:
+                break
             try:
                 self.client_pipe.send(response)
             except socket.error:
                 self.running = False
+                # wake up the reading thread
+                try:
+                    self.client_pipe.socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
                 break
         self.server.remove_client(self)
 
@@ -111,7 +119,7 @@ class NetworkServer(threading.Thread):
         self.daemon = True
         self.debug = False
         self.config = config
-        self.network = Network(config)
+        self.network = new_network(config)
         # network sends responses on that queue
         self.network_queue = Queue.Queue()
 
@@ -130,6 +138,7 @@ class NetworkServer(threading.Thread):
     def stop(self):
         with self.lock:
             self.running = False
+        self.network_queue.put(None)
 
     def start(self):
         self.running = True
@@ -162,26 +171,167 @@ class NetworkServer(threading.Thread):
     def run(self):
         self.network.start(self.network_queue)
         while self.is_running():
+            response = self.network_queue.get()
+            if response is None:
+                break
+            self.process_response(response)
+
+        self.network.stop()
+        print_error("server exiting")
+
+    def process_response(self, response):
+        if self.debug:
+            print_error("<--", response)
+        response_id = response.get('id')
+        if response_id:
+            with self.lock:
+                client_id, client = self.requests.pop(response_id)
+            response['id'] = client_id
+            client.response_queue.put(response)
+        else:
+            # notification
+            for client in self.clients:
+                client.response_queue.put(response)
+
+    def serve(self, s, daemon_timeout):
+        s.settimeout(1)
+        t = time.time()
+        while self.running:
             try:
-                response = self.network_queue.get(timeout=0.1)
-            except Queue.Empty:
+                connection, address = s.accept()
+            except socket.timeout:
+                if not self.clients:
+                    if time.time() - t > daemon_timeout:
+                        print_error("Daemon timeout")
+                        break
+                else:
+                    t = time.time()
                 continue
-            if self.debug:
-                print_error("<--", response)
-            response_id = response.get('id')
-            if response_id:
-                with self.lock:
-                    client_id, client = self.requests.pop(response_id)
-                response['id'] = client_id
-                client.response_queue.put(response)
-            else:
-                # notification
-                for client in self.clients:
-                    client.response_queue.put(response)
+            t = time.time()
+            client = ClientThread(self, connection)
+            client.start()
+
+
+
+class LoopClient:
+    """Client of a LoopNetworkServer, read and written on the event loop.
+    The socket is non-blocking, responses are written as it takes them."""
+
+    def __init__(self, server, s):
+        self.server = server
+        self.s = s
+        self.client_pipe = util.SocketPipe(s)
+        self.client_pipe.set_timeout(0)
+        self.response_queue = LoopQueue(server.loop, self.send_responses)
+        server.loop.add_reader(s, self.on_readable)
+        self.server.add_client(self)
 
+    def on_readable(self):
+        try:
+            requests = self.client_pipe.get_all()
+        except util.timeout:
+            return
+        if requests is None:
+            self.close()
+            return
+        for request in requests:
+            if request.get('method') == 'daemon.stop':
+                self.server.stop()
+                continue
+            self.server.send_request(self, request)
+
+    def send_responses(self, responses):
+        if not self.s:
+            return
+        self.client_pipe.queue_all(responses)
+        self.flush()
+
+    def flush(self):
+        if not self.s:
+            return
+        try:
+            done = self.client_pipe.flush()
+        except socket.error:
+            self.close()
+            return
+        if done:
+            self.server.loop.remove_writer(self.s)
+        else:
+            self.server.loop.add_writer(self.s, self.flush)
+
+    def close(self):
+        if not self.s:
+            return
+        self.server.loop.remove_reader(self.s)
+        self.server.loop.remove_writer(self.s)
+        self.s.close()
+        self.s = None
+        self.server.remove_client(self)
+
+
+
+class LoopNetworkServer(NetworkServer):
+    """NetworkServer for the 'loop' network engine.  The clients, the
+    servers and the responses are all handled on the event loop of the
+    network, which runs in the thread that calls serve."""
+
+    def __init__(self, config):
+        NetworkServer.__init__(self, config)
+        self.loop = self.network.loop
+        self.network_queue = LoopQueue(self.loop, self.process_responses)
+        self.last_client = time.time()
+
+    def start(self):
+        self.running = True
+        self.network.prepare(self.network_queue)
+
+    def stop(self):
+        with self.lock:
+            self.running = False
         self.network.stop()
+
+    def remove_client(self, client):
+        NetworkServer.remove_client(self, client)
+        self.last_client = time.time()
+
+    def process_responses(self, responses):
+        for response in responses:
+            self.process_response(response)
+
+    def serve(self, s, daemon_timeout):
+        self.listener = s
+        self.daemon_timeout = daemon_timeout
+        self.loop.add_reader(s, self.accept)
+        self.loop.call_later(daemon_timeout, self.check_timeout)
+        self.network.run()
+        s.close()
+        for client in self.clients[:]:
+            client.close()
         print_error("server exiting")
 
+    def accept(self):
+        try:
+            connection, address = self.listener.accept()
+        except socket.error:
+            return
+        LoopClient(self, connection)
+
+    def check_timeout(self):
+        if self.clients:
+            delay = self.daemon_timeout
+        else:
+            delay = self.last_client + self.daemon_timeout - time.time()
+            if delay <= 0:
+                print_error("Daemon timeout")
+                self.stop()
+                return
+        self.loop.call_later(delay, self.check_timeout)
+
+
+def new_server(config):
+    if config.get('network_engine', 'threads') == 'loop':
+        return LoopNetworkServer(config)
+    return NetworkServer(config)
 
 
 def daemon_loop(server):
@@ -191,22 +341,7 @@ def daemon_loop(server):
     daemon_timeout = server.config.get('daemon_timeout', 5*60)
     s.bind(('', daemon_port))
     s.listen(5)
-    s.settimeout(1)
-    t = time.time()
-    while server.running:
-        try:
-            connection, address = s.accept()
-        except socket.timeout:
-            if not server.clients:
-                if time.time() - t > daemon_timeout:
-                    print_error("Daemon timeout")
-                    break
-            else:
-                t = time.time()
-            continue
-        t = time.time()
-        client = ClientThread(server, connection)
-        client.start()
+    server.serve(s, daemon_timeout)
     server.stop()
     # sleep so that other threads can terminate cleanly
     time.sleep(0.5)
@@ -217,7 +352,7 @@ if __name__ == '__main__':
     import simple_config, util
     config = simple_config.SimpleConfig()
     util.set_verbosity(True)
-    server = NetworkServer(config)
+    server = new_server(config)
     server.start()
     try:
         daemon_loop(server)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2014 Thomas Voegtlin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import heapq
+import select
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from util import print_error
+
+
+def wakeup_pair():
+    "Two connected sockets, used to interrupt select from another thread."
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    # windows
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    a.connect(server.getsockname())
+    b, address = server.accept()
+    server.close()
+    return a, b
+
+
+class EventLoop:
+    """Runs callbacks on a single thread: when a socket is readable or
+    writable, when a timer expires, or when another thread asks for it
+    with call_soon.  The thread sleeps in select until one of those
+    happens."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.readers = {}       # fileno -> socket, callback
+        self.writers = {}       # fileno -> socket, callback
+        self.timers = []        # heap of time, sequence number, callback, args
+        self.timer_id = 0
+        self.ready = deque()    # callback, args
+        self.wakeup_r, self.wakeup_w = wakeup_pair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.woken = False
+
+    def add_reader(self, s, callback):
+        self.readers[s.fileno()] = s, callback
+
+    def remove_reader(self, s):
+        for fd, (sock, callback) in self.readers.items():
+            if sock is s:
+                self.readers.pop(fd)
+
+    def add_writer(self, s, callback):
+        self.writers[s.fileno()] = s, callback
+
+    def remove_writer(self, s):
+        for fd, (sock, callback) in self.writers.items():
+            if sock is s:
+                self.writers.pop(fd)
+
+    def call_soon(self, callback, *args):
+        "Thread safe."
+        with self.lock:
+            self.ready.append((callback, args))
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            self.wakeup_w.send('\0')
+        except socket.error:
+            pass
+
+    def call_later(self, delay, callback, *args):
+        "Call from the thread of the loop."
+        self.timer_id += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_id, callback, args))
+
+    def in_loop(self):
+        return self.thread is threading.current_thread()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+        self.call_soon(lambda: None)
+
+    def is_running(self):
+        with self.lock:
+            return self.running
+
+    def run(self):
+        with self.lock:
+            self.running = True
+        self.thread = threading.current_thread()
+        while self.is_running():
+            self.run_ready()
+            if self.timers:
+                delay = max(0, self.timers[0][0] - time.time())
+            else:
+                delay = None
+            self.select(delay)
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                t, _, callback, args = heapq.heappop(self.timers)
+                self.run_callback(callback, args)
+        self.thread = None
+
+    def select(self, delay):
+        fds = [self.wakeup_r] + [s for s, callback in self.readers.values()]
+        wfds = [s for s, callback in self.writers.values()]
+        try:
+            readable, writable, _ = select.select(fds, wfds, [], delay)
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return
+            raise
+        for s in readable:
+            if s is self.wakeup_r:
+                self.drain_wakeup()
+                continue
+            self.dispatch(self.readers, s)
+        for s in writable:
+            self.dispatch(self.writers, s)
+
+    def dispatch(self, callbacks, s):
+        # a callback may have removed or closed the socket
+        for fd, (sock, callback) in callbacks.items():
+            if sock is s:
+                self.run_callback(callback, ())
+                return
+
+    def drain_wakeup(self):
+        with self.lock:
+            self.woken = False
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def run_ready(self):
+        with self.lock:
+            ready, self.ready = self.ready, deque()
+        for callback, args in ready:
+            self.run_callback(callback, args)
+
+    def run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            print_error("event loop: error in", callback)
+            traceback.print_exc(file=sys.stderr)
+
+
+class LoopQueue:
+    """Queue whose items are handed to a callback on the thread of the loop.
+    Items put before the loop gets to them are passed together, as a list,
+    so that they can be processed as a batch."""
+
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.items = []
+
+    def put(self, item):
+        with self.lock:
+            self.items.append(item)
+            if len(self.items) > 1:
+                return
+        self.loop.call_soon(self.flush)
+
+    def flush(self):
+        with self.lock:
+            items, self.items = self.items, []
+        if items:
+            self.callback(items)
@@ -19,6 +19,7 @@
 
 import random, ast, re, errno, os
 import threading, traceback, sys, time, json, Queue
+from collections import deque
 import socks
 import socket
 import ssl
@@ -40,10 +41,12 @@ import util
 
 
 
-def Interface(server, config = None):
+def Interface(server, config = None, loop = None):
     host, port, protocol = server.split(':')
     port = int(port)
-    if protocol in 'st':
+    if protocol in 'st' and loop:
+        return LoopInterface(server, config, loop)
+    elif protocol in 'st':
         return TcpInterface(server, config)
     elif protocol in 'hg':
         return HttpInterface(server, config)
@@ -60,7 +63,12 @@ class TcpInterface(threading.Thread):
         self.is_connected = False
         self.debug = False # dump network messages. can be changed at runtime using the console
         self.message_id = 0
-        self.unanswered_requests = {}
+        self.unanswered_requests = {}   # message id -> method, params, id, queue, time sent
+        self.pending_requests = deque() # (request, queue) waiting for room in the window
+        # window of unanswered requests and resend timeout, both off by default
+        self.max_inflight = self.config.get('max_inflight_requests', 0)
+        self.request_timeout = self.config.get('request_timeout', 0)
+        self.timeout_check = 0
         # are we waiting for a pong?
         self.is_ping = False
         # parse server
@@ -89,7 +97,12 @@ class TcpInterface(threading.Thread):
 
         if msg_id is not None:
             with self.lock:
-                method, params, _id, queue = self.unanswered_requests.pop(msg_id)
+                item = self.unanswered_requests.pop(msg_id, None)
+                self.flush_requests()
+            if item is None:
+                print_error("answer to an expired request", self.server, msg_id)
+                return
+            method, params, _id, queue, t = item
             if queue is None:
                 queue = self.response_queue
         else:
@@ -255,21 +268,81 @@ class TcpInterface(threading.Thread):
 
 
     def send_request(self, request, queue=None):
-        _id = request.get('id')
-        method = request.get('method')
-        params = request.get('params')
+        self.send_requests([request], queue)
+
+    def send_requests(self, requests, queue=None):
+        """Send requests to the server in a single write.  At most
+        max_inflight_requests are left unanswered, the other requests are
+        sent as answers come in."""
         with self.lock:
-            try:
-                r = {'id':self.message_id, 'method':method, 'params':params}
-                self.pipe.send(r)
-                if self.debug:
+            self.pending_requests.extend((request, queue) for request in requests)
+            self.flush_requests()
+
+    def flush_requests(self):
+        "Send the pending requests that fit in the window. Call with the lock held."
+        items = []
+        while self.pending_requests:
+            if self.max_inflight and len(self.unanswered_requests) + len(items) >= self.max_inflight:
+                break
+            items.append(self.pending_requests.popleft())
+        if not items:
+            return
+        out = [self.make_request(request) for request, queue in items]
+        if self.write_requests(out):
+            for r, (request, queue) in zip(out, items):
+                self.register_request(r, request, queue)
+        else:
+            # sent again if the connection is still used
+            self.pending_requests.extendleft(reversed(items))
+
+    def make_request(self, request):
+        r = {'id':self.message_id, 'method':request.get('method'), 'params':request.get('params')}
+        self.message_id += 1
+        return r
+
+    def register_request(self, r, request, queue):
+        self.unanswered_requests[r['id']] = r['method'], r['params'], request.get('id'), queue, time.time()
+
+    def write_requests(self, out):
+        "Returns True if the requests were sent."
+        try:
+            self.pipe.send_all(out)
+            if self.debug:
+                for r in out:
                     print_error("-->", r)
-            except socket.error, e:
-                print_error("socked error:", self.server, e)
-                self.is_connected = False
-                return
-            self.unanswered_requests[self.message_id] = method, params, _id, queue
-            self.message_id += 1
+            return True
+        except socket.error, e:
+            print_error("socked error:", self.server, e)
+            self.is_connected = False
+            return False
+
+    def send_ping(self):
+        # not held back by the window, the server has to answer in time
+        with self.lock:
+            request = {'method':'server.version', 'params':[ELECTRUM_VERSION, PROTOCOL_VERSION]}
+            r = self.make_request(request)
+            if self.write_requests([r]):
+                self.register_request(r, request, None)
+
+    def check_timeouts(self):
+        """Send again the requests that have been waiting for more than
+        request_timeout seconds.  They go first in the window, and a late
+        answer to the first send is dropped."""
+        now = time.time()
+        if not self.request_timeout or now - self.timeout_check < 1:
+            return
+        self.timeout_check = now
+        expired = []
+        with self.lock:
+            for msg_id, item in self.unanswered_requests.items():
+                method, params, _id, queue, t = item
+                # unanswered pings are handled by run
+                if now - t > self.request_timeout and method != 'server.version':
+                    expired.append(self.unanswered_requests.pop(msg_id))
+            for method, params, _id, queue, t in sorted(expired, key=lambda item: item[4], reverse=True):
+                print_error("request timeout, sending again", self.server, method, params)
+                self.pending_requests.appendleft(({'method':method, 'params':params, 'id':_id}, queue))
+            self.flush_requests()
 
     def parse_proxy_options(self, s):
         if type(s) == type({}): return s  # fixme: type should be fixed
@@ -303,7 +376,7 @@ class TcpInterface(threading.Thread):
     def run(self):
         self.s = self.get_socket()
         if self.s:
-            self.s.settimeout(60)
+            self.s.settimeout(min(60, self.request_timeout) if self.request_timeout else 60)
             self.is_connected = True
             print_error("connected to", self.host, self.port)
             self.pipe = util.SocketPipe(self.s)
@@ -321,9 +394,10 @@ class TcpInterface(threading.Thread):
                     self.is_connected = False
                     break
                 else:
-                    self.send_request({'method':'server.version', 'params':[ELECTRUM_VERSION, PROTOCOL_VERSION]})
+                    self.send_ping()
                     self.is_ping = True
                     t = time.time()
+            self.check_timeouts()
             try:
                 response = self.pipe.get()
             except util.timeout:
@@ -342,6 +416,122 @@ class TcpInterface(threading.Thread):
 
 
 
+class LoopInterface(TcpInterface):
+    """TcpInterface that reads from its socket on an EventLoop instead of
+    a thread of its own.  Only the connection, which blocks on dns and on
+    the ssl handshake, is made in a short lived thread.  The socket is
+    non-blocking: requests are queued and written when it is writable."""
+
+    def __init__(self, server, config, loop):
+        TcpInterface.__init__(self, server, config)
+        self.loop = loop
+        self.s = None
+
+    def start(self, response_queue):
+        self.response_queue = response_queue
+        t = threading.Thread(target=self.connect)
+        t.daemon = True
+        t.start()
+
+    def connect(self):
+        self.loop.call_soon(self.on_connect, self.get_socket())
+
+    def on_connect(self, s):
+        if s and not self.loop.is_running():
+            s.close()
+            return
+        if s:
+            self.s = s
+            self.pipe = util.SocketPipe(self.s)
+            self.pipe.set_timeout(0)
+            self.is_connected = True
+            print_error("connected to", self.host, self.port)
+            self.loop.add_reader(self.s, self.on_readable)
+            self.ping()
+            if self.request_timeout:
+                self.loop.call_later(1, self.timeout_timer)
+        self.change_status()
+
+    def on_readable(self):
+        try:
+            responses = self.pipe.get_all()
+        except util.timeout:
+            return
+        if responses is None:
+            self.close()
+            return
+        for response in responses:
+            self.process_response(response)
+
+    def write_requests(self, out):
+        if not self.is_connected:
+            return False
+        self.pipe.queue_all(out)
+        if self.debug:
+            for r in out:
+                print_error("-->", r)
+        if self.loop.in_loop():
+            self.flush()
+        else:
+            self.loop.call_soon(self.flush)
+        return True
+
+    def flush(self):
+        "Call from the thread of the loop."
+        if not self.s:
+            return
+        try:
+            done = self.pipe.flush()
+        except socket.error, e:
+            print_error("socked error:", self.server, e)
+            self.close()
+            return
+        if done:
+            self.loop.remove_writer(self.s)
+        else:
+            self.loop.add_writer(self.s, self.flush)
+
+    def ping(self):
+        if not self.s:
+            return
+        if self.is_ping:
+            print_error("ping timeout", self.server)
+            self.close()
+            return
+        self.send_ping()
+        self.is_ping = True
+        self.loop.call_later(60, self.ping)
+
+    def timeout_timer(self):
+        if not self.s:
+            return
+        self.check_timeouts()
+        self.loop.call_later(1, self.timeout_timer)
+
+    def close(self):
+        "Call from the thread of the loop."
+        if not self.s:
+            return
+        self.loop.remove_reader(self.s)
+        self.loop.remove_writer(self.s)
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.s.close()
+        self.s = None
+        self.is_connected = False
+        self.change_status()
+        print_error("closing connection:", self.server)
+
+    def stop(self):
+        if self.loop.in_loop() or not self.loop.is_running():
+            self.close()
+        else:
+            self.loop.call_soon(self.close)
+
+
+
 class HttpInterface(TcpInterface):
 
     def run(self):
@@ -352,6 +542,10 @@ class HttpInterface(TcpInterface):
             self.run_http()
         self.change_status()
 
+    def send_requests(self, requests, queue=None):
+        for request in requests:
+            self.send_request(request, queue)
+
     def send_request(self, request, queue=None):
         import urllib2, json, time, cookielib
         print_error( "send_http", messages )
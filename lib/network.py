@@ -3,6 +3,7 @@ from util import user_dir, appdata_dir, print_error, print_msg
 from pesetacoin import *
 import interface
 from blockchain import Blockchain
+from event_loop import EventLoop, LoopQueue
 
 DEFAULT_PORTS = {'t':'50101', 's':'50102', 'h':'8100', 'g':'8200'}
 
@@ -62,9 +63,22 @@ def pick_random_server(p='t'):
 from simple_config import SimpleConfig
 
 
+def new_network(config=None):
+    """Return a Network for the engine selected by 'network_engine':
+    'threads' (default) runs one thread per server, 'loop' runs all the
+    servers on one event loop."""
+    if config is None:
+        config = {}
+    if config.get('network_engine', 'threads') == 'loop':
+        return LoopNetwork(config)
+    return Network(config)
+
+
 
 class Network(threading.Thread):
 
+    loop = None
+
     def __init__(self, config=None):
         if config is None:
             config = {}  # Do not use mutables as default values!
@@ -128,10 +142,10 @@ class Network(threading.Thread):
         return self.interface and self.interface.is_connected
 
     def send_subscriptions(self):
-        for addr in self.addresses:
-            self.interface.send_request({'method':'blockchain.address.subscribe', 'params':[addr]})
-        self.interface.send_request({'method':'server.banner','params':[]})
-        self.interface.send_request({'method':'server.peers.subscribe','params':[]})
+        requests = [{'method':'blockchain.address.subscribe', 'params':[addr]} for addr in self.addresses]
+        requests.append({'method':'server.banner','params':[]})
+        requests.append({'method':'server.peers.subscribe','params':[]})
+        self.interface.send_requests(requests)
 
     def get_status_value(self, key):
         if key == 'status':
@@ -188,7 +202,7 @@ class Network(threading.Thread):
     def start_interface(self, server):
         if server in self.interfaces.keys():
             return
-        i = interface.Interface(server, self.config)
+        i = interface.Interface(server, self.config, self.loop)
         self.pending_servers.add(server)
         i.start(self.queue)
         return i
@@ -330,9 +344,22 @@ class Network(threading.Thread):
                 request = self.requests_queue.get(timeout=0.1)
             except Queue.Empty:
                 continue
-            self.process_request(request)
-
-    def process_request(self, request):
+            # requests that arrived together go to the server together
+            requests = [request]
+            while True:
+                try:
+                    requests.append(self.requests_queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self.process_requests(requests)
+
+    def process_requests(self, requests):
+        batch = [request for request in requests if not self.answer_request(request)]
+        if batch:
+            self.interface.send_requests(batch)
+
+    def answer_request(self, request):
+        "Answer requests that do not need the server. Returns True if the request was answered."
         method = request['method']
         params = request['params']
         _id = request['id']
@@ -350,15 +377,15 @@ class Network(threading.Thread):
                 print_error("network error", str(e))
 
             self.response_queue.put(out)
-            return
+            return True
 
         if method == 'blockchain.address.subscribe':
             addr = params[0]
             if addr in self.addresses:
                 self.response_queue.put({'id':_id, 'result':self.addresses[addr]})
-                return
+                return True
 
-        self.interface.send_request(request)
+        return False
 
 
     def run(self):
@@ -366,60 +393,65 @@ class Network(threading.Thread):
             try:
                 i, response = self.queue.get(timeout=0.1)
             except Queue.Empty:
-
-                if len(self.interfaces) + len(self.pending_servers) < self.num_server:
-                    self.start_random_interface()
-                if not self.interfaces:
-                    if time.time() - self.disconnected_time > DISCONNECTED_RETRY_INTERVAL:
-                        print_error('network: retrying connections')
-                        self.disconnected_servers = set([])
-                        self.disconnected_time = time.time()
-
-                if not self.interface.is_connected:
-                    if time.time() - self.disconnected_time > DISCONNECTED_RETRY_INTERVAL:
-                        print_error("forcing reconnection")
-                        self.queue.put((self.interface, None))
-                        self.disconnected_time = time.time()
-
-                continue
-
-            if response is not None:
-                self.process_response(i, response)
+                self.maintain_interfaces()
                 continue
+            self.process_item(i, response)
 
-            # if response is None it is a notification about the interface
-            if i.server in self.pending_servers:
-                self.pending_servers.remove(i.server)
+        self.stop_interfaces()
 
-            if i.is_connected:
-                self.add_interface(i)
-                self.add_recent_server(i)
-                i.send_request({'method':'blockchain.headers.subscribe','params':[]})
-                if i == self.interface:
-                    print_error('sending subscriptions to', self.interface.server)
-                    self.send_subscriptions()
-                    self.set_status('connected')
-            else:
-                self.disconnected_servers.add(i.server)
-                if i.server in self.interfaces:
-                    self.remove_interface(i)
-                if i.server in self.heights:
-                    self.heights.pop(i.server)
-                if i == self.interface:
-                    self.set_status('disconnected')
-
-            if not self.interface.is_connected:
-                if self.config.get('auto_cycle'):
-                    self.switch_to_random_interface()
-                else:
-                    if self.default_server not in self.disconnected_servers:
-                        print_error("restarting main interface")
-                        if self.default_server in self.interfaces.keys():
-                            self.switch_to_interface(self.interfaces[self.default_server])
-                        else:
-                            self.interface = self.start_interface(self.default_server)
+    def maintain_interfaces(self):
+        if len(self.interfaces) + len(self.pending_servers) < self.num_server:
+            self.start_random_interface()
+        if not self.interfaces:
+            if time.time() - self.disconnected_time > DISCONNECTED_RETRY_INTERVAL:
+                print_error('network: retrying connections')
+                self.disconnected_servers = set([])
+                self.disconnected_time = time.time()
+
+        if not self.interface.is_connected:
+            if time.time() - self.disconnected_time > DISCONNECTED_RETRY_INTERVAL:
+                print_error("forcing reconnection")
+                self.queue.put((self.interface, None))
+                self.disconnected_time = time.time()
+
+    def process_item(self, i, response):
+        if response is not None:
+            self.process_response(i, response)
+            return
 
+        # if response is None it is a notification about the interface
+        if i.server in self.pending_servers:
+            self.pending_servers.remove(i.server)
+
+        if i.is_connected:
+            self.add_interface(i)
+            self.add_recent_server(i)
+            i.send_request({'method':'blockchain.headers.subscribe','params':[]})
+            if i == self.interface:
+                print_error('sending subscriptions to', self.interface.server)
+                self.send_subscriptions()
+                self.set_status('connected')
+        else:
+            self.disconnected_servers.add(i.server)
+            if i.server in self.interfaces:
+                self.remove_interface(i)
+            if i.server in self.heights:
+                self.heights.pop(i.server)
+            if i == self.interface:
+                self.set_status('disconnected')
 
+        if not self.interface.is_connected:
+            if self.config.get('auto_cycle'):
+                self.switch_to_random_interface()
+            else:
+                if self.default_server not in self.disconnected_servers:
+                    print_error("restarting main interface")
+                    if self.default_server in self.interfaces.keys():
+                        self.switch_to_interface(self.interfaces[self.default_server])
+                    else:
+                        self.interface = self.start_interface(self.default_server)
+
+    def stop_interfaces(self):
         print_error("Network: Stopping interfaces")
         for i in self.interfaces.values():
             i.stop()
@@ -469,7 +501,49 @@ class Network(threading.Thread):
             return self.running
 
     def get_header(self, tx_height):
-        return self.blockchain.read_header(tx_height)
+        header = self.blockchain.read_header(tx_height)
+        return header.as_dict() if header else None
 
     def get_local_height(self):
         return self.blockchain.height()
+
+
+
+class LoopNetwork(Network):
+    """Network on an EventLoop.  The connections to the servers, the
+    requests of the clients and the routing of the responses are handled on
+    the thread of the loop, which sleeps until one of them needs it."""
+
+    def __init__(self, config=None):
+        Network.__init__(self, config)
+        self.loop = EventLoop()
+        self.queue = LoopQueue(self.loop, self.process_items)
+        self.requests_queue = LoopQueue(self.loop, self.process_requests)
+
+    def process_items(self, items):
+        for i, response in items:
+            self.process_item(i, response)
+
+    def start(self, response_queue):
+        self.prepare(response_queue)
+        threading.Thread.start(self)
+
+    def prepare(self, response_queue):
+        "Start everything but the loop, which is left to run."
+        self.running = True
+        self.response_queue = response_queue
+        self.start_interfaces()
+        self.blockchain.start()
+        self.loop.call_later(1, self.maintain_timer)
+
+    def maintain_timer(self):
+        self.maintain_interfaces()
+        self.loop.call_later(1, self.maintain_timer)
+
+    def run(self):
+        self.loop.run()
+        self.stop_interfaces()
+
+    def stop(self):
+        Network.stop(self)
+        self.loop.stop()
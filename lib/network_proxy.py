@@ -26,7 +26,7 @@ import json
 import Queue
 
 import util
-from network import Network
+from network import new_network
 from util import print_error, print_stderr, parse_json
 from simple_config import SimpleConfig
 from daemon import NetworkServer, DAEMON_PORT
@@ -53,10 +53,14 @@ class NetworkProxy(threading.Thread):
 
         if socket:
             self.pipe = util.SocketPipe(socket)
+            # block on reads, stop shuts the socket down
+            self.pipe.set_timeout(None)
             self.network = None
         else:
-            self.network = Network(config)
+            self.network = new_network(config)
             self.pipe = util.QueuePipe(send_queue=self.network.requests_queue)
+            # wait for responses without polling, stop puts None on the queue
+            self.pipe.set_timeout(None)
             self.network.start(self.pipe.get_queue)
             for key in ['status','banner','updated','servers','interfaces']:
                 value = self.network.get_status_value(key)
@@ -215,6 +219,13 @@ class NetworkProxy(threading.Thread):
 
     def stop(self):
         self.running = False
+        if self.network:
+            self.pipe.get_queue.put(None)
+        else:
+            try:
+                self.pipe.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
 
     def stop_daemon(self):
         return self.send([('daemon.stop',[])], None)
@@ -19,6 +19,18 @@
 import hashlib
 import hmac
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# number of headers hashed together by scrypt_batch; each lane needs a
+# 128 KiB scratchpad, so 512 lanes keep V at 64 MiB
+BATCH_SIZE = 512
+# below this many headers the NumPy overhead outweighs the batching and
+# scrypt_1024_1_1_80 is faster
+MIN_BATCH_SIZE = 32
+
 def scrypt_1024_1_1_80(header):
     if not isinstance(header, str) or len(header) != 80:
         raise ValueError('header must be an 80-byte string')
@@ -245,6 +257,88 @@ def _xor_salsa8_2(X):
 
 
 
+def scrypt_batch(headers):
+    """Hash a list of 80-byte headers, returning the list of digests.
+
+    The Salsa20/8 rounds and the V scratchpad are computed on NumPy uint32
+    arrays with one lane per header.  Batches of fewer than MIN_BATCH_SIZE
+    headers, and NumPy not being available, use scrypt_1024_1_1_80.
+    """
+    headers = list(headers)
+    if numpy is None:
+        return map(scrypt_1024_1_1_80, headers)
+    out = []
+    for i in xrange(0, len(headers), BATCH_SIZE):
+        batch = headers[i:i+BATCH_SIZE]
+        if len(batch) < MIN_BATCH_SIZE:
+            out += map(scrypt_1024_1_1_80, batch)
+        else:
+            out += _scrypt_batch_np(batch)
+    return out
+
+def _scrypt_batch_np(headers):
+    n = len(headers)
+    if n == 0:
+        return []
+    macs = []
+    X = numpy.empty((32, n), dtype=numpy.uint32)
+    for lane, header in enumerate(headers):
+        if not isinstance(header, str) or len(header) != 80:
+            raise ValueError('header must be an 80-byte string')
+        mac = hmac.new(header, digestmod=hashlib.sha256)
+        macs.append(mac)
+        B = ''
+        for i in xrange(4):
+            m = mac.copy()
+            m.update(header + '\0\0\0' + chr(i + 1))
+            B += m.digest()
+        X[:, lane] = numpy.frombuffer(B, dtype='<u4')
+
+    V = numpy.empty((1024, n, 32), dtype=numpy.uint32)
+    for i in xrange(1024):
+        V[i] = X.T
+        _xor_salsa8_np(X)
+
+    lanes = numpy.arange(n)
+    for i in xrange(1024):
+        k = X[16] & 1023
+        X ^= V[k, lanes].T
+        _xor_salsa8_np(X)
+
+    out = []
+    data = X.T.astype('<u4')
+    for lane, mac in enumerate(macs):
+        mac.update(data[lane].tostring() + '\0\0\0\x01')
+        out.append(mac.digest())
+    return out
+
+def _xor_salsa8_np(X):
+    # X is a (32, n) uint32 array; rows are the words of the state
+    X[0:16] ^= X[16:32]
+    _salsa8_np(X[0:16])
+    X[16:32] ^= X[0:16]
+    _salsa8_np(X[16:32])
+
+def _salsa8_np(B):
+    x = [row.copy() for row in B]
+    t = numpy.empty_like(x[0])
+    def step(a, b, c, r):
+        numpy.add(x[a], x[b], t)
+        x[c] ^= (t << r) | (t >> (32 - r))
+    for j in xrange(4):
+        step(0, 12, 4, 7);  step(4, 0, 8, 9);    step(8, 4, 12, 13);  step(12, 8, 0, 18)
+        step(5, 1, 9, 7);   step(9, 5, 13, 9);   step(13, 9, 1, 13);  step(1, 13, 5, 18)
+        step(10, 6, 14, 7); step(14, 10, 2, 9);  step(2, 14, 6, 13);  step(6, 2, 10, 18)
+        step(15, 11, 3, 7); step(3, 15, 7, 9);   step(7, 3, 11, 13);  step(11, 7, 15, 18)
+        step(0, 3, 1, 7);   step(1, 0, 2, 9);    step(2, 1, 3, 13);   step(3, 2, 0, 18)
+        step(5, 4, 6, 7);   step(6, 5, 7, 9);    step(7, 6, 4, 13);   step(4, 7, 5, 18)
+        step(10, 9, 11, 7); step(11, 10, 8, 9);  step(8, 11, 9, 13);  step(9, 8, 10, 18)
+        step(15, 14, 12, 7); step(12, 15, 13, 9); step(13, 12, 14, 13); step(14, 13, 15, 18)
+    for i in xrange(16):
+        B[i] += x[i]
+
+
+
 if __name__ == '__main__':
 
     vectors = [
@@ -264,3 +358,12 @@ if __name__ == '__main__':
     dt = (default_timer() - t0) / len(vectors)
     print "%.1f ms/hash" % (dt*1000)
     print "%.2f hash/s" % (1.0 / dt)
+
+    headers = [header.decode('hex') for header, hash in vectors] * 50
+    t0 = default_timer()
+    hashes = scrypt_batch(headers)
+    assert hashes == [hash.decode('hex') for header, hash in vectors] * 50
+
+    dt = (default_timer() - t0) / len(headers)
+    print "batch: %.1f ms/hash" % (dt*1000)
+    print "batch: %.2f hash/s" % (1.0 / dt)
@@ -18,7 +18,6 @@
 
 
 import threading
-import time
 import Queue
 
 import pesetacoin
@@ -38,10 +37,24 @@ class WalletSynchronizer(threading.Thread):
         self.lock = threading.Lock()
         self.queue = Queue.Queue()
         self.address_queue = Queue.Queue()
+        self.connected = threading.Event()
+        network.register_callback('status', self.on_status)
+        # the network may become up to date without sending us anything
+        network.register_callback('updated', self.wakeup)
+        self.on_status()
+
+    def on_status(self):
+        if self.network.is_connected():
+            self.connected.set()
+
+    def wakeup(self):
+        self.queue.put(None)
 
     def stop(self):
         with self.lock:
             self.running = False
+        self.connected.set()
+        self.wakeup()
 
     def is_running(self):
         with self.lock:
@@ -49,6 +62,7 @@ class WalletSynchronizer(threading.Thread):
 
     def add(self, address):
         self.address_queue.put(address)
+        self.wakeup()
 
     def subscribe_to_addresses(self, addresses):
         messages = []
@@ -60,9 +74,9 @@ class WalletSynchronizer(threading.Thread):
         with self.lock:
             self.running = True
         while self.is_running():
-            while not self.network.is_connected():
-                time.sleep(0.1)
-            self.run_interface()
+            self.connected.wait()
+            if self.is_running():
+                self.run_interface()
 
     def run_interface(self):
         #print_error("synchronizer: connected to", self.network.get_parameters())
@@ -121,10 +135,9 @@ class WalletSynchronizer(threading.Thread):
                 self.network.trigger_callback('updated')
                 self.was_updated = False
 
-            # 2. get a response
-            try:
-                r = self.queue.get(timeout=0.1)
-            except Queue.Empty:
+            # 2. get a response, or a wakeup
+            r = self.queue.get()
+            if r is None:
                 continue
 
             # 3. process response
@@ -0,0 +1,52 @@
+import pickle
+import struct
+import unittest
+
+from lib import auxpow
+from lib.auxpow import AuxPow, verify_many
+from lib.pesetacoin import Hash
+
+
+class TestAuxPow(unittest.TestCase):
+
+    auxhash = Hash('our block header')
+
+    def serialize(self, script, parent_version=1, chain_index=0):
+        coinbase = struct.pack('<iB', 1, 1) + chr(len(script)) + script + '\xff'*4
+        coinbase += struct.pack('<Bq', 1, 50) + chr(1) + '\x51' + struct.pack('<I', 0)
+        txid = Hash(coinbase[0:5] + '\0'*32 + '\xff'*4 + coinbase[5:])
+        parent = struct.pack('<I32s32sIII', parent_version, '\0'*32, txid, 0, 0, 0)
+        # empty coinbase branch, empty chain branch
+        return coinbase + '\0' + struct.pack('<i', 0) + '\0' + struct.pack('<i', chain_index) + parent
+
+    def script(self, nonce=7):
+        return '\x03\x01\x02\x03' + self.auxhash[::-1] + struct.pack('<II', 1, nonce)
+
+    def test_parse(self):
+        aux = AuxPow(self.serialize(self.script()))
+        self.assertEqual(self.script(), aux.coinbase_script)
+        self.assertEqual(aux.coinbase_txid, aux.parent_block[36:68])
+        self.assertEqual([], aux.chain_branch)
+        self.assertEqual(80, len(aux.parent_block))
+
+    def test_verify_many(self):
+        items = [
+            (1, self.auxhash, self.serialize(self.script())),
+            (2, Hash('another header'), self.serialize(self.script())),
+            (3, self.auxhash, self.serialize(self.script(), parent_version=auxpow.get_our_chain_id() << 16)),
+            (4, self.auxhash, self.serialize(self.script()[:-4])),
+            (5, self.auxhash, 'garbage'),
+        ]
+        failures = verify_many(items)
+        self.assertEqual([2, 3, 4, 5], [height for height, _ in failures])
+        self.assertEqual('Aux POW missing chain merkle root in parent coinbase', failures[0][1])
+        self.assertEqual('Aux POW parent has our chain ID', failures[1][1])
+
+    def test_verify_parsed(self):
+        aux = AuxPow(self.serialize(self.script()))
+        self.assertEqual([], verify_many([(1, self.auxhash, aux)]))
+
+    def test_pickle(self):
+        aux = AuxPow(self.serialize(self.script()))
+        aux = pickle.loads(pickle.dumps(aux, 2))
+        self.assertEqual([], verify_many([(1, self.auxhash, aux)]))
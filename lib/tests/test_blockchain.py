@@ -0,0 +1,559 @@
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+import zlib
+
+from lib import blockchain
+from lib.auxpow import AuxPow
+from lib.blockchain import Blockchain, BlockHeader, HeaderCache, HeaderStore, RetargetWindow
+from lib.blockchain import check_chunk_pow, file_chunk, get_checkpoints, hash_header, header_from_string, header_to_string
+from lib.pesetacoin import Hash, hash_encode
+
+
+class TestBlockHeader(unittest.TestCase):
+
+    raw = struct.pack('<I32s32sIII', 1, 'p'*31 + '\0', 'm'*32, 0x53a2d9e8, 0x1e0fef35, 0x04b1c700)
+
+    def header_dict(self):
+        return {
+            'version': 1,
+            'prev_block_hash': self.raw[4:36][::-1].encode('hex'),
+            'merkle_root': self.raw[36:68][::-1].encode('hex'),
+            'timestamp': 0x53a2d9e8,
+            'bits': 0x1e0fef35,
+            'nonce': 0x04b1c700,
+        }
+
+    def test_fields(self):
+        header = header_from_string(self.raw)
+        self.assertTrue(isinstance(header, BlockHeader))
+        self.assertEqual(self.header_dict(), header.as_dict())
+        self.assertEqual(0x1e0fef35, header['bits'])
+        self.assertEqual(None, header.get('block_height'))
+        self.assertFalse('auxpow' in header)
+        self.assertRaises(KeyError, header.__getitem__, 'auxpow_offset')
+
+    def test_round_trip(self):
+        header = header_from_string(self.raw)
+        self.assertEqual(self.raw.encode('hex'), header_to_string(header))
+        self.assertEqual(header_to_string(self.header_dict()), header_to_string(header))
+        self.assertEqual(hash_header(self.header_dict()), hash_header(header))
+
+    def test_auxpow_offsets(self):
+        header = header_from_string(self.raw + "\x10\0\0\0\x20\0\0\0")
+        self.assertEqual(16, header['auxpow_offset'])
+        self.assertEqual(32, header['auxpow_length'])
+        self.assertEqual(self.raw, header.raw)
+
+    def test_read_only_fields(self):
+        header = header_from_string(self.raw)
+        header['block_height'] = 5
+        self.assertEqual(5, header['block_height'])
+        self.assertRaises(KeyError, header.__setitem__, 'bits', 0)
+
+
+class TestRetargetWindow(unittest.TestCase):
+
+    def header(self, height):
+        return {'block_height':height, 'bits':0x1e0ffff0 + height, 'timestamp':1400000000 + 60*height}
+
+    def test_get(self):
+        window = RetargetWindow(size=4)
+        window.push(self.header(10))
+        self.assertEqual(self.header(10), window.get(10))
+        self.assertEqual(None, window.get(9))
+        self.assertEqual(None, window.get(-1))
+
+    def test_old_headers_are_overwritten(self):
+        window = RetargetWindow(size=4)
+        for height in range(10):
+            window.push(self.header(height))
+        self.assertEqual(None, window.get(5))
+        for height in range(6, 10):
+            self.assertEqual(self.header(height), window.get(height))
+
+
+class TestHeaderCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = HeaderCache(size=2)
+        cache.put(1, {'nonce':1})
+        cache.put(2, {'nonce':2})
+        self.assertEqual({'nonce':1}, cache.get(1))
+        cache.put(3, {'nonce':3})
+        self.assertEqual(None, cache.get(2))
+        self.assertEqual({'nonce':1}, cache.get(1))
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_shares_headers(self):
+        cache = HeaderCache()
+        header = {'nonce':1}
+        cache.put(1, header)
+        self.assertTrue(cache.get(1) is header)
+
+    def test_invalidate(self):
+        cache = HeaderCache()
+        for height in range(10):
+            cache.put(height, {'nonce':height})
+        cache.invalidate(8)
+        cache.invalidate(2, 4)
+        self.assertEqual([0, 1, 4, 5, 6, 7], sorted(cache.headers.keys()))
+
+
+class TestHeaderStore(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHeaderStore, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.user_dir, 'blockchain_headers')
+        self.store = HeaderStore(self.path)
+
+    def tearDown(self):
+        super(TestHeaderStore, self).tearDown()
+        self.store.close()
+        shutil.rmtree(self.user_dir)
+
+    def test_missing_file_is_not_created(self):
+        self.assertFalse(self.store.open())
+        self.assertEqual(None, self.store.read(0))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_write_and_read(self):
+        self.store.write(0, 'a'*80 + 'b'*80)
+        self.assertEqual(1, self.store.height())
+        self.assertEqual('b'*80, self.store.read(1))
+        # appending after the file was mapped
+        self.store.write(2, 'c'*80)
+        self.assertEqual(2, self.store.height())
+        self.assertEqual('c'*80, self.store.read(2))
+        self.assertEqual('b'*80 + 'c'*80, self.store.read(1, 5))
+        self.assertEqual(None, self.store.read(3))
+        with open(self.path, 'rb') as f:
+            self.assertEqual('a'*80 + 'b'*80 + 'c'*80, f.read())
+
+    def test_truncate(self):
+        self.store.write(0, 'a'*80 + 'b'*80 + 'c'*80)
+        self.store.read(2)
+        self.store.truncate(1)
+        self.assertEqual(0, self.store.height())
+        self.assertEqual(None, self.store.read(1))
+        self.assertEqual(80, os.path.getsize(self.path))
+
+
+class FakeConfig(dict):
+
+    def __init__(self, path, **kwargs):
+        dict.__init__(self, **kwargs)
+        self.path = path
+
+
+def linked_headers(count, prev_hash='\0'*32):
+    "count 80-byte headers from height 0, each linked to the one before"
+    raws = []
+    for height in range(count):
+        raw = struct.pack('<I32s32sIII', 2, prev_hash, 'm'*32, 1400000000 + 60*height, 0x1e0ffff0, height)
+        prev_hash = Hash(raw)
+        raws.append(raw)
+    return raws
+
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        super(TestCheckpoints, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        raws = linked_headers(2016)
+        self.hashes = [hash_encode(Hash(raw)) for raw in raws]
+        self.chunk = file_chunk(''.join(raws))
+        # proof of work cannot be produced for test headers
+        self.pow_data = []
+        self.pow_batch = blockchain.PoWHashBatch
+        blockchain.PoWHashBatch = lambda data: self.pow_data.extend(data) or ['\0'*32] * len(data)
+
+    def tearDown(self):
+        super(TestCheckpoints, self).tearDown()
+        blockchain.PoWHashBatch = self.pow_batch
+        shutil.rmtree(self.user_dir)
+
+    def test_shipped_checkpoints(self):
+        for height, _hash in blockchain.checkpoints.items():
+            self.assertTrue(isinstance(height, int))
+            self.assertEqual(32, len(_hash.decode('hex')))
+
+    def blockchain(self, checkpoints):
+        return Blockchain(FakeConfig(self.user_dir, checkpoints=checkpoints), None)
+
+    def test_config_overrides(self):
+        checkpoints = get_checkpoints(FakeConfig(self.user_dir, checkpoints={'10': 'ab'}))
+        self.assertEqual('ab', checkpoints[10])
+
+    def test_chunk_below_checkpoint(self):
+        bc = self.blockchain({'2015': self.hashes[2015], '1000': self.hashes[1000]})
+        self.assertEqual(2015, bc.checkpoint_height)
+        bc.verify_chunk(0, self.chunk)
+        self.assertEqual(self.hashes[2015], bc.hash_header(bc.read_header(2015)))
+        # no proof of work is computed below the highest checkpoint
+        self.assertEqual([], self.pow_data)
+
+    def test_bad_checkpoint(self):
+        bc = self.blockchain({'2015': self.hashes[2015], '1000': self.hashes[999]})
+        self.assertRaises(AssertionError, bc.verify_chunk, 0, self.chunk)
+        self.assertEqual(None, bc.read_header(0))
+
+    def test_bad_highest_checkpoint(self):
+        bc = self.blockchain({'2015': self.hashes[2014], '1000': self.hashes[1000]})
+        self.assertRaises(AssertionError, bc.verify_chunk, 0, self.chunk)
+        self.assertEqual(None, bc.read_header(0))
+
+    def test_chunk_across_checkpoint(self):
+        bc = self.blockchain({'1000': self.hashes[1000]})
+        bc.verify_chunk(0, self.chunk)
+        self.assertEqual(self.hashes[2015], bc.hash_header(bc.read_header(2015)))
+        # only the headers above the checkpoint are hashed
+        self.assertEqual(''.join(linked_headers(2016)[1001:]), ''.join(self.pow_data))
+
+    def test_pipeline_skips_checkpointed_headers(self):
+        self.assertEqual(None, check_chunk_pow(0, self.chunk, 2015))
+        self.assertEqual([], self.pow_data)
+
+
+def reject_marked_chunk(index, hexdata, checkpoint_height=-1):
+    "check_chunk_pow of a worker that rejects the headers with nonce 0xffffffff"
+    if 'ffffffff' + '00'*8 in hexdata:
+        return 'block in chunk %d: insufficient proof of work' % index
+
+
+class FakeInterface(object):
+
+    server = 'fake'
+
+    def __init__(self, chunks):
+        self.chunks = chunks    # index -> list of answers, the last one repeated
+        self.requests = []
+
+    def send_request(self, request, queue):
+        index = request['params'][0]
+        self.requests.append(index)
+        answers = self.chunks[index]
+        hexdata = answers.pop(0) if len(answers) > 1 else answers[0]
+        result = zlib.compress(hexdata).encode('hex')
+        queue.put((self, {'method':request['method'], 'params':[index], 'result':result}))
+
+
+class TestChunkPipeline(unittest.TestCase):
+
+    def setUp(self):
+        super(TestChunkPipeline, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.raws = linked_headers(3*2016 + 10)
+        self.chunks = dict((index, [file_chunk(''.join(self.raws[index*2016:(index+1)*2016]))]) for index in range(4))
+        # proof of work cannot be produced for test headers
+        self.pow_batch = blockchain.PoWHashBatch
+        blockchain.PoWHashBatch = lambda data: ['\0'*32] * len(data)
+
+    def tearDown(self):
+        super(TestChunkPipeline, self).tearDown()
+        blockchain.PoWHashBatch = self.pow_batch
+        shutil.rmtree(self.user_dir)
+
+    def sync(self, workers):
+        bc = Blockchain(FakeConfig(self.user_dir, verify_workers=workers), None)
+        i = FakeInterface(self.chunks)
+        height = len(self.raws) - 1
+        self.assertTrue(bc.get_and_verify_chunks(i, None, height))
+        self.assertEqual(height, bc.height())
+        self.assertEqual(''.join(self.raws), bc.store.read(0, len(self.raws)))
+        bc.store.close()
+        return i.requests
+
+    def bad_chunk(self, index, n, nonce=None, prev_hash=None):
+        "chunk index, with header n changed"
+        raws = list(self.raws[index*2016:(index+1)*2016])
+        raw = raws[n]
+        if prev_hash is not None:
+            raw = raw[:4] + prev_hash + raw[36:]
+        if nonce is not None:
+            raw = raw[:76] + struct.pack('<I', nonce)
+        raws[n] = raw
+        return file_chunk(''.join(raws))
+
+    def test_serial(self):
+        serial = blockchain.Blockchain.get_and_verify_chunks_pipelined
+        blockchain.Blockchain.get_and_verify_chunks_pipelined = None
+        try:
+            self.assertEqual([0, 1, 2, 3], self.sync(0))
+        finally:
+            blockchain.Blockchain.get_and_verify_chunks_pipelined = serial
+
+    def test_pipelined(self):
+        self.assertEqual([0, 1, 2, 3], self.sync(2))
+
+    def test_bad_linkage(self):
+        self.chunks[1].insert(0, self.bad_chunk(1, 5, prev_hash='p'*32))
+        requests = self.sync(1)
+        # chunk 1 is erased, and the pipeline starts again from chunk 0
+        self.assertEqual([0, 1, 2, 0, 1, 2, 3], requests)
+
+    def test_worker_rejects_chunk(self):
+        saved = blockchain.check_chunk_pow
+        blockchain.check_chunk_pow = reject_marked_chunk
+        try:
+            self.chunks[2].insert(0, self.bad_chunk(2, 7, nonce=0xffffffff))
+            requests = self.sync(1)
+        finally:
+            blockchain.check_chunk_pow = saved
+        self.assertEqual([0, 1, 2, 3, 1, 2, 3], requests)
+
+    def test_check_chunk_pow(self):
+        # proof of work is checked from block 555000 on
+        index = 555000 / 2016
+        raws = [struct.pack('<I32s32sIII', 2, 'p'*32, 'm'*32, 0, 0x1e0ffff0, height)
+                for height in range(index*2016, (index+1)*2016)]
+        hexdata = file_chunk(''.join(raws))
+        self.assertEqual(None, check_chunk_pow(index, hexdata))
+        blockchain.PoWHashBatch = lambda data: ['\xff'*32] * len(data)
+        self.assertEqual('block 555000: insufficient proof of work', check_chunk_pow(index, hexdata))
+        # headers up to the checkpoint are skipped
+        self.assertEqual(None, check_chunk_pow(index, hexdata, (index+1)*2016 - 1))
+
+
+class TestVerifyChain(unittest.TestCase):
+
+    start = 120*270
+
+    def setUp(self):
+        super(TestVerifyChain, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.bc = Blockchain(FakeConfig(self.user_dir), None)
+        self.prev_hash = '\0'*32
+        for height in range(self.start - 250, self.start):
+            self.bc.save_header(self.header(height, 0x1e0ffff0, 2))
+        # proof of work cannot be produced for test headers
+        self.pow_data = []
+        self.pow_batch = blockchain.PoWHashBatch
+        blockchain.PoWHashBatch = lambda data: self.pow_data.extend(data) or ['\0'*32] * len(data)
+
+    def tearDown(self):
+        super(TestVerifyChain, self).tearDown()
+        blockchain.PoWHashBatch = self.pow_batch
+        self.bc.store.close()
+        shutil.rmtree(self.user_dir)
+
+    def header(self, height, bits, version):
+        raw = struct.pack('<I32s32sIII', version, self.prev_hash, 'm'*32, 1400000000 + 60*height, bits, height)
+        self.prev_hash = Hash(raw)
+        header = header_from_string(raw)
+        header['block_height'] = height
+        return header
+
+    def auxpow(self, header_hash):
+        """Auxpow committing to header_hash, in the form sent by the server."""
+        script = '\0'*4 + header_hash[::-1] + struct.pack('<II', 1, 0)
+        coinbase = struct.pack('<iB', 1, 1) + chr(len(script)) + script + '\xff'*4
+        coinbase += struct.pack('<Bq', 1, 50) + chr(1) + '\x51' + struct.pack('<I', 0)
+        txid = Hash(coinbase[0:5] + '\0'*32 + '\xff'*4 + coinbase[5:])
+        parent = struct.pack('<I32s32sIII', 2, 'p'*32, txid, 0, 0, 0)
+        aux = AuxPow(coinbase + '\0' + struct.pack('<i', 0) + '\0' + struct.pack('<i', 0) + parent)
+        return {
+            'coinbasetx': {'txid': hash_encode(aux.coinbase_txid), 'vin': [{'coinbase': aux.coinbase_script.encode('hex')}]},
+            'coinbaseMerkleBranch': [],
+            'coinbaseIndex': 0,
+            'chainMerkleBranch': [],
+            'chainIndex': 0,
+            'parent_block': header_from_string(parent).as_dict(),
+        }, parent
+
+    def chain(self):
+        chain = []
+        parents = []
+        for height in range(self.start, self.start + 2):
+            bits, _ = self.bc.get_target(height, chain)
+            header = self.header(height, bits, 4653314).as_dict()
+            header['block_height'] = height
+            header['auxpow'], parent = self.auxpow(self.prev_hash)
+            chain.append(header)
+            parents.append(parent)
+        return chain, parents
+
+    def test_auxpow_dicts(self):
+        chain, parents = self.chain()
+        self.assertTrue(self.bc.verify_chain(chain))
+        # the proof of work is the one of the parent blocks
+        self.assertEqual(parents, self.pow_data)
+
+    def test_bad_auxpow(self):
+        chain, parents = self.chain()
+        chain[1]['auxpow']['chainIndex'] = 1
+        self.assertFalse(self.bc.verify_chain(chain))
+
+    def test_unreadable_auxpow(self):
+        chain, parents = self.chain()
+        del chain[1]['auxpow']['parent_block']
+        self.assertFalse(self.bc.verify_chain(chain))
+
+
+class HeadersHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range')))
+        if self.path.endswith('.manifest'):
+            if server.manifest is None:
+                self.send_error(404)
+                return
+            data = json.dumps(server.manifest)
+            start = 0
+        else:
+            data = server.data[:server.limit]
+            start = 0
+            if self.headers.get('Range'):
+                start = int(self.headers['Range'][len('bytes='):-1])
+        if start:
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHeaderDownload(unittest.TestCase):
+
+    chunk_size = 2016 * 80
+
+    def setUp(self):
+        super(TestHeaderDownload, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), HeadersHandler)
+        self.set_data(''.join(linked_headers(3*2016 + 10)))
+        self.server.limit = None
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.path = os.path.join(self.user_dir, 'blockchain_headers')
+        # proof of work cannot be produced for test headers
+        self.pow_batch = blockchain.PoWHashBatch
+        blockchain.PoWHashBatch = lambda data: ['\0'*32] * len(data)
+
+    def tearDown(self):
+        super(TestHeaderDownload, self).tearDown()
+        blockchain.PoWHashBatch = self.pow_batch
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.user_dir)
+
+    def set_data(self, data):
+        self.server.data = data
+        self.server.manifest = [hashlib.sha256(data[i:i+self.chunk_size]).hexdigest()
+                                for i in range(0, len(data), self.chunk_size)]
+
+    def blockchain(self):
+        url = 'http://127.0.0.1:%d/blockchain_headers' % self.server.server_port
+        return Blockchain(FakeConfig(self.user_dir, headers_url=url), None)
+
+    def test_download(self):
+        bc = self.blockchain()
+        bc.init_headers_file()
+        self.assertEqual(3*2016 + 9, bc.height())
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.server.data, f.read())
+
+    def test_resume(self):
+        # the connection is cut in the middle of the second chunk
+        self.server.limit = self.chunk_size * 3 / 2
+        bc = self.blockchain()
+        bc.init_headers_file()
+        self.assertEqual(2015, bc.height())
+        with open(self.path + '.tmp') as f:
+            self.assertEqual('', f.read())
+
+        self.server.limit = None
+        self.server.requests = []
+        bc = self.blockchain()
+        bc.init_headers_file()
+        self.assertEqual('bytes=%d-' % self.chunk_size, self.server.requests[-1][1])
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.server.data, f.read())
+
+    def test_interrupted_download(self):
+        # stopped after writing the second chunk, before it was verified
+        with open(self.path, 'wb') as f:
+            f.write(self.server.data[:self.chunk_size] + 'x' * self.chunk_size)
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(str(self.chunk_size))
+        bc = self.blockchain()
+        bc.init_headers_file()
+        self.assertEqual('bytes=%d-' % self.chunk_size, self.server.requests[-1][1])
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.server.data, f.read())
+
+    def test_verification_failure(self):
+        headers = linked_headers(3*2016 + 10)
+        # the third header of the second chunk does not link to the second
+        headers[2018] = headers[2018][:4] + 'p'*32 + headers[2018][36:]
+        self.set_data(''.join(headers))
+        bc = self.blockchain()
+        bc.init_headers_file()
+        self.assertEqual(2015, bc.height())
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.server.data[:self.chunk_size], f.read())
+        with open(self.path + '.tmp') as f:
+            self.assertEqual('', f.read())
+
+    def test_checksum_mismatch(self):
+        self.server.manifest[1] = '00'*32
+        bc = self.blockchain()
+        bc.init_headers_file()
+        self.assertEqual(2015, bc.height())
+        self.assertTrue(os.path.exists(self.path + '.tmp'))
+
+    def test_without_manifest(self):
+        self.server.manifest = None
+        bc = self.blockchain()
+        bc.init_headers_file()
+        self.assertEqual(3*2016 + 9, bc.height())
+
+    def test_failure_without_progress(self):
+        self.server.manifest[0] = '00'*32
+        bc = self.blockchain()
+        bc.init_headers_file()
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        self.assertEqual(0, os.path.getsize(self.path))
+        # not retried on the next start
+        self.server.requests = []
+        self.blockchain().init_headers_file()
+        self.assertEqual([], self.server.requests)
+
+    def test_resume_keeps_synced_headers(self):
+        self.server.limit = self.chunk_size * 3 / 2
+        bc = self.blockchain()
+        bc.init_headers_file()
+        # headers received from the network after the failed download
+        bc.store.write(2016, self.server.data[self.chunk_size:self.chunk_size + 80*100])
+        bc.store.close()
+
+        self.server.limit = None
+        bc = self.blockchain()
+        writes = []
+        write = bc.store.write
+        bc.store.write = lambda height, data: writes.append(height) or write(height, data)
+        bc.init_headers_file()
+        self.assertEqual('bytes=%d-' % self.chunk_size, self.server.requests[-1][1])
+        self.assertEqual([2116, 2*2016, 3*2016], writes)
+        self.assertEqual(3*2016 + 9, bc.height())
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.server.data, f.read())
@@ -0,0 +1,215 @@
+import Queue
+import socket
+import threading
+import unittest
+
+from lib.event_loop import EventLoop, LoopQueue
+from lib.daemon import LoopClient
+from lib.interface import Interface, LoopInterface
+from lib.util import SocketPipe
+
+
+class LoopTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(LoopTestCase, self).setUp()
+        self.loop = EventLoop()
+        self.thread = threading.Thread(target=self.loop.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        super(LoopTestCase, self).tearDown()
+        self.loop.stop()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+
+
+class TestRunCallback(unittest.TestCase):
+
+    def test_interrupt(self):
+        loop = EventLoop()
+        def interrupt():
+            raise KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, loop.run_callback, interrupt, ())
+
+
+class TestEventLoop(LoopTestCase):
+
+    def test_call_soon(self):
+        queue = Queue.Queue()
+        self.loop.call_soon(queue.put, 1)
+        self.loop.call_soon(lambda: queue.put(self.loop.in_loop()))
+        self.assertEqual(1, queue.get(timeout=5))
+        self.assertEqual(True, queue.get(timeout=5))
+        self.assertFalse(self.loop.in_loop())
+
+    def test_call_later(self):
+        queue = Queue.Queue()
+        def schedule():
+            self.loop.call_later(0.05, queue.put, 2)
+            self.loop.call_later(0.01, queue.put, 1)
+        self.loop.call_soon(schedule)
+        self.assertEqual(1, queue.get(timeout=5))
+        self.assertEqual(2, queue.get(timeout=5))
+
+    def test_errors_do_not_stop_the_loop(self):
+        queue = Queue.Queue()
+        self.loop.call_soon(lambda: 1/0)
+        self.loop.call_soon(queue.put, 1)
+        self.assertEqual(1, queue.get(timeout=5))
+
+    def test_writer(self):
+        a, b = socket.socketpair()
+        queue = Queue.Queue()
+        def on_writable():
+            self.loop.remove_writer(b)
+            queue.put(self.loop.writers)
+        self.loop.call_soon(self.loop.add_writer, b, on_writable)
+        self.assertEqual({}, queue.get(timeout=5))
+        a.close()
+        b.close()
+
+    def test_reader(self):
+        a, b = socket.socketpair()
+        queue = Queue.Queue()
+        def on_readable():
+            data = b.recv(10)
+            if not data:
+                self.loop.remove_reader(b)
+            queue.put(data)
+        self.loop.call_soon(self.loop.add_reader, b, on_readable)
+        a.sendall('x')
+        self.assertEqual('x', queue.get(timeout=5))
+        a.close()
+        self.assertEqual('', queue.get(timeout=5))
+        b.close()
+
+    def test_loop_queue(self):
+        batches = Queue.Queue()
+        lock = threading.Lock()
+        queue = LoopQueue(self.loop, batches.put)
+        # the loop cannot run the callback before the items are all there
+        with lock:
+            self.loop.call_soon(lock.acquire)
+            for n in range(3):
+                queue.put(n)
+        self.assertEqual([0, 1, 2], batches.get(timeout=5))
+        queue.put(3)
+        self.assertEqual([3], batches.get(timeout=5))
+
+
+class TestLoopInterface(LoopTestCase):
+
+    def setUp(self):
+        super(TestLoopInterface, self).setUp()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.server = '127.0.0.1:%d:t' % self.listener.getsockname()[1]
+        self.queue = Queue.Queue()
+
+    def tearDown(self):
+        self.listener.close()
+        super(TestLoopInterface, self).tearDown()
+
+    def connect(self):
+        i = Interface(self.server, {}, self.loop)
+        self.assertTrue(isinstance(i, LoopInterface))
+        i.start(self.queue)
+        connection, address = self.listener.accept()
+        self.assertEqual((i, None), self.queue.get(timeout=5))
+        self.assertTrue(i.is_connected)
+        pipe = SocketPipe(connection)
+        pipe.set_timeout(5)
+        return i, pipe
+
+    def test_requests(self):
+        i, pipe = self.connect()
+        ping = pipe.get()
+        self.assertEqual('server.version', ping['method'])
+        i.send_request({'method':'blockchain.address.get_history', 'params':['addr'], 'id':7})
+        request = pipe.get()
+        pipe.send_all([{'id':ping['id'], 'result':'1.0'}, {'id':request['id'], 'result':[]}])
+        self.assertEqual((i, {'method':'blockchain.address.get_history', 'params':['addr'], 'result':[], 'id':7}),
+                         self.queue.get(timeout=5))
+        self.assertFalse(i.is_ping)
+
+    def test_disconnect(self):
+        i, pipe = self.connect()
+        pipe.socket.close()
+        self.assertEqual((i, None), self.queue.get(timeout=5))
+        self.assertFalse(i.is_connected)
+
+    def test_stop(self):
+        i, pipe = self.connect()
+        i.stop()
+        self.assertEqual((i, None), self.queue.get(timeout=5))
+        self.assertFalse(i.is_connected)
+        self.assertEqual({}, self.loop.readers)
+        self.assertEqual({}, self.loop.writers)
+
+
+class FakeServer(object):
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.clients = []
+        self.requests = Queue.Queue()
+        self.stopped = False
+
+    def add_client(self, client):
+        self.clients.append(client)
+
+    def remove_client(self, client):
+        self.clients.remove(client)
+        self.requests.put(None)
+
+    def send_request(self, client, request):
+        self.requests.put(request)
+
+    def stop(self):
+        self.stopped = True
+
+
+class TestLoopClient(LoopTestCase):
+
+    def test_client(self):
+        server = FakeServer(self.loop)
+        a, b = socket.socketpair()
+        pipe = SocketPipe(a)
+        pipe.set_timeout(5)
+        self.loop.call_soon(LoopClient, server, b)
+        pipe.send({"id": 1, "method": "server.banner", "params": []})
+        self.assertEqual({"id": 1, "method": "server.banner", "params": []}, server.requests.get(timeout=5))
+        client = server.clients[0]
+        client.response_queue.put({'id': 1, 'result': 'banner'})
+        client.response_queue.put({'id': 2, 'result': 'x'})
+        self.assertEqual({'id': 1, 'result': 'banner'}, pipe.get())
+        self.assertEqual({'id': 2, 'result': 'x'}, pipe.get())
+        a.close()
+        self.assertEqual(None, server.requests.get(timeout=5))
+        self.assertEqual([], server.clients)
+        self.assertEqual({}, self.loop.readers)
+        self.assertEqual({}, self.loop.writers)
+
+    def test_slow_reader(self):
+        server = FakeServer(self.loop)
+        a, b = socket.socketpair()
+        pipe = SocketPipe(a)
+        pipe.set_timeout(5)
+        self.loop.call_soon(LoopClient, server, b)
+        pipe.send({"id": 1, "method": "server.banner", "params": []})
+        server.requests.get(timeout=5)
+        client = server.clients[0]
+        banner = 'x' * 4000000
+        client.response_queue.put({'id': 1, 'result': banner})
+        # the loop goes on while the response waits for the reader
+        queue = Queue.Queue()
+        self.loop.call_soon(lambda: queue.put(dict(self.loop.writers)))
+        self.assertEqual([b], [s for s, callback in queue.get(timeout=5).values()])
+        self.assertEqual({'id': 1, 'result': banner}, pipe.get())
+        self.loop.call_soon(lambda: queue.put(dict(self.loop.writers)))
+        self.assertEqual({}, queue.get(timeout=5))
+        a.close()
+        self.assertEqual(None, server.requests.get(timeout=5))
@@ -0,0 +1,98 @@
+import Queue
+import socket
+import time
+import unittest
+
+from lib.interface import TcpInterface
+
+
+class FakePipe(object):
+
+    def __init__(self):
+        self.writes = []
+        self.error = None
+
+    def send_all(self, requests):
+        if self.error:
+            raise self.error
+        self.writes.append(requests)
+
+
+class TestTcpInterface(unittest.TestCase):
+
+    def interface(self, **config):
+        i = TcpInterface('localhost:50001:t', config)
+        i.pipe = FakePipe()
+        i.response_queue = Queue.Queue()
+        return i
+
+    def request(self, n):
+        return {'method':'blockchain.address.get_history', 'params':['addr%d' % n], 'id':n}
+
+    def test_batch(self):
+        i = self.interface()
+        i.send_requests([self.request(n) for n in range(3)])
+        self.assertEqual(1, len(i.pipe.writes))
+        self.assertEqual([0, 1, 2], [r['id'] for r in i.pipe.writes[0]])
+
+    def test_defaults(self):
+        i = self.interface()
+        self.assertEqual((0, 0), (i.max_inflight, i.request_timeout))
+        i = self.interface(max_inflight_requests=2)
+        self.assertEqual((2, 0), (i.max_inflight, i.request_timeout))
+
+    def test_send_failure(self):
+        i = self.interface(max_inflight_requests=2)
+        i.pipe.error = socket.error('broken pipe')
+        i.send_requests([self.request(n) for n in range(3)])
+        i.send_ping()
+        self.assertFalse(i.is_connected)
+        self.assertEqual({}, i.unanswered_requests)
+        self.assertEqual(3, len(i.pending_requests))
+
+    def test_window(self):
+        i = self.interface(max_inflight_requests=2)
+        i.send_requests([self.request(n) for n in range(5)])
+        self.assertEqual([[0, 1]], [[r['id'] for r in w] for w in i.pipe.writes])
+        i.process_response({'id':0, 'result':[]})
+        self.assertEqual([2], [r['id'] for r in i.pipe.writes[-1]])
+        self.assertEqual((i, {'method':'blockchain.address.get_history', 'params':['addr0'], 'result':[], 'id':0}),
+                         i.response_queue.get_nowait())
+        # pings are not held back by the window
+        i.send_ping()
+        self.assertEqual(['server.version'], [r['method'] for r in i.pipe.writes[-1]])
+        self.assertEqual(2, len(i.pending_requests))
+
+    def test_timeout(self):
+        i = self.interface(request_timeout=10)
+        queue = Queue.Queue()
+        i.send_requests([self.request(0)], queue)
+        i.check_timeouts()
+        self.assertTrue(queue.empty())
+        msg_id = i.unanswered_requests.keys()[0]
+        item = i.unanswered_requests[msg_id]
+        i.unanswered_requests[msg_id] = item[:4] + (time.time() - 11,)
+        i.timeout_check = 0
+        i.check_timeouts()
+        # sent again, nothing is answered
+        self.assertTrue(queue.empty())
+        self.assertEqual([[msg_id], [msg_id + 1]], [[r['id'] for r in w] for w in i.pipe.writes])
+        self.assertEqual(i.pipe.writes[0][0]['params'], i.pipe.writes[1][0]['params'])
+        self.assertEqual([msg_id + 1], i.unanswered_requests.keys())
+        # a late answer to the first send is dropped
+        i.process_response({'id':msg_id, 'result':[]})
+        self.assertTrue(queue.empty())
+        i.process_response({'id':msg_id + 1, 'result':[]})
+        self.assertEqual((i, {'method':'blockchain.address.get_history', 'params':['addr0'], 'result':[], 'id':0}),
+                         queue.get_nowait())
+
+    def test_timeout_window(self):
+        i = self.interface(request_timeout=10, max_inflight_requests=1)
+        i.send_requests([self.request(n) for n in range(2)])
+        msg_id = i.unanswered_requests.keys()[0]
+        item = i.unanswered_requests[msg_id]
+        i.unanswered_requests[msg_id] = item[:4] + (time.time() - 11,)
+        i.check_timeouts()
+        # the expired request keeps its place ahead of the waiting one
+        self.assertEqual(['addr0'], i.pipe.writes[-1][0]['params'])
+        self.assertEqual(1, len(i.pending_requests))
@@ -0,0 +1,63 @@
+import unittest
+
+from lib import scrypt
+from lib.scrypt import scrypt_1024_1_1_80, scrypt_batch
+
+
+class TestScrypt(unittest.TestCase):
+
+    vectors = [
+        ("00"*80, "161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69"),
+        ("ff"*80, "5253069c14ecedf978745486375ee37415e977f55cdbedac31ebee8bf33dd127"),
+        ("010000000000000000000000000000000000000000000000000000000000000000000000d9ced4ed1130f7b7faad9be25323ffafa33232a17c3edf6cfd97bee6bafbdd97b9aa8e4ef0ff0f1ecd513f7c", "001e67b013726fd7382e9acb69165b4b6316227fb3156b5b414ba6340c050000"),
+    ]
+
+    def setUp(self):
+        super(TestScrypt, self).setUp()
+        self.headers = [header.decode('hex') for header, _ in self.vectors]
+        self.hashes = [h.decode('hex') for _, h in self.vectors]
+
+    def test_scrypt(self):
+        self.assertEqual(self.hashes[0], scrypt_1024_1_1_80(self.headers[0]))
+
+    def test_scrypt_batch(self):
+        self.assertEqual(self.hashes, scrypt_batch(self.headers))
+
+    def test_scrypt_batch_numpy(self):
+        if scrypt.numpy is None:
+            self.skipTest("numpy not available")
+        self.assertEqual(self.hashes, scrypt._scrypt_batch_np(self.headers))
+
+    def test_scrypt_batch_small(self):
+        calls = []
+        saved = scrypt.scrypt_1024_1_1_80, scrypt._scrypt_batch_np, scrypt.numpy
+        scrypt.scrypt_1024_1_1_80 = lambda header: calls.append(1) or header[:32]
+        scrypt._scrypt_batch_np = lambda headers: calls.append(len(headers)) or [h[:32] for h in headers]
+        scrypt.numpy = saved[2] or object()
+        try:
+            headers = [chr(n % 256) * 80 for n in range(scrypt.BATCH_SIZE + 3)]
+            self.assertEqual([h[:32] for h in headers], scrypt_batch(headers))
+            # one full batch, the three headers left are hashed one by one
+            self.assertEqual([scrypt.BATCH_SIZE, 1, 1, 1], calls)
+            del calls[:]
+            scrypt_batch(headers[:scrypt.MIN_BATCH_SIZE - 1])
+            self.assertEqual([1] * (scrypt.MIN_BATCH_SIZE - 1), calls)
+            del calls[:]
+            scrypt_batch(headers[:scrypt.MIN_BATCH_SIZE])
+            self.assertEqual([scrypt.MIN_BATCH_SIZE], calls)
+        finally:
+            scrypt.scrypt_1024_1_1_80, scrypt._scrypt_batch_np, scrypt.numpy = saved
+
+    def test_scrypt_batch_empty(self):
+        self.assertEqual([], scrypt_batch([]))
+
+    def test_scrypt_batch_without_numpy(self):
+        saved = scrypt.numpy
+        scrypt.numpy = None
+        try:
+            self.assertEqual(self.hashes, scrypt_batch(self.headers))
+        finally:
+            scrypt.numpy = saved
+
+    def test_scrypt_batch_rejects_short_header(self):
+        self.assertRaises(ValueError, scrypt_batch, ['\0' * 79])
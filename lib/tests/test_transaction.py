@@ -0,0 +1,58 @@
+import unittest
+
+from lib import transaction
+from lib.pesetacoin import hash_160_to_bc_address, public_key_to_bc_address
+from lib.transaction import Transaction
+
+
+class TestTransaction(unittest.TestCase):
+
+    pubkey = '02' + '11' * 32
+    h160 = '22' * 20
+
+    def raw_tx(self):
+        # a coinbase paying to an address and to a pubkey
+        return ('01000000' + '01' + '00' * 32 + 'ffffffff' + '04' + '01020304' + 'ffffffff'
+                + '02'
+                + '0100000000000000' + '19' + '76a914' + self.h160 + '88ac'
+                + '0200000000000000' + '23' + '21' + self.pubkey + 'ac'
+                + '00000000')
+
+    def test_lazy_parse(self):
+        saved = transaction.deserialize
+        calls = []
+        def deserialize(raw):
+            calls.append(raw)
+            return saved(raw)
+        transaction.deserialize = deserialize
+        try:
+            tx = Transaction.deserialize(self.raw_tx(), lazy=True)
+            self.assertEqual(self.raw_tx(), str(tx))
+            self.assertEqual([], calls)
+            self.assertEqual(3, tx.output_value())
+            tx.inputs
+            self.assertEqual(1, len(calls))
+        finally:
+            transaction.deserialize = saved
+
+    def test_outputs(self):
+        tx = Transaction.deserialize(self.raw_tx())
+        address = hash_160_to_bc_address(self.h160.decode('hex'))
+        pubkey_address = public_key_to_bc_address(self.pubkey.decode('hex'))
+        self.assertEqual([(address, 1), (pubkey_address, 2)], tx.get_outputs())
+        self.assertTrue(tx.get_outputs() is tx.get_outputs())
+        self.assertTrue(tx.has_address(pubkey_address))
+        self.assertFalse(tx.has_address('other'))
+
+    def test_invalidate(self):
+        tx = Transaction.deserialize(self.raw_tx())
+        tx.get_outputs()
+        tx.insert_output(0, ('address', 'other', 5))
+        self.assertEqual(('other', 5), tx.get_outputs()[0])
+        self.assertTrue(tx.has_address('other'))
+        tx.remove_output(0)
+        self.assertFalse(tx.has_address('other'))
+
+        self.assertFalse(tx.has_address('input address'))
+        tx.add_input({'address': 'input address'})
+        self.assertTrue(tx.has_address('input address'))
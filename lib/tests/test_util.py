@@ -1,5 +1,8 @@
+import json
+import socket
+import threading
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, SocketPipe
 
 class TestUtil(unittest.TestCase):
 
@@ -62,3 +65,45 @@ class TestUtil(unittest.TestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'pesetacoin:LGmTrmr2cS9HD3YSbxtGGjhznabfnFba9a?amount=0.0003&label=test&amount=30.0')
+
+
+class TestSocketPipe(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSocketPipe, self).setUp()
+        self.a, self.b = socket.socketpair()
+        self.pipe = SocketPipe(self.b)
+        self.pipe.set_timeout(5)
+
+    def tearDown(self):
+        super(TestSocketPipe, self).tearDown()
+        self.a.close()
+        self.b.close()
+
+    def test_messages(self):
+        self.a.sendall('{"id": 1}\n{"id"')
+        self.assertEqual({"id": 1}, self.pipe.get())
+        self.a.sendall(': 2}\nnot json\n\n{"id": 3}\n')
+        self.assertEqual({"id": 2}, self.pipe.get())
+        self.assertEqual({"id": 3}, self.pipe.get())
+
+    def test_large_message(self):
+        message = {"id": 1, "result": "ab" * 300000}
+        data = json.dumps(message) + '\n'
+        t = threading.Thread(target=self.a.sendall, args=(data,))
+        t.start()
+        self.assertEqual(message, self.pipe.get())
+        t.join()
+
+    def test_closed(self):
+        self.a.sendall('{"id": 1}')
+        self.a.close()
+        self.assertEqual(None, self.pipe.get())
+
+    def test_get_all(self):
+        self.a.sendall('{"id": 1}\n{"id": 2}\n{"id"')
+        self.assertEqual([{"id": 1}, {"id": 2}], self.pipe.get_all())
+        self.a.sendall(': 3}\n')
+        self.assertEqual([{"id": 3}], self.pipe.get_all())
+        self.a.close()
+        self.assertEqual(None, self.pipe.get_all())
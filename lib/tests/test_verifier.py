@@ -0,0 +1,149 @@
+import threading
+import time
+import unittest
+
+from lib import verifier as verifier_module
+from lib.pesetacoin import Hash, hash_encode
+from lib.verifier import TxVerifier
+
+
+class FakeStorage(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def borrow(self, key, default=None):
+        return default
+
+    def put_item(self, key, item, value, save=True):
+        self.put_items(key, [(item, value)], save)
+
+    def put_items(self, key, items, save=True):
+        self.writes.append((key, items))
+
+
+class FakeNetwork(object):
+
+    def __init__(self, batch_size):
+        self.config = {'merkle_batch_size': batch_size}
+        self.sent = []
+        self.headers = {}
+        self.updated = threading.Event()
+        self.local_height = 1000
+        self.callbacks = {}
+
+    def register_callback(self, event, callback):
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def get_local_height(self):
+        return self.local_height
+
+    def get_header(self, height):
+        return self.headers.get(height)
+
+    def send(self, messages, callback):
+        self.sent.append(messages)
+        responses = []
+        for method, params in messages:
+            responses.append({'method':method, 'params':params,
+                              'result':{'block_height':params[1], 'pos':0, 'merkle':[]}})
+        # answers are queued before the verifier reads any of them
+        for r in responses:
+            callback(r)
+        return range(len(messages))
+
+    def trigger_callback(self, event):
+        self.updated.set()
+        for callback in self.callbacks.get(event, []):
+            callback()
+
+
+class TestTxVerifier(unittest.TestCase):
+
+    def test_batches(self):
+        network = FakeNetwork(batch_size=2)
+        storage = FakeStorage()
+        verifier = TxVerifier(network, storage)
+        tx_hashes = ['%064x' % i for i in range(1, 6)]
+        for height, tx_hash in enumerate(tx_hashes):
+            # with an empty branch, the merkle root is the tx hash
+            network.headers[height + 10] = {'merkle_root': tx_hash, 'timestamp': 1400000000 + height}
+            verifier.add(tx_hash, height + 10)
+        # a header that does not match
+        network.headers[14]['merkle_root'] = '00'*32
+
+        verifier.start()
+        try:
+            self.assertTrue(network.updated.wait(5))
+        finally:
+            verifier.stop()
+            verifier.join()
+        self.assertEqual([2, 2, 1], map(len, network.sent))
+        verified = [(tx_hash, (height + 10, 1400000000 + height, 0)) for height, tx_hash in enumerate(tx_hashes[:4])]
+        self.assertEqual([('verified_tx3', verified)], [(key, sorted(items)) for key, items in storage.writes])
+        self.assertEqual(12, verifier.get_height(tx_hashes[2]))
+        self.assertEqual(None, verifier.get_height(tx_hashes[4]))
+
+    def test_wait_for_headers(self):
+        network = FakeNetwork(batch_size=10)
+        network.local_height = 5
+        verifier = TxVerifier(network, FakeStorage())
+        tx_hash = '%064x' % 1
+        network.headers[10] = {'merkle_root': tx_hash, 'timestamp': 1400000000}
+        verifier.add(tx_hash, 10)
+        verifier.start()
+        try:
+            # nothing is requested before the header is there
+            self.assertFalse(network.updated.wait(0.2))
+            self.assertEqual([], network.sent)
+            # new headers wake the verifier up
+            network.local_height = 10
+            for callback in network.callbacks['updated']:
+                callback()
+            self.assertTrue(network.updated.wait(5))
+        finally:
+            verifier.stop()
+            verifier.join()
+        self.assertEqual(1, len(network.sent))
+        self.assertEqual(10, verifier.get_height(tx_hash))
+
+    def test_merkle_cache(self):
+        network = FakeNetwork(batch_size=10)
+        verifier = TxVerifier(network, FakeStorage())
+        leaves = [Hash(chr(i)) for i in range(4)]
+        level1 = [Hash(leaves[0] + leaves[1]), Hash(leaves[2] + leaves[3])]
+        root = Hash(level1[0] + level1[1])
+        network.headers[10] = {'merkle_root': hash_encode(root), 'timestamp': 1400000000}
+        tx_hashes = [hash_encode(leaf) for leaf in leaves]
+
+        def branch(pos):
+            return [hash_encode(leaves[pos ^ 1]), hash_encode(level1[(pos >> 1) ^ 1])]
+
+        calls = []
+        saved = verifier_module.Hash
+        def counting_hash(x):
+            calls.append(x)
+            return saved(x)
+        verifier_module.Hash = counting_hash
+        try:
+            self.assertTrue(verifier.verify_merkle(tx_hashes[0], {'block_height':10, 'pos':0, 'merkle':branch(0)}))
+            self.assertEqual(2, len(calls))
+            # the sibling leaf is a known node
+            self.assertTrue(verifier.verify_merkle(tx_hashes[1], {'block_height':10, 'pos':1, 'merkle':branch(1)}))
+            self.assertEqual(2, len(calls))
+            # the other half of the tree joins the known path one level up
+            self.assertTrue(verifier.verify_merkle(tx_hashes[2], {'block_height':10, 'pos':2, 'merkle':branch(2)}))
+            self.assertEqual(3, len(calls))
+            # a tx that is not in the block does not reach the known nodes
+            self.assertEqual(None, verifier.verify_merkle('00'*32, {'block_height':10, 'pos':3, 'merkle':branch(3)}))
+        finally:
+            verifier_module.Hash = saved
+
+        # after a reorg, the block at that height has another tree
+        leaves[0] = Hash('new')
+        level1[0] = Hash(leaves[0] + leaves[1])
+        network.headers[10] = {'merkle_root': hash_encode(Hash(level1[0] + level1[1])), 'timestamp': 1400000060}
+        self.assertTrue(verifier.verify_merkle(tx_hashes[1], {'block_height':10, 'pos':1, 'merkle':branch(1)}))
+        # the transaction that left the block does not verify any more
+        self.assertEqual(None, verifier.verify_merkle(tx_hashes[0], {'block_height':10, 'pos':0,
+            'merkle':[hash_encode(leaves[1]), hash_encode(level1[1])]}))
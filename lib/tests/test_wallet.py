@@ -6,7 +6,9 @@ import os
 import json
 
 from StringIO import StringIO
-from lib.wallet import WalletStorage, NewWallet
+from lib.wallet import WalletStorage, NewWallet, TxStore, tx_summary
+from lib.pesetacoin import Hash, bc_address_to_hash_160
+from lib.transaction import Transaction
 
 
 class FakeConfig(object):
@@ -31,6 +33,28 @@ class FakeSynchronizer(object):
         self.store.append(address)
 
 
+class FakeVerifier(object):
+
+    def __init__(self):
+        self.transactions = {}
+        self.verified_tx = {}
+
+    def add(self, tx_hash, tx_height):
+        self.transactions[tx_hash] = tx_height
+
+    def get_txpos(self, tx_hash):
+        return self.transactions.get(tx_hash, 1e12), 0
+
+    def get_confirmations(self, tx_hash):
+        return (1, 1400000000) if tx_hash in self.transactions else (0, None)
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.pending_transactions_for_notifications = []
+
+
 class WalletTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -101,6 +125,263 @@ class TestWalletStorage(WalletTestCase):
         self.assertEqual(some_dict, json.loads(contents))
 
 
+    def test_borrow(self):
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", {"b": [1]}, False)
+        self.assertTrue(storage.borrow("a") is storage.borrow("a"))
+        self.assertEqual(storage.get("a"), storage.borrow("a"))
+        self.assertFalse(storage.get("a") is storage.borrow("a"))
+        self.assertEqual("c", storage.borrow("d", "c"))
+
+    def test_put_appends_to_journal(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", "b")
+        storage.put("c", {"d": 1})
+        storage.put("a", None)
+
+        with open(path, "r") as f:
+            self.assertEqual({"a": "b"}, json.loads(f.read()))
+        with open(path + ".journal", "r") as f:
+            self.assertEqual(3, len(f.readlines()))
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual(None, storage.get("a"))
+        self.assertEqual({"d": 1}, storage.get("c"))
+
+    def test_put_item(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+
+        storage = WalletStorage(self.fake_config)
+        storage.put("transactions", {"a": "00"})
+        storage.put_item("transactions", "b", "01")
+        storage.put_item("transactions", "a", None)
+        storage.put_item("verified_tx3", "b", (1, 2, 3))
+
+        with open(path + ".journal", "r") as f:
+            self.assertEqual('["transactions", "b", "01"]\n', f.readlines()[1])
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual({"b": "01"}, storage.get("transactions"))
+        self.assertEqual({"b": [1, 2, 3]}, storage.get("verified_tx3"))
+
+    def test_put_items(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+
+        storage = WalletStorage(self.fake_config)
+        storage.put("verified_tx3", {"a": (1, 2, 3)})
+        storage.put_items("verified_tx3", [("a", None), ("b", (4, 5, 6)), ("c", (7, 8, 9))])
+
+        with open(path + ".journal", "r") as f:
+            self.assertEqual(4, len(f.readlines()))
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual({"b": [4, 5, 6], "c": [7, 8, 9]}, storage.get("verified_tx3"))
+
+    def test_journal_compaction(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+
+        storage = WalletStorage(self.fake_config)
+        storage.min_journal_size = 0
+        for i in range(100):
+            storage.put("key", "x" * i)
+        # the journal never grows much larger than the wallet file
+        self.assertTrue(os.path.getsize(path + ".journal") < 2 * os.path.getsize(path) + 500)
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("x" * 99, storage.get("key"))
+
+    def test_stale_journal_is_ignored(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", "b")
+        storage.put("a", "c")
+        # the wallet file is replaced by another one
+        with open(path, "w") as f:
+            f.write(json.dumps({"a": "d"}))
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("d", storage.get("a"))
+
+    def test_wallet_without_journal(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        # a wallet written before the journal existed
+        with open(path, "w") as f:
+            f.write(json.dumps({"a": "b"}))
+
+        storage = WalletStorage(self.fake_config)
+        storage.put("labels", {"x": "y"})
+        storage.put_item("transactions", "tx", "00")
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual({"x": "y"}, storage.get("labels"))
+        self.assertEqual({"tx": "00"}, storage.get("transactions"))
+        self.assertEqual(0600, os.stat(path + ".journal").st_mode & 0777)
+
+    def test_journal_without_header(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        with open(path, "w") as f:
+            f.write(json.dumps({"a": "b"}))
+        with open(path + ".journal", "w") as f:
+            f.write('["a", "c"]\n')
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("b", storage.get("a"))
+
+    def test_interrupted_append(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", "b")
+        storage.put("a", "c")
+        with open(path + ".journal", "a") as f:
+            f.write('["a", "d')
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("c", storage.get("a"))
+        storage.put("e", "f")
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("c", storage.get("a"))
+        self.assertEqual("f", storage.get("e"))
+
+    def test_write_behind(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        self.fake_config.set("wallet_flush_interval", 3600)
+
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", "b")
+        for i in range(10):
+            storage.put_item("transactions", "tx", str(i))
+        storage.put("a", "c")
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(10, storage.coalesced)
+
+        storage.stop()
+        self.assertFalse(storage.flusher.is_alive())
+        # once stopped, updates are written immediately
+        storage.put("d", "e")
+
+        self.assertEqual([path, path + ".journal"], sorted(os.path.join(self.user_dir, f) for f in os.listdir(self.user_dir)))
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("c", storage.get("a"))
+        self.assertEqual({"tx": "9"}, storage.get("transactions"))
+        self.assertEqual("e", storage.get("d"))
+
+
+class TestTxStore(WalletTestCase):
+
+    def setUp(self):
+        super(TestTxStore, self).setUp()
+        self.path = os.path.join(self.user_dir, "somewallet.txs")
+        self.txs = dict((Hash(raw)[::-1].encode('hex'), raw) for raw in ["tx%d" % i * 10 for i in range(5)])
+
+    def test_put_and_get(self):
+        store = TxStore(self.path)
+        for tx_hash, raw in self.txs.items():
+            store.put(tx_hash, raw)
+        store.close()
+
+        store = TxStore(self.path)
+        self.assertEqual(sorted(self.txs.keys()), sorted(store.keys()))
+        for tx_hash, raw in self.txs.items():
+            self.assertEqual(raw, store.get(tx_hash))
+        self.assertEqual(None, store.get("00" * 32))
+
+    def test_remove(self):
+        store = TxStore(self.path)
+        for tx_hash, raw in self.txs.items():
+            store.put(tx_hash, raw)
+        removed = self.txs.keys()[0]
+        store.remove(removed)
+        self.assertFalse(removed in store)
+        store.close()
+
+        store = TxStore(self.path)
+        self.assertFalse(removed in store)
+        self.assertEqual(len(self.txs) - 1, len(store.keys()))
+
+    def test_compact(self):
+        store = TxStore(self.path)
+        for tx_hash, raw in self.txs.items():
+            store.put(tx_hash, raw)
+        kept = self.txs.keys()[0]
+        for tx_hash in self.txs.keys()[1:]:
+            store.remove(tx_hash)
+        store.compact()
+        self.assertEqual(store.header_size + len(self.txs[kept]), os.path.getsize(self.path))
+        self.assertEqual(self.txs[kept], store.get(kept))
+
+    def test_wallet_without_journal(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        # a wallet written before the journal existed
+        with open(path, "w") as f:
+            f.write(json.dumps({"a": "b"}))
+
+        storage = WalletStorage(self.fake_config)
+        storage.put("labels", {"x": "y"})
+        storage.put_item("transactions", "tx", "00")
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual({"x": "y"}, storage.get("labels"))
+        self.assertEqual({"tx": "00"}, storage.get("transactions"))
+        self.assertEqual(0600, os.stat(path + ".journal").st_mode & 0777)
+
+    def test_journal_without_header(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        with open(path, "w") as f:
+            f.write(json.dumps({"a": "b"}))
+        with open(path + ".journal", "w") as f:
+            f.write('["a", "c"]\n')
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual("b", storage.get("a"))
+
+    def test_interrupted_append(self):
+        store = TxStore(self.path)
+        tx_hash, raw = self.txs.items()[0]
+        store.put(tx_hash, raw)
+        store.close()
+        with open(self.path, "ab") as f:
+            f.write("\0" * 40)
+
+        store = TxStore(self.path)
+        self.assertEqual([tx_hash], store.keys())
+        other_hash, other = self.txs.items()[1]
+        store.put(other_hash, other)
+        store.close()
+
+        store = TxStore(self.path)
+        self.assertEqual(other, store.get(other_hash))
+
+    def test_corrupted_transaction(self):
+        store = TxStore(self.path)
+        tx_hash, raw = self.txs.items()[0]
+        store.put(tx_hash, raw)
+        store.close()
+        with open(self.path, "r+b") as f:
+            f.seek(store.header_size)
+            f.write("x")
+
+        store = TxStore(self.path)
+        self.assertEqual(None, store.get(tx_hash))
+
+
 class TestNewWallet(WalletTestCase):
 
     seed_text = "travel nowhere air position hill peace suffer parent beautiful rise blood power home crumble teach"
@@ -162,3 +443,213 @@ class TestNewWallet(WalletTestCase):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+    def payment(self, prevout, script, outputs):
+        raw = '01000000' + '01' + prevout + ('%02x' % (len(script)/2)) + script + 'ffffffff'
+        raw += '%02x' % len(outputs)
+        for address, value in outputs:
+            h160 = bc_address_to_hash_160(address)[1].encode('hex')
+            raw += ('%016x' % value).decode('hex')[::-1].encode('hex') + '1976a914' + h160 + '88ac'
+        raw += '00000000'
+        tx = Transaction.deserialize(raw)
+        self.wallet.add_transaction(tx.hash(), tx, tx_summary(tx))
+        return tx.hash()
+
+    def take(self, tx_hash):
+        "Removes a transaction added by payment, to be received again"
+        tx = self.wallet.transactions[tx_hash]
+        self.wallet.remove_transaction(tx_hash)
+        return tx
+
+    def test_unspent_coins(self):
+        a = self.wallet.create_new_address(for_change=0)
+        b = self.wallet.create_new_address(for_change=0)
+        tx1 = self.payment('11'*36, '', [(a, 5)])
+        # tx2 spends tx1:0 and pays b
+        pubkey = self.wallet.get_public_keys(a)[0]
+        script = '4830' + '00'*70 + '01' + '21' + pubkey
+        tx2 = self.payment(tx1.decode('hex')[::-1].encode('hex') + '00000000', script, [(b, 3)])
+
+        self.wallet.history[a] = [(tx1, 100), (tx2, 0)]
+        self.wallet.history[b] = [(tx2, 0)]
+        self.wallet.update_addr_utxos(a)
+        self.wallet.update_addr_utxos(b)
+        self.assertEqual((5, -5), self.wallet.get_addr_balance(a))
+        self.assertEqual((0, 3), self.wallet.get_addr_balance(b))
+        self.assertEqual((5, -2), self.wallet.get_balance())
+        coins = self.wallet.get_unspent_coins()
+        self.assertEqual([(tx2, 0, 3, 0)], [(c['prevout_hash'], c['prevout_n'], c['value'], c['height']) for c in coins])
+
+        self.wallet.history[a] = [(tx1, 100), (tx2, 101)]
+        self.wallet.history[b] = [(tx2, 101)]
+        self.wallet.update_addr_utxos(a)
+        self.wallet.update_addr_utxos(b)
+        self.assertEqual((3, 0), self.wallet.get_balance())
+
+    def test_account_balance(self):
+        a = self.wallet.create_new_address(for_change=0)
+        tx1 = self.payment('11'*36, '', [(a, 5)])
+        self.wallet.history[a] = [(tx1, 0)]
+        self.wallet.update_addr_utxos(a)
+        self.assertEqual((0, 5), self.wallet.get_account_balance('0'))
+
+        self.wallet.history[a] = [(tx1, 100)]
+        self.wallet.update_addr_utxos(a)
+        self.assertEqual({a: (0, 5)}, self.wallet.dirty_balances)
+        self.assertEqual((5, 0), self.wallet.get_account_balance('0'))
+        self.assertEqual({}, self.wallet.dirty_balances)
+
+        # new addresses reset the totals
+        self.wallet.create_new_address(for_change=0)
+        self.assertEqual((5, 0), self.wallet.get_account_balance('0'))
+        self.assertEqual((5, 0), self.wallet.get_balance())
+
+    def test_tx_addresses(self):
+        a = self.wallet.create_new_address(for_change=0)
+        b = self.wallet.create_new_address(for_change=0)
+        tx1 = self.payment('11'*36, '', [(a, 5), (b, 1)])
+        tx = self.take(tx1)
+        self.wallet.receive_history_callback(a, [(tx1, 100)])
+        self.wallet.receive_history_callback(b, [(tx1, 100)])
+        self.assertEqual(set([a, b]), self.wallet.tx_addresses[tx1])
+        self.assertTrue(self.wallet.check_new_tx(tx1, tx))
+        self.assertFalse(self.wallet.check_new_tx('22'*32, tx))
+
+        self.wallet.receive_history_callback(a, [])
+        self.assertEqual(set([b]), self.wallet.tx_addresses[tx1])
+        self.wallet.receive_history_callback(b, ['*'])
+        self.assertFalse(tx1 in self.wallet.tx_addresses)
+        self.assertFalse(self.wallet.check_new_tx(tx1, tx))
+
+    def test_tx_history(self):
+        a = self.wallet.create_new_address(for_change=0)
+        b = self.wallet.create_new_address(for_change=0)
+        tx1 = self.payment('11'*36, '', [(a, 5)])
+        pubkey = self.wallet.get_public_keys(a)[0]
+        script = '4830' + '00'*70 + '01' + '21' + pubkey
+        tx2 = self.payment(tx1.decode('hex')[::-1].encode('hex') + '00000000', script, [(b, 3)])
+        txs = dict((h, self.take(h)) for h in [tx1, tx2])
+        self.wallet.network = FakeNetwork()
+        self.wallet.set_verifier(FakeVerifier())
+
+        self.wallet.receive_history_callback(a, [(tx1, 100)])
+        self.wallet.receive_tx_callback(tx1, txs[tx1], 100)
+        history = self.wallet.get_tx_history()
+        self.assertEqual([(tx1, 5, 5)], [(h[0], h[3], h[5]) for h in history])
+
+        self.wallet.receive_history_callback(a, [(tx1, 100), (tx2, 0)])
+        self.wallet.receive_history_callback(b, [(tx2, 0)])
+        self.wallet.receive_tx_callback(tx2, txs[tx2], 0)
+        model = self.wallet.history_models[None]
+        self.assertEqual(set([tx2]), model.dirty)
+        history = self.wallet.get_tx_history()
+        self.assertEqual([(tx1, 5, 5), (tx2, -2, 3)], [(h[0], h[3], h[5]) for h in history])
+        self.assertEqual(history[1:], self.wallet.get_tx_history(offset=-1))
+        self.assertEqual(history[:1], self.wallet.get_tx_history(limit=1))
+        self.assertEqual(history[1:], self.wallet.get_tx_history(since_height=101))
+
+        # confirmation of tx2
+        self.wallet.receive_history_callback(a, [(tx1, 100), (tx2, 101)])
+        self.wallet.receive_history_callback(b, [(tx2, 101)])
+        self.assertEqual([tx2], [h[0] for h in self.wallet.get_tx_history(since_height=101)])
+        self.assertEqual((100, 0), model.positions[tx1])
+        self.assertEqual((101, 0), model.positions[tx2])
+
+    def pubkey_payment(self, a):
+        pubkey = self.wallet.get_public_keys(a)[0]
+        raw1 = '01000000' + '01' + '11'*36 + '00' + 'ffffffff' + '01' + '0500000000000000' + '23' + '21' + pubkey + 'ac' + '00000000'
+        tx1 = Transaction.deserialize(raw1)
+        prevout = tx1.hash().decode('hex')[::-1].encode('hex') + '00000000'
+        raw2 = '01000000' + '01' + prevout + '49' + '48' + '30' + '00'*70 + '01' + 'ffffffff' + '00' + '00000000'
+        tx2 = Transaction.deserialize(raw2)
+        return tx1, tx2
+
+    def test_pubkey_inputs(self):
+        a = self.wallet.create_new_address(for_change=0)
+        tx1, tx2 = self.pubkey_payment(a)
+        h1, h2 = tx1.hash(), tx2.hash()
+        self.assertEqual("(pubkey)", tx2.inputs[0]['address'])
+
+        # the spending transaction arrives first
+        summary2 = tx_summary(tx2)
+        self.wallet.add_pubkey_addresses(h2, summary2)
+        self.assertEqual([h2], self.wallet.pubkey_inputs[h1])
+        self.wallet.add_transaction(h2, tx2, summary2)
+        summary1 = tx_summary(tx1)
+        self.wallet.add_pubkey_addresses(h1, summary1)
+        self.assertEqual(a, summary2.inputs[0]['address'])
+        self.assertEqual(a, tx2.inputs[0]['address'])
+        self.assertEqual({}, self.wallet.pubkey_inputs)
+        self.assertEqual([[h1, 0, a, True]], self.storage.get('tx_summaries')[h2][0])
+
+    def receive(self, tx_hash, tx, height, *addresses):
+        self.wallet.network = FakeNetwork()
+        if self.wallet.verifier is None:
+            self.wallet.set_verifier(FakeVerifier())
+        for addr in addresses:
+            hist = self.wallet.history.get(addr, []) + [(tx_hash, height)]
+            self.wallet.receive_history_callback(addr, hist)
+        self.wallet.receive_tx_callback(tx_hash, tx, height)
+
+    def load_wallet(self):
+        "Opens the wallet again, returns it with the hashes of the transactions parsed"
+        parsed = []
+        parse = Transaction.parse
+        Transaction.parse = lambda tx: parsed.append(tx.hash()) or parse(tx)
+        try:
+            wallet = NewWallet(WalletStorage(self.fake_config))
+        finally:
+            Transaction.parse = parse
+        return wallet, parsed
+
+    def test_load_transactions(self):
+        a = self.wallet.create_new_address(for_change=0)
+        tx1 = self.payment('11'*36, '', [(a, 5)])
+        tx = self.take(tx1)
+        self.receive(tx1, tx, 100, a)
+        # a transaction that no history refers to
+        self.storage.txs.put('33'*32, 'x')
+
+        wallet, parsed = self.load_wallet()
+        self.assertEqual([tx1], wallet.transactions.keys())
+        self.assertEqual([tx1], wallet.storage.txs.keys())
+        # the balance comes from the stored summary
+        self.assertEqual([], parsed)
+        self.assertEqual((5, 0), wallet.get_addr_balance(a))
+        self.assertEqual(tx.raw, wallet.transactions[tx1].raw)
+        self.assertEqual(tx.get_outputs(), wallet.transactions[tx1].get_outputs())
+
+    def test_load_transactions_without_summaries(self):
+        a = self.wallet.create_new_address(for_change=0)
+        tx1 = self.payment('11'*36, '', [(a, 5)])
+        tx = self.take(tx1)
+        self.receive(tx1, tx, 100, a)
+        # written by a version without summaries
+        self.storage.put('tx_summaries', None)
+
+        wallet, parsed = self.load_wallet()
+        self.assertEqual([tx1], parsed)
+        self.assertEqual((5, 0), wallet.get_addr_balance(a))
+        self.assertEqual([tx1], wallet.storage.get('tx_summaries').keys())
+        wallet, parsed = self.load_wallet()
+        self.assertEqual([], parsed)
+
+    def test_load_pubkey_inputs(self):
+        a = self.wallet.create_new_address(for_change=0)
+        tx1, tx2 = self.pubkey_payment(a)
+        h1, h2 = tx1.hash(), tx2.hash()
+        self.receive(h1, tx1, 100, a)
+        self.receive(h2, tx2, 101, a)
+        self.assertEqual((0, 0), self.wallet.get_addr_balance(a))
+
+        wallet, parsed = self.load_wallet()
+        self.assertEqual([], parsed)
+        self.assertEqual((0, 0), wallet.get_addr_balance(a))
+        self.assertEqual({}, wallet.pubkey_inputs)
+        self.assertEqual(a, wallet.transactions[h2].inputs[0]['address'])
+
+    def test_unsynchronized_wallet(self):
+        a = self.wallet.create_new_address(for_change=0)
+        self.wallet.history[a] = [('22'*32, 100)]
+        self.wallet.update_addr_utxos(a)
+        self.assertRaises(Exception, self.wallet.get_unspent_coins)
@@ -497,7 +497,12 @@ def push_script(x):
     return op_push(len(x)/2) + x
 
 
-class Transaction:
+class Transaction(object):
+    """With deserialize(raw, lazy=True), a transaction is only parsed when
+    its inputs or outputs are first needed; the wallet loads its stored
+    transactions that way.  Outputs and the input and output address sets
+    are computed once; methods that change the transaction reset them with
+    invalidate()."""
 
     def __str__(self):
         if self.raw is None:
@@ -505,23 +510,70 @@ class Transaction:
         return self.raw
 
     def __init__(self, inputs, outputs, locktime=0):
-        self.inputs = inputs
-        self.outputs = outputs
-        self.locktime = locktime
+        self._inputs = inputs
+        self._outputs = outputs
+        self._locktime = locktime
         self.raw = None
+        self.input_addresses = {}   # input index -> address found by set_input_address
+        self.invalidate()
 
     @classmethod
-    def deserialize(klass, raw):
+    def deserialize(klass, raw, lazy=False):
         self = klass([],[])
-        self.update(raw)
+        self.update(raw, lazy)
         return self
 
-    def update(self, raw):
-        d = deserialize(raw)
+    def update(self, raw, lazy=False):
         self.raw = raw
-        self.inputs = d['inputs']
-        self.outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
-        self.locktime = d['lockTime']
+        self._inputs = self._outputs = self._locktime = None
+        self.invalidate()
+        if not lazy:
+            self.parse()
+
+    def parse(self):
+        d = deserialize(self.raw)
+        self._inputs = d['inputs']
+        for i, address in self.input_addresses.items():
+            self._inputs[i]['address'] = address
+        self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
+        self._locktime = d['lockTime']
+
+    def invalidate(self):
+        self._address_outputs = None
+        self._output_addresses = None
+        self._input_addresses = None
+
+    @property
+    def inputs(self):
+        if self._inputs is None:
+            self.parse()
+        return self._inputs
+
+    @inputs.setter
+    def inputs(self, inputs):
+        self._inputs = inputs
+        self.invalidate()
+
+    @property
+    def outputs(self):
+        if self._outputs is None:
+            self.parse()
+        return self._outputs
+
+    @outputs.setter
+    def outputs(self, outputs):
+        self._outputs = outputs
+        self.invalidate()
+
+    @property
+    def locktime(self):
+        if self._locktime is None:
+            self.parse()
+        return self._locktime
+
+    @locktime.setter
+    def locktime(self, locktime):
+        self._locktime = locktime
 
     @classmethod
     def sweep(klass, privkeys, network, to_address, fee):
@@ -679,6 +731,17 @@ class Transaction:
     def add_input(self, input):
         self.inputs.append(input)
         self.raw = None
+        self.invalidate()
+
+    def insert_output(self, posn, output):
+        self.outputs.insert(posn, output)
+        self.raw = None
+        self.invalidate()
+
+    def remove_output(self, posn):
+        self.outputs.pop(posn)
+        self.raw = None
+        self.invalidate()
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs)
@@ -753,6 +816,7 @@ class Transaction:
 
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
+        self.invalidate()
 
 
     def add_pubkey_addresses(self, txdict):
@@ -763,10 +827,23 @@ class Transaction:
                     address, value = prev_tx.get_outputs()[txin.get('prevout_n')]
                     print_error("found pay-to-pubkey address:", address)
                     txin["address"] = address
+                    self._input_addresses = None
+
+
+    def set_input_address(self, i, address):
+        """Set the address of input i, found from its previous output.  A
+        transaction that is not parsed yet keeps it until it is."""
+        self.input_addresses[i] = address
+        if self._inputs is not None:
+            self._inputs[i]['address'] = address
+            self._input_addresses = None
 
 
     def get_outputs(self):
-        """convert pubkeys to addresses"""
+        """convert pubkeys to addresses.  The returned list is shared and
+        must not be modified."""
+        if self._address_outputs is not None:
+            return self._address_outputs
         o = []
         for type, x, v in self.outputs:
             if type == 'address':
@@ -781,14 +858,24 @@ class Transaction:
             else:
                 addr = "(None)"
             o.append((addr,v))      # consider using yield (addr, v)
+        self._address_outputs = o
         return o
 
     def get_output_addresses(self):
         return [addr for addr, val in self.get_outputs()]
 
+    def get_output_address_set(self):
+        if self._output_addresses is None:
+            self._output_addresses = set(addr for addr, val in self.get_outputs())
+        return self._output_addresses
+
+    def get_input_address_set(self):
+        if self._input_addresses is None:
+            self._input_addresses = set(txin.get("address") for txin in self.inputs)
+        return self._input_addresses
 
     def has_address(self, addr):
-        return (addr in self.get_output_addresses()) or (addr in (tx.get("address") for tx in self.inputs))
+        return (addr in self.get_output_address_set()) or (addr in self.get_input_address_set())
 
 
     def get_value(self, addresses, prevout_values):
@@ -254,14 +254,25 @@ import socket
 import errno
 import json
 import ssl
+import threading
 import traceback
 import time
+from collections import deque
 
 class SocketPipe:
+    """JSON messages, one per line, over a socket.  Data is received
+    into a fixed buffer; only the new data is searched for line ends, and
+    each complete line is decoded once."""
+
+    buffer_size = 65536
 
     def __init__(self, socket):
         self.socket = socket
-        self.message = ''
+        self.buffer = bytearray(self.buffer_size)
+        self.partial = []       # pieces of a line whose end was not received
+        self.lines = deque()    # complete lines, not decoded yet
+        self.outgoing = deque() # data queued by queue_all, not written yet
+        self.out_lock = threading.Lock()
         self.set_timeout(0.1)
 
     def set_timeout(self, t):
@@ -269,33 +280,77 @@ class SocketPipe:
 
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response:
-                return response
-            try:
-                data = self.socket.recv(1024)
-            except socket.timeout:
-                raise timeout
-            except ssl.SSLError:
-                raise timeout
-            except socket.error, err:
-                if err.errno == 60:
-                    raise timeout
-                elif err.errno in [11, 10035]:
-                    print_error("socket errno", err.errno)
-                    time.sleep(0.1)
-                    continue
-                else:
-                    print_error("pipe: socket error", err)
-                    data = ''
-            except:
-                traceback.print_exc(file=sys.stderr)
-                data = ''
+            while self.lines:
+                response = self.decode(self.lines.popleft())
+                if response:
+                    return response
+            n = self.recv()
+            if n is None:
+                time.sleep(0.1)
+                continue
+            if not n:
+                self.socket.close()
+                return None
+            self.add_data(memoryview(self.buffer)[:n].tobytes())
 
-            if not data:
+    def get_all(self):
+        """Read what the socket has and return the complete messages, or
+        None if the connection was closed.  Meant to be called when the
+        socket is readable, as it blocks otherwise."""
+        while True:
+            n = self.recv()
+            if n is None:
+                break
+            if not n:
                 self.socket.close()
                 return None
-            self.message += data
+            self.add_data(memoryview(self.buffer)[:n].tobytes())
+            # data already decrypted by ssl is not seen by select
+            if not (hasattr(self.socket, 'pending') and self.socket.pending()):
+                break
+        messages = []
+        while self.lines:
+            response = self.decode(self.lines.popleft())
+            if response:
+                messages.append(response)
+        return messages
+
+    def decode(self, line):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def recv(self):
+        "Return the number of bytes received, 0 if closed, None to try again."
+        try:
+            return self.socket.recv_into(self.buffer)
+        except socket.timeout:
+            raise timeout
+        except ssl.SSLError:
+            raise timeout
+        except socket.error, err:
+            if err.errno == 60:
+                raise timeout
+            elif err.errno in [11, 10035]:
+                print_error("socket errno", err.errno)
+                return None
+            else:
+                print_error("pipe: socket error", err)
+                return 0
+        except:
+            traceback.print_exc(file=sys.stderr)
+            return 0
+
+    def add_data(self, data):
+        if '\n' not in data:
+            self.partial.append(data)
+            return
+        lines = data.split('\n')
+        self.partial.append(lines[0])
+        self.lines.append(''.join(self.partial))
+        self.lines.extend(lines[1:-1])
+        self.partial = [lines[-1]] if lines[-1] else []
 
     def send(self, request):
         out = json.dumps(request) + '\n'
@@ -305,6 +360,35 @@ class SocketPipe:
         out = ''.join(map(lambda x: json.dumps(x) + '\n', requests))
         self._send(out)
 
+    def queue_all(self, requests):
+        "Queue messages for flush.  Thread safe."
+        out = ''.join(map(lambda x: json.dumps(x) + '\n', requests))
+        with self.out_lock:
+            self.outgoing.append(out)
+
+    def flush(self):
+        """Write as much of the queued data as the socket takes without
+        blocking; the socket has to be non-blocking.  Returns True once
+        everything is written, raises socket.error if the connection is
+        broken.  Thread safe."""
+        with self.out_lock:
+            while self.outgoing:
+                try:
+                    sent = self.socket.send(self.outgoing[0])
+                except ssl.SSLError as e:
+                    if e.errno in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+                        return False
+                    raise
+                except socket.error as e:
+                    if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        return False
+                    raise
+                if sent < len(self.outgoing[0]):
+                    self.outgoing[0] = self.outgoing[0][sent:]
+                else:
+                    self.outgoing.popleft()
+            return True
+
     def _send(self, out):
         while out:
             try:
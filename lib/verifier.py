@@ -18,6 +18,7 @@
 
 
 import threading, time, Queue, os, sys, shutil
+from collections import OrderedDict
 from util import user_dir, appdata_dir, print_error
 from pesetacoin import *
 
@@ -33,13 +34,26 @@ class TxVerifier(threading.Thread):
         self.storage = storage
         self.network = network
         self.transactions    = {}                                 # requested verifications (with height sent by the requestor)
-        self.verified_tx     = storage.get('verified_tx3',{})      # height, timestamp of verified transactions
-        self.merkle_roots    = storage.get('merkle_roots',{})      # hashed by me
+        self.verified_tx     = dict(storage.borrow('verified_tx3',{}))      # height, timestamp of verified transactions
+        self.merkle_roots    = dict(storage.borrow('merkle_roots',{}))      # hashed by me
         self.lock = threading.Lock()
         self.running = False
         self.queue = Queue.Queue()
+        self.callbacks = []
+        self.merkle_nodes = OrderedDict()   # merkle root -> {(level, index): hash} of verified merkle trees
+        self.merkle_cache_blocks = network.config.get('merkle_cache_blocks', 100)
+        # new headers may allow more merkle requests
+        network.register_callback('updated', self.wakeup)
 
 
+    def add_callback(self, callback):
+        "callback is called with the hash of a transaction that was verified or unverified"
+        self.callbacks.append(callback)
+
+    def trigger_callbacks(self, tx_hash):
+        for callback in self.callbacks:
+            callback(tx_hash)
+
     def get_confirmations(self, tx):
         """ return the number of confirmations of a monitored transaction. """
         with self.lock:
@@ -84,11 +98,16 @@ class TxVerifier(threading.Thread):
         """ add a transaction to the list of monitored transactions. """
         assert tx_height > 0
         with self.lock:
-            if tx_hash not in self.transactions.keys():
+            if tx_hash not in self.transactions:
                 self.transactions[tx_hash] = tx_height
+                self.wakeup()
+
+    def wakeup(self):
+        self.queue.put(None)
 
     def stop(self):
         with self.lock: self.running = False
+        self.wakeup()
 
     def is_running(self):
         with self.lock: return self.running
@@ -96,68 +115,114 @@ class TxVerifier(threading.Thread):
     def run(self):
         with self.lock:
             self.running = True
-        requested_merkle = []
+        requested_merkle = set()
+        batch_size = self.network.config.get('merkle_batch_size', 100)
 
         while self.is_running():
             # request missing tx
-            for tx_hash, tx_height in self.transactions.items():
+            requests = []
+            local_height = self.network.get_local_height()
+            with self.lock:
+                items = self.transactions.items()
+            for tx_hash, tx_height in items:
                 if tx_hash not in self.verified_tx:
                     # do not request merkle branch before headers are available
-                    if tx_height > self.network.get_local_height():
+                    if tx_height > local_height:
                         continue
                     if self.merkle_roots.get(tx_hash) is None and tx_hash not in requested_merkle:
-                        if self.network.send([ ('blockchain.transaction.get_merkle',[tx_hash, tx_height]) ], self.queue.put):
-                            print_error('requesting merkle', tx_hash)
-                            requested_merkle.append(tx_hash)
-
-            try:
-                r = self.queue.get(timeout=0.1)
-            except Queue.Empty:
-                continue
-
-            if not r: continue
-
-            if r.get('error'):
-                print_error('Verifier received an error:', r)
-                continue
-
-            # 3. handle response
-            method = r['method']
-            params = r['params']
-            result = r['result']
-
-            if method == 'blockchain.transaction.get_merkle':
-                tx_hash = params[0]
-                self.verify_merkle(tx_hash, result)
+                        requests.append(('blockchain.transaction.get_merkle', [tx_hash, tx_height]))
+            for i in range(0, len(requests), batch_size):
+                batch = requests[i:i+batch_size]
+                if self.network.send(batch, self.queue.put):
+                    print_error('requesting merkle', len(batch))
+                    requested_merkle.update(params[0] for method, params in batch)
+
+            # sleep until a response, a new transaction or new headers
+            r = self.queue.get()
+
+            # handle every response that is already there in one pass
+            responses = [r]
+            while True:
+                try:
+                    responses.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            verified = []
+            for r in responses:
+                if not r: continue
+
+                if r.get('error'):
+                    print_error('Verifier received an error:', r)
+                    continue
+
+                method = r['method']
+                params = r['params']
+                result = r['result']
+
+                if method == 'blockchain.transaction.get_merkle':
+                    tx_hash = params[0]
+                    item = self.verify_merkle(tx_hash, result)
+                    if item:
+                        verified.append((tx_hash, item))
+
+            if verified:
+                self.storage.put_items('verified_tx3', verified)
+                for tx_hash, item in verified:
+                    self.trigger_callbacks(tx_hash)
+                self.network.trigger_callback('updated')
 
 
     def verify_merkle(self, tx_hash, result):
+        """Check a merkle branch against the header of its block.  Returns
+        the (height, timestamp, pos) of the transaction if it is verified."""
         tx_height = result.get('block_height')
         pos = result.get('pos')
-        merkle_root = self.hash_merkle_root(result['merkle'], tx_hash, pos)
         header = self.network.get_header(tx_height)
         if not header: return
+        nodes = {}
+        merkle_root = self.hash_merkle_root(result['merkle'], tx_hash, pos, header.get('merkle_root'), nodes)
         if header.get('merkle_root') != merkle_root:
             print_error("merkle verification failed for", tx_hash)
             return
 
         # we passed all the tests
+        self.cache_merkle_nodes(merkle_root, nodes)
         self.merkle_roots[tx_hash] = merkle_root
         timestamp = header.get('timestamp')
         with self.lock:
             self.verified_tx[tx_hash] = (tx_height, timestamp, pos)
         print_error("verified %s"%tx_hash)
-        self.storage.put('verified_tx3', self.verified_tx, True)
-        self.network.trigger_callback('updated')
+        return tx_height, timestamp, pos
 
 
-    def hash_merkle_root(self, merkle_s, target_hash, pos):
+    def hash_merkle_root(self, merkle_s, target_hash, pos, merkle_root=None, nodes=None):
+        """Return the merkle root of a branch.  Given the expected root, the
+        walk stops at the first node already known from a verified branch
+        of the tree with that root.  The nodes of the branch are added to
+        nodes, if given."""
         h = hash_decode(target_hash)
-        for i in range(len(merkle_s)):
-            item = merkle_s[i]
-            h = Hash( hash_decode(item) + h ) if ((pos >> i) & 1) else Hash( h + hash_decode(item) )
+        depth = len(merkle_s)
+        with self.lock:
+            known = self.merkle_nodes.get(merkle_root, {}) if merkle_root is not None else {}
+        for i in range(depth):
+            index = pos >> i
+            if known.get((i, index)) == h:
+                return merkle_root
+            item = hash_decode(merkle_s[i])
+            if nodes is not None:
+                nodes[(i, index)] = h
+                nodes[(i, index ^ 1)] = item
+            h = Hash( item + h ) if (index & 1) else Hash( h + item )
         return hash_encode(h)
 
+    def cache_merkle_nodes(self, merkle_root, nodes):
+        with self.lock:
+            tree = self.merkle_nodes.pop(merkle_root, {})
+            tree.update(nodes)
+            self.merkle_nodes[merkle_root] = tree
+            while len(self.merkle_nodes) > self.merkle_cache_blocks:
+                self.merkle_nodes.popitem(last=False)
 
 
     def undo_verifications(self, height):
@@ -171,3 +236,5 @@ class TxVerifier(threading.Thread):
                     self.verified_tx.pop(tx_hash)
                     if tx_hash in self.merkle_roots:
                         self.merkle_roots.pop(tx_hash)
+                self.storage.put_item('verified_tx3', tx_hash, None)
+                self.trigger_callbacks(tx_hash)
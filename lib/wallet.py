@@ -26,6 +26,11 @@ import time
 import math
 import json
 import copy
+import atexit
+import bisect
+import struct
+import stat
+from collections import OrderedDict
 
 from util import print_msg, print_error, NotEnoughFunds
 
@@ -45,15 +50,67 @@ from mnemonic import Mnemonic
 IMPORTED_ACCOUNT = '/x'
 
 
+def tx_summary(tx):
+    """What the wallet needs of a transaction to track its coins: the
+    previous outputs and addresses of the inputs, the addresses and values
+    of the outputs.  Returned as a Transaction, so that it has the same
+    methods; pay-to-pubkey inputs are marked with 'pubkey'."""
+    inputs = []
+    for i, txin in enumerate(tx.inputs):
+        d = dict((k, txin[k]) for k in ('prevout_hash', 'prevout_n', 'address') if txin.get(k) is not None)
+        if txin.get('address') == "(pubkey)" or i in tx.input_addresses:
+            d['pubkey'] = True
+        inputs.append(d)
+    outputs = [('address', addr, value) for addr, value in tx.get_outputs()]
+    return Transaction(inputs, outputs)
+
+def summary_to_json(summary):
+    inputs = [[txin.get('prevout_hash'), txin.get('prevout_n'), txin.get('address'), txin.get('pubkey', False)]
+              for txin in summary.inputs]
+    return [inputs, map(list, summary.get_outputs())]
+
+def summary_from_json(x):
+    inputs = []
+    for values in x[0]:
+        d = dict((k, v) for k, v in zip(('prevout_hash', 'prevout_n', 'address'), values) if v is not None)
+        if values[3]:
+            d['pubkey'] = True
+        inputs.append(d)
+    return Transaction(inputs, [('address', addr, value) for addr, value in x[1]])
+
+
 class WalletStorage(object):
+    """The wallet file is a JSON snapshot of all keys.  Updates are appended
+    to a journal file next to it, one key (or one item of a dict-valued
+    key) per line, and folded into the snapshot once the journal grows
+    larger than the snapshot.  The first line of the journal holds the
+    hash of the snapshot it applies to, so a journal left over from
+    another snapshot is ignored.
+
+    With 'wallet_flush_interval' set, updates are kept in memory and
+    written by a background thread every that many seconds; repeated
+    updates of the same key in between are coalesced into one."""
+
+    # do not rewrite small wallets on every few updates
+    min_journal_size = 64 * 1024
 
     def __init__(self, config):
         self.lock = threading.RLock()
         self.config = config
         self.data = {}
         self.file_exists = False
+        self.journal = None
+        self.journal_size = 0
+        self.snapshot_size = 0
+        self.snapshot_hash = None
+        self.flush_interval = config.get('wallet_flush_interval', 0)
+        self.pending = OrderedDict()
+        self.flusher = None
+        self.flusher_stop = threading.Event()
+        self.coalesced = 0
         self.path = self.init_path(config)
         print_error( "wallet path", self.path )
+        self.txs = TxStore(self.path + '.txs')
         if self.path:
             self.read(self.path)
 
@@ -84,6 +141,9 @@ class WalletStorage(object):
 
         return new_path
 
+    def journal_path(self):
+        return self.path + '.journal'
+
     def read(self, path):
         """Read the contents of the wallet file."""
         try:
@@ -107,6 +167,42 @@ class WalletStorage(object):
                     continue
                 self.data[key] = value
         self.file_exists = True
+        self.snapshot_size = len(data)
+        self.snapshot_hash = hashlib.sha256(data).hexdigest()
+        self.read_journal()
+
+    def read_journal(self):
+        try:
+            with open(self.journal_path(), "r") as f:
+                lines = f.readlines()
+        except IOError:
+            return
+        try:
+            header = json.loads(lines[0])
+        except Exception:
+            header = None
+        if not isinstance(header, dict) or header.get('snapshot') != self.snapshot_hash:
+            print_error("ignoring stale wallet journal")
+            return
+        size = len(lines[0])
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except Exception:
+                # interrupted append
+                break
+            if len(entry) == 2:
+                key, value = entry
+                d = self.data
+            else:
+                item, key, value = entry
+                d = self.data.setdefault(item, {})
+            if value is not None:
+                d[key] = value
+            else:
+                d.pop(key, None)
+            size += len(line)
+        self.journal_size = size
 
     def get(self, key, default=None):
         with self.lock:
@@ -117,6 +213,14 @@ class WalletStorage(object):
                 v = copy.deepcopy(v)
             return v
 
+    def borrow(self, key, default=None):
+        """Like get, but return the stored value itself instead of a deep
+        copy.  The caller must not modify it, and should make a shallow
+        copy of the containers it is going to change."""
+        with self.lock:
+            v = self.data.get(key)
+            return default if v is None else v
+
     def put(self, key, value, save = True):
         try:
             json.dumps(key)
@@ -126,20 +230,363 @@ class WalletStorage(object):
             return
         with self.lock:
             if value is not None:
-                self.data[key] = copy.deepcopy(value)
+                value = self.data[key] = copy.deepcopy(value)
             elif key in self.data:
                 self.data.pop(key)
             if save:
+                self.append([key, value])
+
+    def put_item(self, key, item, value, save = True):
+        """Set one item of a dict-valued key, without writing the whole
+        dict to disk."""
+        self.put_items(key, [(item, value)], save)
+
+    def put_items(self, key, items, save = True):
+        """Set several (item, value) pairs of a dict-valued key, recorded
+        with a single journal write."""
+        entries = []
+        for item, value in items:
+            try:
+                json.dumps(item)
+                json.dumps(value)
+            except:
+                print_error("json error: cannot save", key, item)
+                continue
+            entries.append([key, item, value])
+        with self.lock:
+            d = self.data.setdefault(key, {})
+            for entry in entries:
+                item, value = entry[1:]
+                if value is not None:
+                    entry[2] = d[item] = copy.deepcopy(value)
+                else:
+                    d.pop(item, None)
+            if save and entries:
+                self.append(*entries)
+
+    def append(self, *entries):
+        """Record updates in the journal, or queue them for the flusher."""
+        with self.lock:
+            if self.flush_interval > 0 and not self.flusher_stop.is_set():
+                for entry in entries:
+                    key = tuple(entry[:-1])
+                    if key in self.pending:
+                        self.pending.pop(key)
+                        self.coalesced += 1
+                    self.pending[key] = entry
+                if self.flusher is None:
+                    self.start_flusher()
+                return
+            self.write_journal(list(entries))
+
+    def write_journal(self, entries):
+        with self.lock:
+            # without a valid journal there is no header to append to
+            if self.snapshot_hash is None or self.journal_size == 0 or self.journal_size > max(self.min_journal_size, self.snapshot_size):
                 self.write()
+                return
+            if self.journal is None:
+                self.journal = self.open_journal("a")
+                self.journal.truncate(self.journal_size)
+            lines = ''.join(json.dumps(entry) + '\n' for entry in entries)
+            self.journal.write(lines)
+            self.journal.flush()
+            self.journal_size += len(lines)
+
+    def start_flusher(self):
+        self.flusher = threading.Thread(target=self.run_flusher)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.stop)
+
+    def run_flusher(self):
+        while not self.flusher_stop.is_set():
+            self.flusher_stop.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write the queued updates."""
+        with self.lock:
+            if not self.pending:
+                return
+            entries = self.pending.values()
+            self.pending.clear()
+            self.write_journal(entries)
+            print_error("wallet flushed: %d updates, %d coalesced so far" % (len(entries), self.coalesced))
+
+    def stop(self):
+        """Stop the flusher and write what it has queued.  Later updates
+        are written immediately."""
+        self.flusher_stop.set()
+        if self.flusher is not None and self.flusher is not threading.current_thread():
+            self.flusher.join()
+        self.flush()
 
     def write(self):
-        s = json.dumps(self.data, indent=4, sort_keys=True)
-        f = open(self.path,"w")
-        f.write(s)
-        f.close()
-        if 'ANDROID_DATA' not in os.environ:
-            import stat
-            os.chmod(self.path,stat.S_IREAD | stat.S_IWRITE)
+        """Write all keys to the wallet file, and start a new journal."""
+        with self.lock:
+            # queued updates are part of the snapshot
+            self.pending.clear()
+            s = json.dumps(self.data, indent=4, sort_keys=True)
+            temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+            with open(temp_path, "w") as f:
+                f.write(s)
+                f.flush()
+                os.fsync(f.fileno())
+            # atomic on POSIX; Windows cannot rename over an existing file
+            try:
+                os.rename(temp_path, self.path)
+            except OSError:
+                os.remove(self.path)
+                os.rename(temp_path, self.path)
+            self.snapshot_size = len(s)
+            self.snapshot_hash = hashlib.sha256(s).hexdigest()
+            if self.journal:
+                self.journal.close()
+            header = json.dumps({'snapshot': self.snapshot_hash}) + '\n'
+            self.journal = self.open_journal("w")
+            self.journal.write(header)
+            self.journal.flush()
+            self.journal_size = len(header)
+            if 'ANDROID_DATA' not in os.environ:
+                os.chmod(self.path,stat.S_IREAD | stat.S_IWRITE)
+                os.chmod(self.journal_path(),stat.S_IREAD | stat.S_IWRITE)
+
+    def open_journal(self, mode):
+        "Open the journal, created readable by the owner only, like the wallet file."
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if mode == "a" else os.O_TRUNC)
+        permissions = 0666 if 'ANDROID_DATA' in os.environ else stat.S_IREAD | stat.S_IWRITE
+        return os.fdopen(os.open(self.journal_path(), flags, permissions), mode)
+
+
+
+class TxStore(object):
+    """Raw transactions of a wallet, in a binary file next to the wallet
+    file.  Records are appended as txid, length and raw bytes; a record of
+    length 0 removes a transaction.  Opening the file only reads the
+    record headers, transactions are read when they are asked for.  The
+    file is a cache: transactions missing from it are fetched again from
+    the history."""
+
+    header_size = 36
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.index = {}     # txid -> (offset, length)
+        self.size = 0
+        self.dead = 0       # bytes of removed records
+        self.f = None
+        self.read_index()
+
+    def read_index(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            pos = 0
+            while pos + self.header_size <= size:
+                f.seek(pos)
+                txid, length = struct.unpack('<32sI', f.read(self.header_size))
+                if pos + self.header_size + length > size:
+                    # interrupted append
+                    break
+                tx_hash = txid.encode('hex')
+                if tx_hash in self.index:
+                    self.dead += self.header_size + self.index.pop(tx_hash)[1]
+                if length:
+                    self.index[tx_hash] = pos + self.header_size, length
+                else:
+                    self.dead += self.header_size
+                pos += self.header_size + length
+        self.size = pos
+
+    def open(self):
+        if self.f is None:
+            mode = 'r+b' if os.path.exists(self.path) else 'w+b'
+            self.f = open(self.path, mode)
+            self.f.truncate(self.size)
+            if 'ANDROID_DATA' not in os.environ:
+                os.chmod(self.path, stat.S_IREAD | stat.S_IWRITE)
+        return self.f
+
+    def close(self):
+        with self.lock:
+            if self.f:
+                self.f.close()
+                self.f = None
+
+    def append(self, tx_hash, raw):
+        f = self.open()
+        f.seek(self.size)
+        f.write(struct.pack('<32sI', tx_hash.decode('hex'), len(raw)) + raw)
+        f.flush()
+        self.size += self.header_size + len(raw)
+
+    def keys(self):
+        with self.lock:
+            return self.index.keys()
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.index
+
+    def get(self, tx_hash):
+        """Return the raw transaction, or None if it is missing or does
+        not match its txid."""
+        with self.lock:
+            if tx_hash not in self.index:
+                return None
+            offset, length = self.index[tx_hash]
+            f = self.open()
+            f.seek(offset)
+            raw = f.read(length)
+        if Hash(raw)[::-1].encode('hex') != tx_hash:
+            print_error("corrupted transaction in cache", tx_hash)
+            return None
+        return raw
+
+    def put(self, tx_hash, raw):
+        with self.lock:
+            if tx_hash in self.index:
+                return
+            self.append(tx_hash, raw)
+            self.index[tx_hash] = self.size - len(raw), len(raw)
+
+    def remove(self, tx_hash):
+        with self.lock:
+            if tx_hash not in self.index:
+                return
+            offset, length = self.index.pop(tx_hash)
+            self.append(tx_hash, '')
+            self.dead += 2 * self.header_size + length
+            if self.dead > max(64 * 1024, self.size - self.dead):
+                self.compact()
+
+    def compact(self):
+        """Rewrite the file without the removed transactions."""
+        with self.lock:
+            records = [(tx_hash, self.get(tx_hash)) for tx_hash in self.index.keys()]
+            self.close()
+            temp_path = self.path + '.tmp'
+            index = {}
+            with open(temp_path, 'wb') as f:
+                pos = 0
+                for tx_hash, raw in records:
+                    if raw is None:
+                        continue
+                    f.write(struct.pack('<32sI', tx_hash.decode('hex'), len(raw)) + raw)
+                    index[tx_hash] = pos + self.header_size, len(raw)
+                    pos += self.header_size + len(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.rename(temp_path, self.path)
+            except OSError:
+                os.remove(self.path)
+                os.rename(temp_path, self.path)
+            self.index = index
+            self.size = pos
+            self.dead = 0
+
+
+class TxHistory(object):
+    """Transaction history of an account, sorted by position in the
+    blockchain, with running balances.  Invalidated transactions are
+    evaluated again and moved to their new position on next use; the
+    running balances are recomputed from the first entry that changed."""
+
+    def __init__(self, wallet, account=None):
+        self.wallet = wallet
+        self.account = account
+        self.lock = threading.Lock()
+        self.entries = []       # sorted list of (txpos, tx_hash, is_mine, value, fee)
+        self.balances = []      # sum of the values up to each entry
+        self.positions = {}     # tx_hash -> txpos of its entry
+        self.dirty = set()
+        self.complete = False
+
+    def invalidate(self, tx_hash=None):
+        with self.lock:
+            if tx_hash is None:
+                self.complete = False
+            else:
+                self.dirty.add(tx_hash)
+
+    def make_entry(self, tx_hash, domain):
+        tx = self.wallet.tx_summaries.get(tx_hash)
+        if tx is None:
+            return
+        is_relevant, is_mine, value, fee = tx.get_value(domain, self.wallet.prevout_values)
+        if not is_relevant:
+            return
+        return (self.wallet.verifier.get_txpos(tx_hash), tx_hash, is_mine, value, fee)
+
+    def update(self):
+        "Call with the wallet transaction lock held"
+        with self.lock:
+            complete, dirty = self.complete, self.dirty
+            self.complete, self.dirty = True, set()
+        domain = set(self.wallet.get_account_addresses(self.account))
+        if not complete:
+            self.entries = filter(None, [self.make_entry(tx_hash, domain) for tx_hash in self.wallet.tx_summaries.keys()])
+            self.entries.sort()
+            self.positions = dict((entry[1], entry[0]) for entry in self.entries)
+            self.balances = []
+            first = 0
+        else:
+            first = len(self.entries)
+            for tx_hash in dirty:
+                txpos = self.positions.pop(tx_hash, None)
+                if txpos is not None:
+                    i = bisect.bisect_left(self.entries, (txpos, tx_hash))
+                    self.entries.pop(i)
+                    first = min(first, i)
+                entry = self.make_entry(tx_hash, domain)
+                if entry is not None:
+                    i = bisect.bisect_left(self.entries, entry)
+                    self.entries.insert(i, entry)
+                    self.positions[tx_hash] = entry[0]
+                    first = min(first, i)
+
+        del self.balances[first:]
+        balance = self.balances[-1] if self.balances else 0
+        for entry in self.entries[first:]:
+            if entry[3] is not None:
+                balance += entry[3]
+            self.balances.append(balance)
+
+    def get(self, offset=0, limit=None, since_height=None):
+        """Return history items (tx_hash, conf, is_mine, value, fee,
+        balance, timestamp) in chronological order.  since_height skips
+        the transactions mined before that height; offset and limit then
+        select a slice of the items, a negative offset counting from the
+        most recent."""
+        with self.wallet.transaction_lock:
+            self.update()
+            c, u = self.wallet.get_account_balance(self.account)
+            total = self.balances[-1] if self.balances else 0
+            # coins received before the first known transaction
+            pruned = c + u - total
+            first = 0
+            if since_height is not None:
+                first = bisect.bisect_left(self.entries, ((since_height,),))
+            head = 1 if pruned and first == 0 else 0
+            start, stop, step = slice(offset, None).indices(head + len(self.entries) - first)
+            if limit is not None:
+                stop = min(stop, start + limit)
+
+            result = []
+            for k in range(start, stop):
+                if k < head:
+                    result.append( ('', 1000, 0, pruned, None, pruned, None ) )
+                    continue
+                i = first + k - head
+                txpos, tx_hash, is_mine, value, fee = self.entries[i]
+                conf, timestamp = self.wallet.verifier.get_confirmations(tx_hash)
+                result.append( (tx_hash, conf, is_mine, value, fee, pruned + self.balances[i], timestamp) )
+        return result
 
 
 class Abstract_Wallet(object):
@@ -156,26 +603,36 @@ class Abstract_Wallet(object):
         self.use_change            = storage.get('use_change',True)
         self.use_encryption        = storage.get('use_encryption', False)
         self.seed                  = storage.get('seed', '')               # encrypted
-        self.labels                = storage.get('labels', {})
-        self.frozen_addresses      = storage.get('frozen_addresses',[])
-        self.addressbook           = storage.get('contacts', [])
+        self.labels                = dict(storage.borrow('labels', {}))
+        self.frozen_addresses      = list(storage.borrow('frozen_addresses',[]))
+        self.addressbook           = list(storage.borrow('contacts', []))
 
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.history               = dict(storage.borrow('addr_history',{}))        # address -> list(txid, height)
+        self.tx_addresses = {}       # txid -> set of addresses whose history has it
+        for addr, hist in self.history.items():
+            self.update_tx_addresses(addr, [], hist)
         self.fee_per_kb            = int(storage.get('fee_per_kb', RECOMMENDED_FEE))
 
         # This attribute is set when wallet.start_threads is called.
         self.synchronizer = None
 
         # imported_keys is deprecated. The GUI should call convert_imported_keys
-        self.imported_keys = self.storage.get('imported_keys',{})
+        self.imported_keys = dict(self.storage.borrow('imported_keys',{}))
 
         self.load_accounts()
 
+        self.pubkey_inputs = {}      # prevout_hash -> txids of transactions with a pay-to-pubkey input spending it
         self.load_transactions()
 
         # not saved
         self.prevout_values = {}     # my own transaction outputs
-        self.spent_outputs = []
+        self.utxos = {}              # address -> {outpoint: coin}, unspent coins
+        self.unsynchronized_addresses = set()
+        self.addr_balances = {}      # address -> (confirmed, unconfirmed)
+        self.account_balances = {}   # account id -> (confirmed, unconfirmed)
+        self.dirty_balances = {}     # address -> balance counted in account_balances
+        self.address_accounts = None # address -> account id
+        self.history_models = {}     # account id -> TxHistory
         # spv
         self.verifier = None
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
@@ -185,8 +642,10 @@ class Abstract_Wallet(object):
         self.lock = threading.Lock()
         self.transaction_lock = threading.Lock()
         self.tx_event = threading.Event()
-        for tx_hash, tx in self.transactions.items():
+        for tx_hash in self.tx_summaries.keys():
             self.update_tx_outputs(tx_hash)
+        for addr in self.history.keys():
+            self.update_addr_utxos(addr)
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -194,33 +653,105 @@ class Abstract_Wallet(object):
 
 
     def load_transactions(self):
+        """Read the stored transactions without parsing them.  Their
+        summaries, stored under 'tx_summaries', are all that the balances
+        and coins are computed from; a transaction is parsed when first
+        used."""
         self.transactions = {}
-        tx_list = self.storage.get('transactions',{})
-        for k, raw in tx_list.items():
-            try:
-                tx = Transaction.deserialize(raw)
-            except Exception:
-                print_msg("Warning: Cannot deserialize transactions. skipping")
+        self.tx_summaries = {}       # txid -> tx_summary of the transaction
+        # wallets written by older versions keep transactions in hex
+        tx_list = self.storage.borrow('transactions')
+        if tx_list:
+            for k, raw in tx_list.items():
+                self.storage.txs.put(k, raw.decode('hex'))
+            self.storage.put('transactions', None)
+        summaries = self.storage.borrow('tx_summaries', {})
+        new_summaries = []
+        for k in self.storage.txs.keys():
+            # no history refers to it: dropped without reading its body
+            if k not in self.tx_addresses:
+                print_error("removing unreferenced tx", k)
+                self.storage.txs.remove(k)
                 continue
-            self.add_pubkey_addresses(tx)
+            raw = self.storage.txs.get(k)
+            if raw is None:
+                continue
+            tx = Transaction.deserialize(raw.encode('hex'), lazy=True)
+            if k in summaries:
+                summary = summary_from_json(summaries[k])
+            else:
+                # stored by a version without summaries
+                try:
+                    summary = tx_summary(tx)
+                except Exception:
+                    print_msg("Warning: Cannot deserialize transactions. skipping")
+                    continue
+                new_summaries.append((k, summary_to_json(summary)))
             self.transactions[k] = tx
-        for h,tx in self.transactions.items():
-            if not self.check_new_tx(h, tx):
+            self.tx_summaries[k] = summary
+        self.storage.put_items('tx_summaries', new_summaries + [(k, None) for k in summaries.keys() if k not in self.tx_summaries])
+        for h, summary in self.tx_summaries.items():
+            self.add_pubkey_addresses(h, summary)
+        for h, summary in self.tx_summaries.items():
+            if not self.check_new_tx(h, summary):
                 print_error("removing unreferenced tx", h)
-                self.transactions.pop(h)
+                self.remove_transaction(h)
+                continue
+            self.copy_pubkey_addresses(h)
+
+    def add_transaction(self, tx_hash, tx, summary):
+        self.transactions[tx_hash] = tx
+        self.tx_summaries[tx_hash] = summary
+        self.storage.txs.put(tx_hash, str(tx).decode('hex'))
+        self.storage.put_item('tx_summaries', tx_hash, summary_to_json(summary))
+        self.copy_pubkey_addresses(tx_hash)
+
+    def remove_transaction(self, tx_hash):
+        "Forgets a transaction, and returns its summary"
+        self.transactions.pop(tx_hash, None)
+        self.storage.txs.remove(tx_hash)
+        self.storage.put_item('tx_summaries', tx_hash, None)
+        return self.tx_summaries.pop(tx_hash, None)
+
+    def update_tx_addresses(self, addr, old_hist, hist):
+        if old_hist != ['*']:
+            for tx_hash, height in old_hist:
+                addresses = self.tx_addresses.get(tx_hash)
+                if addresses is None:
+                    continue
+                addresses.discard(addr)
+                if not addresses:
+                    self.tx_addresses.pop(tx_hash)
+        if hist != ['*']:
+            for tx_hash, height in hist:
+                self.tx_addresses.setdefault(tx_hash, set()).add(addr)
 
-    def add_pubkey_addresses(self, tx):
+    def add_pubkey_addresses(self, tx_hash, summary):
         # find the address corresponding to pay-to-pubkey inputs
-        h = tx.hash()
 
-        # inputs
-        tx.add_pubkey_addresses(self.transactions)
+        # inputs, those whose previous tx is missing wait for it
+        summary.add_pubkey_addresses(self.tx_summaries)
+        for txin in summary.inputs:
+            if txin.get('address') == "(pubkey)":
+                waiting = self.pubkey_inputs.setdefault(txin['prevout_hash'], [])
+                if tx_hash not in waiting:
+                    waiting.append(tx_hash)
 
         # outputs of tx: inputs of tx2
-        for type, x, v in tx.outputs:
-            if type == 'pubkey':
-                for tx2 in self.transactions.values():
-                    tx2.add_pubkey_addresses({h:tx})
+        for h2 in self.pubkey_inputs.pop(tx_hash, []):
+            summary2 = self.tx_summaries.get(h2)
+            if summary2 is None:
+                continue
+            summary2.add_pubkey_addresses({tx_hash:summary})
+            self.storage.put_item('tx_summaries', h2, summary_to_json(summary2))
+            self.copy_pubkey_addresses(h2)
+
+    def copy_pubkey_addresses(self, tx_hash):
+        "Sets the addresses found for the pay-to-pubkey inputs of a transaction, without parsing it"
+        tx = self.transactions.get(tx_hash)
+        for i, txin in enumerate(self.tx_summaries[tx_hash].inputs):
+            if tx and txin.get('pubkey') and txin['address'] != "(pubkey)":
+                tx.set_input_address(i, txin['address'])
 
     def get_action(self):
         pass
@@ -392,7 +923,7 @@ class Abstract_Wallet(object):
 
     def fill_addressbook(self):
         # todo: optimize this
-        for tx_hash, tx in self.transactions.viewitems():
+        for tx_hash, tx in self.tx_summaries.viewitems():
             is_relevant, is_send, _, _ = self.get_tx_value(tx)
             if is_send:
                 for addr in tx.get_output_addresses():
@@ -403,7 +934,7 @@ class Abstract_Wallet(object):
 
     def get_num_tx(self, address):
         n = 0
-        for tx in self.transactions.values():
+        for tx in self.tx_summaries.values():
             if address in tx.get_output_addresses(): n += 1
         return n
 
@@ -412,57 +943,92 @@ class Abstract_Wallet(object):
         return tx.get_value(domain, self.prevout_values)
 
     def update_tx_outputs(self, tx_hash):
-        tx = self.transactions.get(tx_hash)
+        tx = self.tx_summaries.get(tx_hash)
 
         for i, (addr, value) in enumerate(tx.get_outputs()):
             key = tx_hash+ ':%d'%i
             self.prevout_values[key] = value
 
-        for item in tx.inputs:
-            if self.is_mine(item.get('address')):
-                key = item['prevout_hash'] + ':%d'%item['prevout_n']
-                self.spent_outputs.append(key)
+    def get_tx_addresses(self, tx):
+        "Returns the addresses of the wallet that appear in tx"
+        addresses = tx.get_output_address_set() | tx.get_input_address_set()
+        return [addr for addr in addresses if addr in self.history]
 
-    def get_addr_balance(self, address):
-        'returns the confirmed balance and pending (unconfirmed) balance change of this pesetacoin address'
-        #assert self.is_mine(address)
-        h = self.history.get(address,[])
-        if h == ['*']: return 0,0
+    def update_addr_utxos(self, address):
+        "Rebuilds the unspent coins of address from its history"
+        received = {}
+        spent = {}
+        synchronized = True
+        h = self.history.get(address, [])
+        if h != ['*']:
+            for tx_hash, tx_height in h:
+                tx = self.tx_summaries.get(tx_hash)
+                if tx is None:
+                    synchronized = False
+                    continue
+                for item in tx.inputs:
+                    if item.get('address') == address:
+                        spent[item['prevout_hash'] + ':%d'%item['prevout_n']] = tx_height
+                is_coinbase = tx.inputs[0].get('prevout_hash') == '0'*64
+                for i, (addr, value) in enumerate(tx.get_outputs()):
+                    if addr == address:
+                        received[tx_hash + ':%d'%i] = {'address':address, 'value':value, 'prevout_n':i,
+                                                       'prevout_hash':tx_hash, 'height':tx_height, 'coinbase':is_coinbase}
+        coins = {}
         c = u = 0
-        received_coins = []   # list of coins received at address
-        # go through all tx in history of this address and collect the coins arriving on this address
-        for tx_hash, tx_height in h:
-            tx = self.transactions.get(tx_hash)
-            if not tx: continue
-
-            for i, (addr, value) in enumerate(tx.get_outputs()):
-                if addr == address:
-                    key = tx_hash + ':%d'%i
-                    received_coins.append(key)
-        # go through all tx in history of this address again
-        for tx_hash, tx_height in h:
-            tx = self.transactions.get(tx_hash)
-            if not tx: continue
-            v = 0
-            # substract the value of coins leaving from this address
-            for item in tx.inputs:
-                addr = item.get('address')
-                if addr == address:
-                    key = item['prevout_hash']  + ':%d'%item['prevout_n']
-                    value = self.prevout_values.get( key )
-                    if key in received_coins:
-                        v -= value
-            # add the value of the coins arriving in this address
-            for i, (addr, value) in enumerate(tx.get_outputs()):
-                key = tx_hash + ':%d'%i
-                if addr == address:
-                    v += value
-
-            if tx_height:
-                c += v  # confirmed coins value
+        for key, coin in received.items():
+            spent_height = spent.get(key)
+            if spent_height is None:
+                coins[key] = coin
+                if coin['height']:
+                    c += coin['value']  # confirmed coins value
+                else:
+                    u += coin['value']  # unconfirmed coins value
+            elif spent_height == 0 and coin['height']:
+                # the coin still counts as confirmed, its spending does not
+                c += coin['value']
+                u -= coin['value']
+
+        with self.lock:
+            self.utxos[address] = coins
+            if synchronized:
+                self.unsynchronized_addresses.discard(address)
             else:
-                u += v  # unconfirmed coins value
-        return c, u
+                self.unsynchronized_addresses.add(address)
+            old = self.addr_balances.get(address, (0, 0))
+            if (c, u) != old:
+                self.addr_balances[address] = (c, u)
+                self.dirty_balances.setdefault(address, old)
+
+    def get_addr_balance(self, address):
+        'returns the confirmed balance and pending (unconfirmed) balance change of this pesetacoin address'
+        with self.lock:
+            return self.addr_balances.get(address, (0, 0))
+
+    def update_account_balances(self):
+        "Adds the balance changes of dirty addresses to the account totals. Call with the lock held."
+        if not self.dirty_balances:
+            return
+        if self.address_accounts is None:
+            self.address_accounts = {}
+            for acc_id in self.accounts:
+                for addr in self.get_account_addresses(acc_id):
+                    self.address_accounts[addr] = acc_id
+        for address, (c0, u0) in self.dirty_balances.items():
+            acc_id = self.address_accounts.get(address)
+            if acc_id is None:
+                continue
+            c, u = self.addr_balances[address]
+            cc, uu = self.account_balances.get(acc_id, (0, 0))
+            self.account_balances[acc_id] = cc + c - c0, uu + u - u0
+        self.dirty_balances.clear()
+
+    def reset_account_balances(self):
+        "Recomputes the account totals on next use, after the accounts have changed"
+        with self.lock:
+            self.account_balances = {}
+            self.address_accounts = None
+            self.dirty_balances = dict((addr, (0, 0)) for addr in self.addr_balances)
 
     def get_account_name(self, k):
         return self.labels.get(k, self.accounts[k].get_name(k))
@@ -491,16 +1057,24 @@ class Abstract_Wallet(object):
         return None
 
     def get_account_balance(self, account):
-        return self.get_balance(self.get_account_addresses(account))
+        if account is None:
+            return self.get_balance()
+        with self.lock:
+            self.update_account_balances()
+            return self.account_balances.get(account, (0, 0))
 
     def get_frozen_balance(self):
         return self.get_balance(self.frozen_addresses)
 
     def get_balance(self, domain=None):
-        if domain is None: domain = self.addresses(True)
+        with self.lock:
+            if domain is None:
+                self.update_account_balances()
+                balances = [self.account_balances.get(k, (0, 0)) for k in self.accounts]
+            else:
+                balances = [self.addr_balances.get(addr, (0, 0)) for addr in domain]
         cc = uu = 0
-        for addr in domain:
-            c, u = self.get_addr_balance(addr)
+        for c, u in balances:
             cc += c
             uu += u
         return cc, uu
@@ -508,22 +1082,12 @@ class Abstract_Wallet(object):
     def get_unspent_coins(self, domain=None):
         coins = []
         if domain is None: domain = self.addresses(True)
-        for addr in domain:
-            h = self.history.get(addr, [])
-            if h == ['*']: continue
-            for tx_hash, tx_height in h:
-                tx = self.transactions.get(tx_hash)
-                if tx is None: raise Exception("Wallet not synchronized")
-                is_coinbase = tx.inputs[0].get('prevout_hash') == '0'*64
-                for i, (address, value) in enumerate(tx.get_outputs()):
-                    output = {'address':address, 'value':value, 'prevout_n':i}
-                    if address != addr: continue
-                    key = tx_hash + ":%d"%i
-                    if key in self.spent_outputs: continue
-                    output['prevout_hash'] = tx_hash
-                    output['height'] = tx_height
-                    output['coinbase'] = is_coinbase
-                    coins.append((tx_height, output))
+        with self.lock:
+            for addr in domain:
+                if addr in self.unsynchronized_addresses:
+                    raise Exception("Wallet not synchronized")
+                for coin in self.utxos.get(addr, {}).itervalues():
+                    coins.append((coin['height'], dict(coin)))
 
         # sort by age
         if coins:
@@ -556,23 +1120,26 @@ class Abstract_Wallet(object):
     def receive_tx_callback(self, tx_hash, tx, tx_height):
 
         with self.transaction_lock:
-            self.add_pubkey_addresses(tx)
-            if not self.check_new_tx(tx_hash, tx):
+            summary = tx_summary(tx)
+            self.add_pubkey_addresses(tx_hash, summary)
+            if not self.check_new_tx(tx_hash, summary):
                 # may happen due to pruning
                 print_error("received transaction that is no longer referenced in history", tx_hash)
                 return
-            self.transactions[tx_hash] = tx
+            self.add_transaction(tx_hash, tx, summary)
             self.network.pending_transactions_for_notifications.append(tx)
-            self.save_transactions()
             if self.verifier and tx_height>0:
                 self.verifier.add(tx_hash, tx_height)
             self.update_tx_outputs(tx_hash)
-
-    def save_transactions(self):
-        tx = {}
-        for k,v in self.transactions.items():
-            tx[k] = str(v)
-        self.storage.put('transactions', tx, True)
+            for addr in self.get_tx_addresses(summary):
+                self.update_addr_utxos(addr)
+            # the transactions spending its outputs have a new value
+            for addr in summary.get_output_address_set():
+                h = self.history.get(addr, [])
+                if h != ['*']:
+                    for _hash, height in h:
+                        self.invalidate_history(_hash)
+            self.invalidate_history(tx_hash)
 
     def receive_history_callback(self, addr, hist):
 
@@ -580,8 +1147,16 @@ class Abstract_Wallet(object):
             raise Exception("error: received history for %s is not consistent with known transactions"%addr)
 
         with self.lock:
+            old_hist = self.history.get(addr, [])
+            self.update_tx_addresses(addr, old_hist, hist)
             self.history[addr] = hist
-            self.storage.put('addr_history', self.history, True)
+            self.storage.put_item('addr_history', addr, hist)
+        self.update_addr_utxos(addr)
+        if hist == ['*'] or old_hist == ['*']:
+            self.invalidate_history()
+        else:
+            for tx_hash, height in set(map(tuple, hist)) ^ set(map(tuple, old_hist)):
+                self.invalidate_history(tx_hash)
 
         if hist != ['*']:
             for tx_hash, tx_height in hist:
@@ -589,37 +1164,18 @@ class Abstract_Wallet(object):
                     # add it in case it was previously unconfirmed
                     if self.verifier: self.verifier.add(tx_hash, tx_height)
 
-    def get_tx_history(self, account=None):
+    def get_tx_history(self, account=None, offset=0, limit=None, since_height=None):
         if not self.verifier:
             return []
+        model = self.history_models.get(account)
+        if model is None:
+            model = self.history_models.setdefault(account, TxHistory(self, account))
+        return model.get(offset, limit, since_height)
 
-        with self.transaction_lock:
-            history = self.transactions.items()
-            history.sort(key = lambda x: self.verifier.get_txpos(x[0]))
-            result = []
-
-            balance = 0
-            for tx_hash, tx in history:
-                is_relevant, is_mine, v, fee = self.get_tx_value(tx, account)
-                if v is not None: balance += v
-
-            c, u = self.get_account_balance(account)
-
-            if balance != c+u:
-                result.append( ('', 1000, 0, c+u-balance, None, c+u-balance, None ) )
-
-            balance = c + u - balance
-            for tx_hash, tx in history:
-                is_relevant, is_mine, value, fee = self.get_tx_value(tx, account)
-                if not is_relevant:
-                    continue
-                if value is not None:
-                    balance += value
-
-                conf, timestamp = self.verifier.get_confirmations(tx_hash) if self.verifier else (None, None)
-                result.append( (tx_hash, conf, is_mine, value, fee, balance, timestamp) )
-
-        return result
+    def invalidate_history(self, tx_hash=None):
+        "Marks a transaction, or the whole history if None, to be evaluated again"
+        for model in self.history_models.values():
+            model.invalidate(tx_hash)
 
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash)
@@ -628,7 +1184,7 @@ class Abstract_Wallet(object):
         return label, is_default
 
     def get_default_label(self, tx_hash):
-        tx = self.transactions.get(tx_hash)
+        tx = self.tx_summaries.get(tx_hash)
         default_label = ''
         if tx:
             is_relevant, is_mine, _, _ = self.get_tx_value(tx)
@@ -730,19 +1286,19 @@ class Abstract_Wallet(object):
         if fixed_fee is not None and change_amount > 0:
             # Insert the change output at a random position in the outputs
             posn = random.randint(0, len(tx.outputs))
-            tx.outputs[posn:posn] = [( 'address', change_addr,  change_amount)]
+            tx.insert_output(posn, ( 'address', change_addr,  change_amount))
         elif change_amount > DUST_THRESHOLD:
             # Insert the change output at a random position in the outputs
             posn = random.randint(0, len(tx.outputs))
-            tx.outputs[posn:posn] = [( 'address', change_addr,  change_amount)]
+            tx.insert_output(posn, ( 'address', change_addr,  change_amount))
             # recompute fee including change output
             fee = self.estimated_fee(tx)
             # remove change output
-            tx.outputs.pop(posn)
+            tx.remove_output(posn)
             # if change is still above dust threshold, re-add change output.
             change_amount = total - ( amount + fee )
             if change_amount > DUST_THRESHOLD:
-                tx.outputs[posn:posn] = [( 'address', change_addr,  change_amount)]
+                tx.insert_output(posn, ( 'address', change_addr,  change_amount))
                 print_error('change', change_amount)
             else:
                 print_error('not keeping dust', change_amount)
@@ -870,13 +1426,16 @@ class Abstract_Wallet(object):
         vr = self.verifier.transactions.keys() + self.verifier.verified_tx.keys()
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
-                self.transactions.pop(tx_hash)
+                summary = self.remove_transaction(tx_hash)
+                for addr in self.get_tx_addresses(summary):
+                    self.update_addr_utxos(addr)
+        self.invalidate_history()
 
     def check_new_history(self, addr, hist):
         # check that all tx in hist are relevant
         if hist != ['*']:
             for tx_hash, height in hist:
-                tx = self.transactions.get(tx_hash)
+                tx = self.tx_summaries.get(tx_hash)
                 if not tx: continue
                 if not tx.has_address(addr):
                     return False
@@ -885,19 +1444,13 @@ class Abstract_Wallet(object):
         old_hist = self.history.get(addr,[])
         if old_hist == ['*']: return True
 
+        new_tx_hashes = set(x[0] for x in hist) if hist != ['*'] else set()
         for tx_hash, height in old_hist:
-            if tx_hash in map(lambda x:x[0], hist): continue
-            found = False
-            for _addr, _hist in self.history.items():
-                if _addr == addr: continue
-                if _hist == ['*']: continue
-                _tx_hist = map(lambda x:x[0], _hist)
-                if tx_hash in _tx_hist:
-                    found = True
-                    break
+            if tx_hash in new_tx_hashes: continue
+            found = bool(self.tx_addresses.get(tx_hash, set()) - set([addr]))
 
             if not found:
-                tx = self.transactions.get(tx_hash)
+                tx = self.tx_summaries.get(tx_hash)
                 # tx might not be there
                 if not tx: continue
 
@@ -925,19 +1478,16 @@ class Abstract_Wallet(object):
                     self.verifier.add(tx_hash, height)
                 else:
                     print_error("removing orphaned tx from history", tx_hash)
-                    self.transactions.pop(tx_hash)
+                    self.remove_transaction(tx_hash)
+                    for _addr in self.get_tx_addresses(tx):
+                        self.update_addr_utxos(_addr)
+                    self.invalidate_history(tx_hash)
 
         return True
 
     def check_new_tx(self, tx_hash, tx):
         # 1 check that tx is referenced in addr_history.
-        addresses = []
-        for addr, hist in self.history.items():
-            if hist == ['*']:continue
-            for txh, height in hist:
-                if txh == tx_hash:
-                    addresses.append(addr)
-
+        addresses = list(self.tx_addresses.get(tx_hash, ()))
         if not addresses:
             return False
 
@@ -953,6 +1503,7 @@ class Abstract_Wallet(object):
         self.network = network
         if self.network is not None:
             self.verifier = TxVerifier(self.network, self.storage)
+            self.verifier.add_callback(self.invalidate_history)
             self.verifier.start()
             self.set_verifier(self.verifier)
             self.synchronizer = WalletSynchronizer(self, network)
@@ -965,6 +1516,7 @@ class Abstract_Wallet(object):
         if self.network:
             self.verifier.stop()
             self.synchronizer.stop()
+        self.storage.stop()
 
     def restore(self, cb):
         pass
@@ -981,6 +1533,8 @@ class Abstract_Wallet(object):
         for k, v in self.accounts.items():
             d[k] = v.dump()
         self.storage.put('accounts', d, True)
+        self.reset_account_balances()
+        self.invalidate_history()
 
     def can_import(self):
         return not self.is_watching_only()
@@ -97,6 +97,7 @@ setup(
         'electrum_peseta.bmp',
         'electrum_peseta.commands',
         'electrum_peseta.daemon',
+        'electrum_peseta.event_loop',
         'electrum_peseta.i18n',
         'electrum_peseta.interface',
         'electrum_peseta.mnemonic',